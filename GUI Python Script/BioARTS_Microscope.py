@@ -74,87 +74,340 @@
 
 ## ======== DECLARING LIBRARIES ======== ##
 
+# Only what the window needs is imported here. NumPy, OpenCV, PIL, picamera
+# and the modules built on them take seconds to load on a Raspberry Pi, so
+# they are imported by loadHardware() once the window is on screen.
+from startup import StartupTimer
+startupTimer = StartupTimer()
+# Timing spans of the capture stages, the time lapse, the LEDs and the
+# exports (see tracing.py), off unless MICROSCOPE_TRACE=1 or enabled from
+# the Timing menu.
+from tracing import tracer
+
 import Tkinter as tk
 from Tkinter import *
-from PIL import Image
-from PIL import ImageTk
 from fractions import Fraction
 import tkMessageBox as messagebox
 import tkFileDialog
-import pygame
 import time
-import cv2
 import threading
-import picamera
-import picamera.array
-import RPi.GPIO as GPIO  
-import numpy as np
 import io
 import os
+import Queue
 from datetime import datetime, timedelta
-
-# Bright Field LED pin configuration.
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-pin = 18
-GPIO.setup(pin, GPIO.OUT)
-GPIO.output(pin, GPIO.LOW)
-
-# Blue Fluorescence excitation LED pin (UV LED) configuration.
-pin3 = 23
-GPIO.setup(pin3,GPIO.OUT)
-GPIO.output(pin3, GPIO.LOW)
-
-# Green Fluorescence excitation LED pin (Blue LED) configuration.
-pin2 = 24
-GPIO.setup(pin2,GPIO.OUT)
-GPIO.output(pin2, GPIO.LOW)
-
-# Red Fluorescence excitation LED pin (Green-Ambar LED) configuration.
-pin4 = 25
-GPIO.setup(pin4,GPIO.OUT)
-GPIO.output(pin4, GPIO.LOW)
+startupTimer.mark('Tk imports')
+
+# Camera and LED GPIO: picamera and RPi.GPIO on the Raspberry Pi, a simulated
+# camera and LEDs elsewhere or with MICROSCOPE_BACKEND=sim (see hardware.py).
+# They are opened by loadHardware(), until then the controls that use them
+# are disabled.
+camera = None
+GPIO = None
+
+# LED pins (BCM), set from hardware.LED_PINS by loadHardware(): Bright Field
+# (white LED), Blue Fluorescence excitation (UV LED), Green Fluorescence
+# excitation (Blue LED) and Red Fluorescence excitation (Green-Ambar LED).
+pin = None
+pin3 = None
+pin2 = None
+pin4 = None
 
 # Declaring Camera
-camera = picamera.PiCamera()
 previewstatus = 0
 numImages = 1
 timelapse = 0
 
-
-## camera.hflip = True
-camera.vflip = True
 captureCount = 0
 
+# Still images are captured and written by a background pipeline. The writer
+# queue depth is the number of full resolution frames (~24 MB each) that can
+# wait for the SD card before new captures are refused.
+WRITE_QUEUE_DEPTH = 2
+# Full resolution frames are captured into buffers allocated once at start
+# up (see bufferpool.py), shared by stills, time lapses and the multichannel
+# sequence. Steady state captures need one for the capture, one for the
+# writer, one for the image on display and one for the gamma window; when
+# more are needed at once a temporary one is allocated.
+FRAME_BUFFERS = 4
+framePool = None
+# Buffer of the image on display (imgaux), held until the next capture, and
+# its significant bits (10 for raw captures).
+imgLease = None
+imgBits = 8
+
+# Events produced by the pipeline threads, consumed on the Tk main loop. The
+# buffers of the frame and the thumbnail are retained here, before the
+# pipeline releases them, and released by pollCaptureEvents().
+captureEvents = Queue.Queue()
+
+# Files are written by the export engine (see export.py); stills are saved as
+# tiled TIFF compressed with zlib on every core.
+STILL_FORMAT = 'TIFF'
+exporter = None
+
+def stillWrite(fileName, image):
+        result = exporter.write(image, fileName, STILL_FORMAT)
+        storageMonitor.recordExport(result)
+        return result
+
+def captureThumbnail(job):
+        captureEvents.put(('thumbnail', job, (job.buffer.retain(), job.thumbnailBuffer.retain())))
+
+capturePipeline = None
+
+# Raw mode (see rawcapture.py): linear 10-bit sensor counts, 2x2 binned to
+# 1640x1232 and saved as 16-bit TIFF, for quantitative fluorescence.
+rawCapture = None
+
+# Channels captured by the multichannel sequence (brightfield and the three
+# fluorescence fields), with the settings of DEFAULT_CHANNELS in sequencer.py,
+# shared with the headless acquisition (acquire.py).
+CHANNELS = None
+sequencer = None
+
+# Dark and flat-field maps of each channel and exposure (see calibration.py),
+# applied to stills, multichannel sequences and time lapses when "Flat-field"
+# is checked. They are recorded from the Calibration menu.
+calibration = None
+
+# Latest frame of every channel, merged in false colour (see composite.py and
+# compositeView()). Stills taken with an LED on and multichannel sequences
+# update it.
+composite = None
+
+# Thumbnails of the captures shown in the gallery, decoded on worker threads
+# and cached in memory and under .thumbnails/ (see gallery.py).
+thumbnails = None
+
+# Camera settings, channel and LED of every capture, in captures.sqlite and a
+# <file>.json next to each image (see metadata.py).
+metadataIndex = None
+
+# Free space, write rate and time left on the SD card (see storage.py), shown
+# under the Quit button and printed with every time lapse frame. Time lapses
+# switch to a stronger compression and then pause when the card fills up.
+storageMonitor = None
+thread1 = None
+
+# Settings asked for by the controls, written to the camera only when they
+# differ from the ones applied: every 50 ms while a slider moves and right
+# before each capture (see camerasettings.py). The white balance presets of
+# the channels are read from presets.json.
+cameraSettings = None
+
+# Size of the frame captured at start up to wake the sensor up, so the first
+# still does not pay for it.
+WARMUP_SIZE = (320, 240)
+
+# Runs on a background thread once the window is painted: imports the heavy
+# modules, opens the camera and the LEDs and builds the capture pipeline,
+# then takes a first small frame. The main loop is told through captureEvents
+# (see hardwareReady()), this thread never touches the widgets.
+def loadHardware():
+        global np, cv2, Image, ImageTk
+        global BufferPool, Exporter, EXPORT_FORMATS, StackWriter, uniqueFileName
+        global BurstStacker, TimelapseScheduler, MultichannelSequencer, timingReport
+        global ToneMapper, gammaCorrection, VideoPortPreview, focusTracker, AutoExposure
+        global CALIBRATION_FRAMES, calibration, composite
+        global ImagePyramid, Viewport, LRUCache
+        global listCaptures, loadImage, imageBits, thumbnails
+        global cameraState, captureRecord, metadataIndex
+        global storageMonitor, COMPRESSION, STACK_ACTIONS
+        global cameraSettings
+        global pin, pin2, pin3, pin4
+        global camera, GPIO, framePool, exporter, capturePipeline, rawCapture, CHANNELS, sequencer
+        try:
+                import numpy as np
+                import cv2
+                from PIL import Image
+                from PIL import ImageTk
+                from hardware import LED_PINS, openHardware, rgbArray
+                from capture_pipeline import CapturePipeline
+                from export import Exporter, EXPORT_FORMATS
+                from stackwriter import StackWriter, uniqueFileName
+                from bufferpool import BufferPool
+                from rawcapture import RawCapture
+                from stacking import BurstStacker
+                from timelapse import TimelapseScheduler
+                from sequencer import DEFAULT_CHANNELS, MultichannelSequencer, timingReport
+                from tonemap import ToneMapper, gammaCorrection
+                from livepreview import VideoPortPreview
+                from focus import FocusTracker
+                from autoexposure import AutoExposure
+                from calibration import CALIBRATION_FRAMES, CalibrationStore
+                from composite import Composite
+                from pyramid import ImagePyramid, Viewport
+                from cache import LRUCache
+                from gallery import ThumbnailCache, listCaptures, loadImage, imageBits
+                from metadata import MetadataIndex, cameraState, captureRecord
+                from storage import StorageMonitor, COMPRESSION, STACK_ACTIONS
+                from camerasettings import CameraSettings, loadPresets
+                startupTimer.mark('modules')
+
+                camera, GPIO = openHardware()
+                GPIO.setmode(GPIO.BCM)
+                GPIO.setwarnings(False)
+                pin = LED_PINS['BrFld']
+                pin3 = LED_PINS['Blue']
+                pin2 = LED_PINS['Green']
+                pin4 = LED_PINS['Red']
+                for p in (pin, pin2, pin3, pin4):
+                        GPIO.setup(p, GPIO.OUT)
+                        GPIO.output(p, GPIO.LOW)
+                ## camera.hflip = True
+                camera.vflip = True
+                startupTimer.mark('camera')
+
+                framePool = BufferPool((3280,2464), FRAME_BUFFERS)
+                exporter = Exporter()
+                metadataIndex = MetadataIndex()
+                storageMonitor = StorageMonitor('.')
+                capturePipeline = CapturePipeline(camera, queueDepth = WRITE_QUEUE_DEPTH,
+                        onThumbnail = captureThumbnail,
+                        onWritten = lambda job: captureEvents.put(('written', job, None)),
+                        pool = framePool, write = stillWrite, index = metadataIndex)
+                try:
+                        presets = loadPresets()
+                except ValueError as e:
+                        print "Camera presets not loaded:", e
+                        presets = None
+                cameraSettings = CameraSettings(camera, capturePipeline.cameraLock, presets)
+                rawCapture = RawCapture(camera, binning = True)
+                CHANNELS = DEFAULT_CHANNELS
+                sequencer = MultichannelSequencer(camera, GPIO, (pin, pin2, pin3, pin4),
+                                                  sequenceCapture, capturePipeline.cameraLock,
+                                                  settings = cameraSettings)
+                focusTracker = FocusTracker()
+                calibration = CalibrationStore()
+                composite = Composite()
+                thumbnails = ThumbnailCache()
+                startupTimer.mark('pipeline')
+
+                with capturePipeline.cameraLock:
+                        camera.capture(rgbArray(camera, WARMUP_SIZE), 'bgr',
+                                       use_video_port = True, resize = WARMUP_SIZE)
+                startupTimer.mark('first capture')
+        except Exception as e:
+                captureEvents.put(('ready', None, e))
+                return
+        captureEvents.put(('ready', None, None))
+
+# Runs on the main loop once loadHardware() has finished: shows the camera
+# settings, fills the format menus and enables the controls.
+def hardwareReady(error):
+        if error is not None:
+                readyLabel.config(text = "Camera error", fg = "red")
+                print "Could not start the camera:", error
+                return
+        sBright.set(camera.brightness)
+        sContrs.set(camera.contrast)
+        sSat.set(camera.saturation)
+        sSharp.set(camera.sharpness)
+        menu = optionExp['menu']
+        menu.delete(0, END)
+        for name in EXPORT_FORMATS.keys():
+                menu.add_command(label = name, command = tk._setit(var8, name))
+        menu = optionAWBModes['menu']
+        menu.delete(0, END)
+        for name in list(cameraSettings.presets) + AWB_MODES:
+                menu.add_command(label = name, command = tk._setit(var1, name, awb_modes))
+        for widget in hardwareControls:
+                widget.config(state = NORMAL)
+        readyLabel.config(text = "Ready", fg = "dark green")
+        startupTimer.mark('ready')
+        print startupTimer.report()
+
 
 ## ======== THREADED FUNCTIONS DECLARATION ======== ##
-# Creating threading classes. 
 # The use of threads make the program more stable by preventing it to freeze
 # when performing a looped action, such as taking a single photo or a time
 # lapse. Also, this allows to perform different calculations in parallel.
+# Single photos go through the capture pipeline (see still()); time lapses are
+# run by a TimelapseScheduler (see timelapse.py) with the functions below.
+# Every frame of a time lapse is appended to a single OME-TIFF file,
+# timelapse-<date>.ome.tiff, by a StackWriter (see stackwriter.py).
+
+# Presets the camera resolution once, before the first frame of the sequence.
+def timelapsePrepare():
+        with capturePipeline.cameraLock:
+                if camera.resolution != (3280,2464):
+                        camera.resolution = (3280,2464)
 
-class imageSequenceThread(threading.Thread):
-        def __init__(self, timelapse):
-                threading.Thread.__init__(self)
-                self.timelapse = timelapse
-                self._stop = threading.Event()
-        def run(self):
-                while not self._stop.isSet():
-                        GPIO.output(pin, GPIO.HIGH)
+# Called at each deadline of the sequence: turns on the LED, captures the
+# image and turns the LED off again. The encoding is left to the encoder
+# thread of the scheduler, which overlaps it with the wait for the next frame.
+# This time lapse works only for brightfield.
+def timelapseCapture(frame):
+        with capturePipeline.cameraLock:
+                exposure = camera.shutter_speed
+                # The live preview may have switched the sensor mode.
+                if camera.resolution != (3280,2464):
                         camera.resolution = (3280,2464)
-                        timestr = time.strftime("%d-%m-%H-%M-%S-img")
-                        camera.capture(timestr +'.png')
+                GPIO.output(pin, GPIO.HIGH)
+                buf = framePool.acquire()
+                try:
+                        camera.capture(buf.raw, 'bgr')
+                        state = cameraState(camera)
+                except:
+                        buf.release()
+                        raise
+                finally:
                         GPIO.output(pin, GPIO.LOW)
-                        time.sleep(self.timelapse)
-        def stop(self):
-                self.flag = False
-
-# Previous while loop inside the thread captures timelapse images.
-# First, tunrs on the LED, then presets the camera resolution and last captures
-# the image.
-# Once the image is captured, the program waits a defined time to take the next
-# picture.
-# This time lapse works only for brightfield.
+        return ("BrFld", exposure, buf, state)
+
+# Appends a frame to the stack, corrected first if the time lapse was started
+# with "Flat-field" checked, and records it in the metadata index.
+def timelapseWrite(writer, frame, data, correct = False):
+        channel, exposure, buf, state = data
+        try:
+                if correct:
+                        calibration.correct(buf.array, channel, exposure, out = buf.array)
+                status, action = storageMonitor.check(STACK_ACTIONS)
+                if action == 'compress' and (writer.compression, writer.level) != COMPRESSION:
+                        writer.setCompression(*COMPRESSION)
+                start = time.time()
+                end = writer.end
+                writer.append(frame, channel, buf.array)
+                storageMonitor.recordWrite(writer.end - end, time.time() - start)
+                metadataIndex.add(captureRecord(writer.fileName, buf.array, state, channel, channelPin(channel),
+                                                (frame, writer.channelIndex(channel))))
+        finally:
+                buf.release()
+
+# Same as timelapseCapture() for every channel in CHANNELS; the sequencer
+# turns on the LED of each channel and waits until the image is stable.
+def timelapseCaptureChannels(frame):
+        timelapsePrepare()
+        results = sequencer.runTimepoint(CHANNELS, frame)
+        print timingReport(results)
+        return [(channel.name, channel.shutter_speed, buf, t['state']) for channel, buf, t in results]
+
+def timelapseWriteChannels(writer, frame, data, correct = False):
+        for item in data:
+                timelapseWrite(writer, frame, item, correct)
+
+def timelapseReport(frame, jitter, stats):
+        print "Timelapse frame", frame + 1, "jitter %.1f ms," % (jitter * 1000), stats.missed, "missed deadlines"
+        print "Storage:", storageMonitor.status()
+
+# Asked by the scheduler at every deadline: skips it while the card is full.
+def timelapseHold():
+        storageMonitor.setQueue(thread1.encodeQueue.qsize(), thread1.encodeQueue.maxsize)
+        status, action = storageMonitor.check(STACK_ACTIONS)
+        return action == 'pause'
+
+# Runs on the scheduler thread once the run is over, stopped or failed; the
+# buttons and the status are updated by pollCaptureEvents().
+def timelapseFinish(writer):
+        error = thread1.error
+        try:
+                writer.close()
+        except Exception as e:
+                error = error or e
+        # The sequencer may have left the settings of a channel.
+        cameraSettings.restore()
+        print "Timelapse saved to", writer.fileName, "(%d images)" % len(writer.pages)
+        captureEvents.put(('timelapse', None, error))
 
 
 ## ======== DEFINIG FUNCTIONS ======== ##
@@ -167,38 +420,45 @@ def centre_window(w, h):
 	y = (hs/2)
 	root.geometry('%dx%d+%d+%d' % (w, h, x, y))
 	
+# The controls only change the desired settings, cameraSettings writes them.
+# Scales set before the camera is ready are read again by still().
+def cameraSetting(name, value):
+        if cameraSettings is not None:
+                cameraSettings.set(name, value)
+
 def brightnessScale(value):
-        camera.brightness = int(value)
+        cameraSetting('brightness', int(value))
 
 def contrastScale(value):
-        camera.contrast = int(value)
+        cameraSetting('contrast', int(value))
         
 def saturationScale(value):
-        camera.saturation = int(value)
+        cameraSetting('saturation', int(value))
         
 def exposureTimeScale(value):
 # This command controls the exposure time in the RasPi Camera.
-        camera.shutter_speed = int(value)*1000
+        cameraSetting('shutter_speed', int(value)*1000)
 
 def sharpnessScale(value):
-        camera.sharpness = int(value)
+        cameraSetting('sharpness', int(value))
 # Preset values for white balance of the camera. Each observation mode has
-# its own gains.
+# its own gains, listed in presets.json (see camerasettings.py); a preset may
+# also set the exposure time and ISO of its channel.
 # Do not change unless it is necessary. You can use a scale bar (commented
 # down in the script) to tune these gains.
+AWB_MODES = ["auto", "sunlight", "cloudy", "shade", "tungsten", "fluorescent", "incandescent", "flash", "horizon", "off"]
 
 def awb_modes(value):
-        if value == "Red EmF":
-                camera.awb_mode= 'off'
-                camera.awb_gains = (1.1,1.1)
-        if value == "Green EmF":
-                camera.awb_mode= 'off'
-                camera.awb_gains = (1.2,1.2)
-        if value == "B Field":
-                camera.awb_mode= 'off'
-                camera.awb_gains = (1.5,1.2)
-        elif value != "Red EmF" and value != "Green EmF" and value != "B Field":
-                camera.awb_mode = value
+        if cameraSettings is None:
+                return
+        if value in cameraSettings.presets:
+                values = cameraSettings.preset(value)
+                if 'shutter_speed' in values:
+                        sExpT.set(int(round(values['shutter_speed'] / 1000.0)))
+                if 'iso' in values:
+                        var5.set(str(values['iso']) if values['iso'] else "auto")
+        else:
+                cameraSettings.set('awb_mode', value)
 
 
 # This function is used to tune the gains of the white balance for different
@@ -217,20 +477,32 @@ def awb_modes(value):
 # This function helps to select an exposure mode similar to the ones you can
 # use in a digital camera.
 def exposure_modes(value):
-        camera.exposure_mode= value
+        cameraSetting('exposure_mode', value)
 
         
 # This function helps to select an effect similar to the ones you can use in a digital camera.        
 def effects(value):
-        camera.image_effect = value
+        cameraSetting('image_effect', value)
 
 
 # This function helps you to manually modify the ISO sensibility.   
 def isocam(value):
+        cameraSetting('iso', isoValue(value))
+
+def isoValue(value):
         if value == "auto":
-                camera.iso = 0
-        else:
-                camera.iso = int(value)
+                return 0
+        return int(value)
+
+# Sets all the desired settings from the controls, before a capture or the
+# preview. The scales and the ISO win over the values of the AWB preset, they
+# were set from it when it was chosen.
+def settingsFromControls():
+        values = dict(cameraSettings.presets.get(var1.get(), {'awb_mode': var1.get()}))
+        values.update(brightness = sBright.get(), contrast = sContrs.get(),
+                      saturation = sSat.get(), shutter_speed = int(sExpT.get())*1000,
+                      iso = isoValue(var5.get()))
+        cameraSettings.update(**values)
 
 
 # This function helps you to manually rotate the image.  
@@ -260,25 +532,48 @@ def vflip():
 
 # This function defines parameters for the live preview of the camera. It
 # allows you to observe the samples in real time.
+# With "In canvas" checked, the preview is drawn in the capture canvas from
+# small video port frames (see livepreview.py), and each frame is scored for
+# focus (see focus.py): the bar under the canvas shows the score and a mark at
+# the best focus seen since the preview started (click it to forget the
+# peak). Otherwise the GPU overlay is shown on top of the window.
+livePreview = None
+focusTracker = None
+
 def previewCamera():
     global previewstatus
+    global livePreview
     global var1
     global var5
 
 # First, the script verifies the status of the button. Then, sets the
-# configuration of the live preview.
-    if previewstatus == 0:
+# configuration of the live preview. The settings of the controls are written
+# by the settings thread, not here: a capture may be holding the camera.
+    if previewstatus == 0 and canvasPreview.get():
+        previewstatus = 2
+        previewbtn_text.set("Preview Off")
+        settingsFromControls()
+        focusTracker.reset()
+        livePreview = VideoPortPreview(camera, capturePipeline.cameraLock, (510,384),
+                                       onFrame = focusTracker.update)
+        livePreview.start()
+        pollPreview()
+
+    elif previewstatus == 2:
+        livePreview.stop()
+        livePreview = None
+        previewlabel.config(text="   Capture Preview   ")
+        previewbtn_text.set("Preview On")
+        previewstatus = 0
+
+    elif previewstatus == 0:
         previewstatus = 1
         previewbtn_text.set("Preview Off")
         camera.resolution = (3280,2464)
         camera.preview_fullscreen = False
         camera.preview_window = (700, 200, 510, 384)
         camera.video_stabilization = TruLEDstatus = True
-        camera.brightness=sBright.get()
-        camera.contrast=sContrs.get()
-        camera.saturation=sSat.get()
-        awb_modes(var1.get())
-        isocam(var5.get())
+        settingsFromControls()
         camera.start_preview()
         
     else:
@@ -286,60 +581,282 @@ def previewCamera():
         previewbtn_text.set("Preview On")
         previewstatus = 0
 
+
+# Draws the newest live preview frame on the canvas and shows the measured
+# frame rate and latency under it. Runs on the Tk main loop while the
+# in-canvas preview is on.
+def pollPreview(preview = None):
+    if preview is None:
+        preview = livePreview
+    if preview is not livePreview:
+        return
+    frame = preview.poll()
+    if frame is not None:
+        with tracer.span('preview photoimage'):
+            img2 = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            imgtk = ImageTk.PhotoImage(image = Image.fromarray(img2))
+            canvas.itemconfig(img_canvas,imag = imgtk)
+            canvas.imgtk = imgtk
+        preview.displayed()
+        previewlabel.config(text="   Live Preview  " + preview.status() + "   ")
+        drawFocus()
+    if preview.error is not None:
+        print "Live preview stopped:", preview.error
+        return
+    root.after(15, pollPreview, preview)
+
+
+# Draws the focus score as a bar, scaled so the peak sits at 80% of the width.
+def drawFocus():
+    score, peak = focusTracker.values()
+    if score is None:
+        return
+    width = int(focusCanvas['width'])
+    scale = 0.8 * width / peak if peak > 0 else 0
+    focusCanvas.coords(focusBar, 0, 0, score * scale, 16)
+    focusCanvas.coords(focusPeak, peak * scale, 0, peak * scale, 16)
+    focusCanvas.itemconfig(focusText, text = focusTracker.status())
+
+def resetFocusPeak(event = None):
+    if focusTracker is not None:
+        focusTracker.reset()
+
         
 # This function defines the the paramters to capture and image. The parameters
 # can be changed with the respetive scale bars or the exposure mode.
 # Images are automatically stored in TIFF format.
+# The capture itself runs in the capture pipeline: the settings are read here
+# and those that changed are written to the camera by the capture thread, the
+# preview is shown by pollCaptureEvents() and the TIFF file is written in the
+# background.
 
+@tracer.traced('still')
 def still():
-    global img
-    global imgaux
     global captureCount
     global var1
     global var5
-    camera.shutter_speed = int(sExpT.get())* 1000
-    camera.brightness=sBright.get()
-    camera.contrast=sContrs.get()
-    camera.saturation=sSat.get()
-    isocam(var5.get())
-    awb_modes(var1.get())
-    camera.resolution = (3280,2464)
-    # Storing capture on a matrix in order to be used with OpenCV.
-    img = picamera.array.PiRGBArray(camera, size = (3280,2464))
-    camera.capture(img, 'bgr', resize = (3280,2464))
-    # Storing an auxiliar image to be used as display on Canvas.
-    imgaux = img.array
-    res = cv2.resize(imgaux, (510,384))
-    img2 = cv2.cvtColor(res, cv2.COLOR_BGR2RGB)
-    img2FromArray = Image.fromarray(img2)
-    imgtk = ImageTk.PhotoImage(image =img2FromArray)
-    canvas.itemconfig(img_canvas,imag = imgtk)
-    canvas.imgtk = imgtk
+    settingsFromControls()
+    shutter = int(sExpT.get())* 1000
+    channel = litChannel()
+    correct = flatField.get()
+    # Runs on the capture thread: corrects the frame and keeps it as the
+    # latest one of its channel for the composite.
+    def process(job, image):
+        if channel is None:
+            return image
+        if correct:
+            image = calibration.correct(image, channel, shutter, out = image)
+        composite.setFrame(channel, image, job.bits)
+        return image
+    def prepare():
+        cameraSettings.apply()
     # Automatic Storage in TIFF format.
-    captureCount += 1
-    strc = str(captureCount)
+    strc = str(captureCount + 1)
     extStr = ".tiff"
-    cv2.imwrite('image' + strc + extStr, imgaux)
+    metadata = {'channel': channel, 'led': channelPin(channel)}
+    if rawMode.get():
+        job = capturePipeline.submit(captureCount + 1, 'image' + strc + '-raw' + extStr, prepare,
+                                     capture = rawCapture.captureInto, process = process, metadata = metadata)
+    else:
+        job = capturePipeline.submit(captureCount + 1, 'image' + strc + extStr, prepare,
+                                     process = process, metadata = metadata)
+    if job is None:
+        print "Capture refused, still writing previous images to disk"
+        return
+    captureCount += 1
+
+
+# Captures a burst of video port frames (number set with the "Stack frames"
+# scale) with the current settings and saves their mean as a 16-bit TIFF,
+# image<N>-stack.tiff. Useful for fluorescence, where several short
+# exposures give less noise than a single long one; the SNR report printed
+# after each stack helps to choose. The stacker (~158 MB of buffers at
+# 1640x1232) is only allocated the first time it is used.
+burstStacker = None
+
+def stack():
+    global captureCount
+    global burstStacker
+    frames = int(stackN.get())
+    if burstStacker is None:
+        burstStacker = BurstStacker(camera, method = 'sigma')
+    def capture(job):
+        image = burstStacker.captureInto(job, frames)
+        print job.stackReport
+        return image
+    strc = str(captureCount + 1)
+    channel = litChannel()
+    job = capturePipeline.submit(captureCount + 1, 'image' + strc + '-stack.tiff', capture = capture,
+                                 resolution = burstStacker.resolution,
+                                 metadata = {'channel': channel, 'led': channelPin(channel)})
+    if job is None:
+        print "Capture refused, still writing previous images to disk"
+        return
+    captureCount += 1
+
+
+# Finds the exposure time for the channel currently lit from small video port
+# frames (see autoexposure.py) and puts it on the exposure time scale, so the
+# next still is taken with it. Set the ISO (and the LED) of the channel first.
+def autoExposure():
+    def run():
+        try:
+            with capturePipeline.cameraLock:
+                result = AutoExposure(camera).run()
+            # The scale is set to the result by pollCaptureEvents().
+            cameraSettings.invalidate('shutter_speed')
+        except Exception as e:
+            result = e
+        captureEvents.put(('exposure', None, result))
+    autoExposureButton.config(state = DISABLED)
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+
+# Delivers the results of the capture pipeline to the GUI. Runs periodically on
+# the Tk main loop, the only thread allowed to touch the widgets.
+def pollCaptureEvents():
+    global captureCount
+    global imgaux
+    global imgLease
+    global imgBits
+    while True:
+        try:
+            kind, job, buffers = captureEvents.get_nowait()
+        except Queue.Empty:
+            break
+        if kind == 'ready':
+            hardwareReady(buffers)
+        elif kind == 'timelapse':
+            TLButton.config(state = NORMAL)
+            stopTLButton.config(state = DISABLED)
+            if buffers is not None:
+                print "Time lapse failed:", buffers
+                readyLabel.config(text = "Time lapse failed: %s" % buffers, fg = "red")
+            else:
+                readyLabel.config(text = "Ready", fg = "dark green")
+        elif kind == 'multichannel':
+            if isinstance(buffers, Exception):
+                print "Multichannel capture failed:", buffers
+                readyLabel.config(text = "Multichannel capture failed: %s" % buffers, fg = "red")
+            else:
+                captureCount += 1
+                buffers.put(captureCount)
+        elif kind == 'exposure':
+            autoExposureButton.config(state = NORMAL)
+            if isinstance(buffers, Exception):
+                print "Auto exposure failed:", buffers
+            else:
+                print buffers
+                sExpT.set(int(round(buffers.shutter_speed / 1000.0)))
+        elif kind == 'thumbnail':
+            frameBuffer, thumbnailBuffer = buffers
+            # Storing an auxiliar image to be used as display on Canvas. The
+            # buffer of the previous one goes back to the pool.
+            if imgLease is not None:
+                imgLease.release()
+            imgLease = frameBuffer
+            imgaux = frameBuffer.array
+            imgBits = job.bits
+            with tracer.span('photoimage'):
+                img2FromArray = Image.fromarray(thumbnailBuffer.array)
+                imgtk = ImageTk.PhotoImage(image =img2FromArray)
+                thumbnailBuffer.release()
+                canvas.itemconfig(img_canvas,imag = imgtk)
+                canvas.imgtk = imgtk
+        elif job.error is not None:
+            print "Capture", job.fileName, "failed:", job.error
+        else:
+            print "Saved", job.written, "(RSS %d MB, peak %d MB)" % (job.memory[0] >> 20, job.memory[1] >> 20)
+    root.after(50, pollCaptureEvents)
+
+
+# Shows the state of the SD card under the Quit button. The queue is the one
+# of the time lapse while it runs, else the one of the capture pipeline.
+STORAGE_COLOURS = {'ok': "dark green", 'warn': "dark orange", 'compress': "dark orange",
+                   'reduce': "red", 'pause': "red"}
+
+def pollStorage():
+        # The pipeline is the last of the two made by loadHardware().
+        if capturePipeline is not None:
+                if thread1 is not None and thread1.is_alive():
+                        storageMonitor.setQueue(thread1.encodeQueue.qsize(), thread1.encodeQueue.maxsize)
+                else:
+                        queue = capturePipeline.writeQueue
+                        storageMonitor.setQueue(queue.qsize(), queue.maxsize)
+                status = storageMonitor.status()
+                storageLabel.config(text = str(status), fg = STORAGE_COLOURS[status.level])
+        root.after(2000, pollStorage)
+
+
+# Percentiles of the timing spans drawn over the capture canvas, refreshed
+# every second while "Show overlay" is checked in the Timing menu.
+timingOverlay = None
+
+def pollTiming():
+        global timingOverlay
+        if not showTiming.get():
+                if timingOverlay is not None:
+                        canvas.delete(timingOverlay)
+                        timingOverlay = None
+                return
+        if timingOverlay is None:
+                timingOverlay = canvas.create_text(4, 4, anchor = NW, fill = "yellow", font = ("Courier", 8))
+        canvas.itemconfig(timingOverlay, text = tracer.summary())
+        canvas.tag_raise(timingOverlay)
+        root.after(1000, pollTiming)
+
+def toggleTimingOverlay():
+        # A running poll keeps the overlay, only start one if there is none.
+        if showTiming.get() and timingOverlay is None:
+                pollTiming()
+
+def enableTiming():
+        tracer.enable(bool(recordTiming.get()))
+
+# Saves the spans in the buffer as CSV or as a Chrome trace (open it in
+# chrome://tracing or ui.perfetto.dev).
+def exportTiming(kind):
+        if kind == 'csv':
+                fileName = tkFileDialog.asksaveasfilename(defaultextension = ".csv",
+                                                          initialfile = time.strftime("timing-%Y%m%d-%H%M%S.csv"))
+        else:
+                fileName = tkFileDialog.asksaveasfilename(defaultextension = ".json",
+                                                          initialfile = time.strftime("trace-%Y%m%d-%H%M%S.json"))
+        if not fileName:
+                return
+        if kind == 'csv':
+                tracer.writeCsv(fileName)
+        else:
+                tracer.writeChromeTrace(fileName)
+        print "Timing spans saved to", fileName
+        print tracer.summary()
 
 
 # The next 3 functions help to perform a gamma correction of the most recently
 # taken image.
 # The preview of the gamma corrected image is shown in an alternate window.
+# While the slider moves only a preview-sized copy of the image is corrected
+# (see tonemap.py); the full resolution image is corrected when exported.
+
+gamma = 2.4
+toneMapper = None
+# Buffer of the image held by toneMapper; a pooled buffer is only reused
+# once released, so it also identifies the capture the window refers to.
+toneMapperLease = None
 
 def gamma_value(value):
         global gamma
         gamma = float(value)
 
 def gamma_correction(imgGammaAux, value):
-        table = np.array([((i / 255.0) ** value) * 255
-        for i in np.arange(0, 256)]).astype("uint8")
-        # Build a table mapping the pixel values [0, 255] to their adjusted
-        # gamma values.
-        return cv2.LUT(imgGammaAux, table)
-        # Apply gamma correction using the lookup table.
+        # The lookup tables are cached per gamma value in tonemap.py.
+        return gammaCorrection(imgGammaAux, value)
 
 def gammaPreview():
-        global gammaImg
+        global toneMapper
+        global toneMapperLease
         gammaWindow = Toplevel()
         ws = gammaWindow.winfo_screenwidth()
         hs = gammaWindow.winfo_screenheight()
@@ -360,12 +877,25 @@ def gammaPreview():
         gframe2.grid(row=1, column=2, sticky=W+E+N+S)
         gammalabel = Label(gframe2, text="Gamma Correction")
         gammalabel.grid(row=1, column=0)
-        setGamma = Scale(gframe2, from_=0, to=3, resolution = 0.5,orient=HORIZONTAL, command = gamma_value)
+        # Applies the slider value to the preview copy of the image.
+        def updateGamma(value):
+                gamma_value(value)
+                if toneMapper is None:
+                        return
+                res = toneMapper.preview(gamma)
+                gammaImg2 = cv2.cvtColor(res, cv2.COLOR_BGR2RGB)
+                img2FromArrayG = Image.fromarray(gammaImg2)
+                imgtk2 = ImageTk.PhotoImage(image =img2FromArrayG)
+                canvas2.itemconfig(img_canvas2,imag = imgtk2)
+                canvas2.imgtk2 = imgtk2
+
+        setGamma = Scale(gframe2, from_=0, to=3, resolution = 0.1,orient=HORIZONTAL, command = updateGamma)
         setGamma.grid(row=1, column=1)
         
+        global var8g
         var8g = StringVar(gammaWindow)
         var8g.set("TIFF") # initial value
-        optionExp = OptionMenu(gframe2, var8g, 'TIFF', 'JPEG', 'PNG', 'BMP', 'DATA')
+        optionExp = OptionMenu(gframe2, var8g, *EXPORT_FORMATS.keys())
         optionExp.grid(row =1, column = 3)
         var8label = Label(gframe2, text="File Options")
         var8label.grid(row=1, column=2)
@@ -376,13 +906,14 @@ def gammaPreview():
         exportbtn.grid(row=1, column=4)
 
         try:
-                gammaImg = gamma_correction(imgaux,2.4)
-                res = cv2.resize(gammaImg, (510,384))
-                gammaImg2 = cv2.cvtColor(res, cv2.COLOR_BGR2RGB)
-                img2FromArrayG = Image.fromarray(gammaImg2)
-                imgtk2 = ImageTk.PhotoImage(image =img2FromArrayG)
-                canvas2.itemconfig(img_canvas2,imag = imgtk2)
-                canvas2.imgtk2 = imgtk2
+                # The preview copy is made once per captured image.
+                if toneMapper is None or toneMapperLease is not imgLease:
+                        toneMapper = ToneMapper(imgaux, (510,384), bits = imgBits)
+                        if toneMapperLease is not None:
+                                toneMapperLease.release()
+                        toneMapperLease = imgLease.retain()
+                setGamma.set(gamma)
+                updateGamma(gamma)
 
         except:
                 messagebox.showerror("Error", "Image has not been taken, please take an image.")
@@ -391,7 +922,128 @@ def gammaPreview():
         gammaWindow.mainloop()
 
                
+# Full resolution capture used by the multichannel sequencer once a channel
+# has settled. The sequencer already holds the camera lock. Returns the
+# pooled buffer, whoever stores the image releases it.
+def sequenceCapture(channel, timepoint):
+    buf = framePool.acquire()
+    try:
+        camera.capture(buf.raw, 'bgr')
+    except:
+        buf.release()
+        raise
+    return buf
+
+# Captures one image of every channel in CHANNELS. The sequence runs on its own
+# thread and the images are saved through the capture pipeline as
+# image<N>-<channel>.tiff. The number N is taken by pollCaptureEvents() once
+# every channel has been captured, so a failed sequence uses none.
+def multichannel():
+    correct = flatField.get()
+    def run():
+        try:
+            timelapsePrepare()
+            results = sequencer.runTimepoint(CHANNELS)
+        except Exception as e:
+            captureEvents.put(('multichannel', None, e))
+            return
+        finally:
+            # Back to the settings of the controls.
+            cameraSettings.restore()
+        numbers = Queue.Queue()
+        captureEvents.put(('multichannel', None, numbers))
+        number = numbers.get()
+        for channel, buf, t in results:
+            if correct:
+                calibration.correct(buf.array, channel.name, channel.shutter_speed, out = buf.array)
+            composite.setFrame(channel.name, buf.array)
+            capturePipeline.submitFrame(number, 'image%d-%s.tiff' % (number, channel.name), buf.array,
+                                        block = True, buffer = buf,
+                                        metadata = {'channel': channel.name, 'led': channel.pin, 'state': t['state']})
+        print timingReport(results)
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+
+# Name of the channel whose LED is on, None when they are all off.
+def litChannel():
+    for channel in CHANNELS:
+        if GPIO.input(channel.pin):
+            return channel.name
+    return None
+
+# LED pin of a channel, by name.
+def channelPin(name):
+    for channel in CHANNELS:
+        if channel.name == name:
+            return channel.pin
+    return None
+
+# Records the dark frame ("dark", LEDs off) or the flat field ("flat", blank
+# slide with the LED on) of the channel whose LED is on, at the exposure time
+# of the scale, from CALIBRATION_FRAMES full resolution frames. Record the dark
+# first, the flat field is corrected with it.
+def recordCalibration(kind):
+    if calibration is None:
+        print "The camera is not ready yet"
+        return
+    channel = litChannel()
+    if channel is None:
+        messagebox.showerror("Calibration", "Turn on the LED of the channel to calibrate first.")
+        return
+    exposure = int(sExpT.get())*1000
+    if kind == 'flat':
+        question = "Put a blank slide under the objective and make sure nothing is clipped. Record the %s flat field?" % channel
+    else:
+        question = "The LED will be turned off while the frames are taken. Record the %s dark frame?" % channel
+    if not messagebox.askokcancel("Calibration", question):
+        return
+    def run():
+        buf = framePool.acquire()
+        try:
+            with capturePipeline.cameraLock:
+                if camera.resolution != (3280,2464):
+                    camera.resolution = (3280,2464)
+                cameraSettings.set('shutter_speed', exposure)
+                cameraSettings.apply()
+                lit = [p for p in (pin, pin2, pin3, pin4) if GPIO.input(p)]
+                if kind == 'dark':
+                    for p in lit:
+                        GPIO.output(p, GPIO.LOW)
+                def frames():
+                    for i in range(CALIBRATION_FRAMES):
+                        camera.capture(buf.raw, 'bgr')
+                        yield buf.array
+                try:
+                    fileName = calibration.record(kind, channel, exposure, frames())
+                finally:
+                    for p in lit:
+                        GPIO.output(p, GPIO.HIGH)
+            print "Calibration saved to", fileName
+        except Exception as e:
+            print "Calibration failed:", e
+        finally:
+            buf.release()
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+
+# Shows the time taken by the writes of each camera setting.
+def settingsLatency():
+    if cameraSettings is None:
+        print "The camera is not ready yet"
+        return
+    report = cameraSettings.report()
+    print report
+    messagebox.showinfo("Camera settings", report)
+
+
 # The next 4 functions define the control of the switching on/off for the LEDs.
+# They only set the camera settings: the settings thread writes them, as the
+# Tk thread must never wait for the camera lock held during captures.
+@tracer.traced('led BrFld')
 def led():
     if GPIO.input(pin):
         GPIO.output(pin,GPIO.LOW)
@@ -399,7 +1051,7 @@ def led():
         print "LED off"
 
     else:
-        camera.framerate = 30
+        cameraSettings.set('framerate', 30)
         GPIO.output(pin,GPIO.HIGH)
         GPIO.output(pin2,GPIO.LOW)
         GPIO.output(pin3,GPIO.LOW)
@@ -422,6 +1074,7 @@ def led():
         exposure_modes(var3.get())
         print "WhiteLED on"
 
+@tracer.traced('led Green')
 def GREENFluorled():
     if GPIO.input(pin2):
         GPIO.output(pin2,GPIO.LOW)
@@ -432,7 +1085,7 @@ def GREENFluorled():
 ##        var5.set("200")
         isocam(var5.get())
         time.sleep(3)
-        camera.framerate = 1
+        cameraSettings.set('framerate', 1)
         GPIO.output(pin2,GPIO.HIGH)
         GPIO.output(pin,GPIO.LOW) 
         GPIO.output(pin3,GPIO.LOW)
@@ -453,19 +1106,19 @@ def GREENFluorled():
 ##        awb_modes(var1.get())
 ##        exposure_modes(var3.get())
 
+@tracer.traced('led Blue')
 def BLUEFluorled():
     if GPIO.input(pin3):
         GPIO.output(pin3,GPIO.LOW)
         bfluorledbtn_text.set("  UVL OFF  ")
         print "LED off"
-        camera.awb_mode = "off"
-        camera.awb_gains = (1.2, 1.2)
+        cameraSettings.update(awb_mode = "off", awb_gains = (1.2, 1.2))
 
     else:
 ##        var5.set("200")
         isocam(var5.get())
         time.sleep(3)
-        camera.framerate = 1
+        cameraSettings.set('framerate', 1)
         GPIO.output(pin3,GPIO.HIGH)
         GPIO.output(pin,GPIO.LOW) 
         GPIO.output(pin2,GPIO.LOW)
@@ -487,6 +1140,7 @@ def BLUEFluorled():
 ##        awb_modes(var1.get())
         
 
+@tracer.traced('led Red')
 def REDFluorled():
     global var1
     
@@ -502,7 +1156,7 @@ def REDFluorled():
         time.sleep(3)
         var3.set("off")
         exposure_modes(var3.get())
-        camera.framerate = 1
+        cameraSettings.set('framerate', 1)
         GPIO.output(pin4,GPIO.HIGH)
         GPIO.output(pin,GPIO.LOW) 
         GPIO.output(pin2,GPIO.LOW)
@@ -524,11 +1178,29 @@ def REDFluorled():
 
 #The next 2 functions define the start and the stop of the time lapse captures.
 #You can change the delay time with the respctive scale bar, which is in minutes.
+#The delay is the time between the start of two consecutive captures.
 def startLapse():
         try:
                 timelapse = yy.get()*60
                 global thread1
-                thread1 = imageSequenceThread(timelapse)
+                fileName = uniqueFileName(time.strftime("timelapse-%Y-%m-%d-%H%M%S"), ".ome.tiff")
+                correct = bool(flatField.get())
+                if allChannels.get():
+                        writer = StackWriter(fileName, [channel.name for channel in CHANNELS],
+                                             exporter = exporter, interval = timelapse)
+                        # Four full resolution frames per timepoint, keep only
+                        # one timepoint waiting for the encoder.
+                        thread1 = TimelapseScheduler(timelapse, timelapseCaptureChannels,
+                                                     lambda frame, data: timelapseWriteChannels(writer, frame, data, correct),
+                                                     prepare = timelapsePrepare, onFrame = timelapseReport, queueDepth = 1,
+                                                     onFinish = lambda: timelapseFinish(writer), hold = timelapseHold)
+                else:
+                        writer = StackWriter(fileName, ["BrFld"], exporter = exporter, interval = timelapse)
+                        thread1 = TimelapseScheduler(timelapse, timelapseCapture,
+                                                     lambda frame, data: timelapseWrite(writer, frame, data, correct),
+                                                     prepare = timelapsePrepare, onFrame = timelapseReport,
+                                                     onFinish = lambda: timelapseFinish(writer), hold = timelapseHold)
+                storageMonitor.reset(timelapse)
                 thread1.start()
                 TLButton.config(state = DISABLED)
                 stopTLButton.config(state = NORMAL)
@@ -540,14 +1212,15 @@ def startLapse():
 def stopLapse():
         try:
                 if thread1.isAlive():
-                        thread1._stop.set()
+                        thread1.stop()
                         TLButton.config(state = NORMAL)
                         stopTLButton.config(state = DISABLED)
-                        GPIO.output(pin, GPIO.LOW)
                         print "Stopping image sequence"
-                        print "Please wait until the last cycle finishes..."
+                        GPIO.output(pin, GPIO.LOW)
+                        print "The images still in the encoder queue will be written..."
                 messagebox.showwarning("Wait", "Image Sequence Stopped")
                 print "Image timelapse sequence: stopped"
+                print "Image timelapse sequence:", thread1.stats.summary()
         except:
                 print "Can't stop image timelapse sequence!!"
                 GPIO.output(pin, GPIO.LOW)
@@ -562,53 +1235,320 @@ def filenames():
 
 		
 # The next 2 functions help to export the images in different formats, for both
-# the original imagen and the gamma corrected one.
+# the original imagen and the gamma corrected one. The formats, their
+# compression and levels are listed in EXPORT_FORMATS (see export.py); the
+# time taken and the compression ratio are printed after every export.
 def export_image():
         global imgaux
         global captureCount
         
         captureCount += 1
         strc = str(captureCount)
-        if var8.get() == "PNG":
-                extStr = ".png"
-        if var8.get() == "JPEG":
-                extStr = ".jpeg"
-        if var8.get() == "TIFF":
-                extStr = ".tiff"
-        if var8.get() == "DATA":
-                extStr = ".data"
-        if var8.get() == "BMP":
-                extStr = ".bmp"
-
-        cv2.imwrite('image' + strc + extStr, imgaux)
+        extStr = EXPORT_FORMATS[var8.get()].extension
+
+        print exporter.write(imgaux, 'image' + strc + extStr, var8.get())
 
 def export_image_corrected():
-        global gammaImg
         global captureCount
         strc = str(captureCount)
-        if var8.get() == "PNG":
-                extStr = ".png"
-        if var8.get() == "JPEG":
-                extStr = ".jpeg"
-        if var8.get() == "TIFF":
-                extStr = ".tiff"
-        if var8.get() == "DATA":
-                extStr = ".data"
-        if var8.get() == "BMP":
-                extStr = ".bmp"
+        extStr = EXPORT_FORMATS[var8g.get()].extension
 
-        cv2.imwrite('gc-image' + strc + extStr, gammaImg)
+        # The corrected image is written from a pooled buffer, so exporting
+        # does not keep another full resolution image alive.
+        buf = framePool.acquire()
+        try:
+                print exporter.write(toneMapper.export(gamma, out = buf.array), 'gc-image' + strc + extStr, var8g.get())
+        finally:
+                buf.release()
+
+
+# Window with the false colour composite of the latest frame of every channel.
+# Each channel has a check box to show it and its low and high contrast
+# limits; moving them only blends the preview sized planes again. The export
+# button blends the full resolution planes and writes composite<N> in the
+# format of the main window.
+def compositeView():
+        if not composite.names():
+                messagebox.showerror("Error", "No channel has been captured yet, take a multichannel sequence or a still with an LED on.")
+                return
+        compositeWindow = Toplevel()
+        compositeWindow.title("Composite")
+        canvas3 = Canvas(compositeWindow, width=510, height=384)
+        img_canvas3 = canvas3.create_image(0, 0, anchor = NW)
+        canvas3.grid(row=0, column=0, columnspan = 4)
+
+        def redraw(*args):
+                rgb = cv2.cvtColor(composite.preview(), cv2.COLOR_BGR2RGB)
+                imgtk3 = ImageTk.PhotoImage(image = Image.fromarray(rgb))
+                canvas3.itemconfig(img_canvas3, image = imgtk3)
+                canvas3.imgtk3 = imgtk3
+
+        controls = {}
+        def limitsChanged(name):
+                visible, low, high = controls[name]
+                composite.setVisible(name, visible.get())
+                composite.setLimits(name, low.get(), high.get())
+                redraw()
+
+        # Puts the scales back on the limits chosen for a new frame.
+        def showLimits():
+                for name, (visible, low, high) in controls.items():
+                        lo, hi = composite.limits(name)
+                        low.set(lo)
+                        high.set(hi)
+
+        for row, name in enumerate(composite.names()):
+                visible = IntVar(compositeWindow, value = 1)
+                Checkbutton(compositeWindow, text = name, variable = visible,
+                            command = lambda name = name: limitsChanged(name)).grid(row = row + 1, column = 0, sticky = W)
+                low = Scale(compositeWindow, from_ = 0, to = 255, orient = HORIZONTAL, label = "Low",
+                            command = lambda value, name = name: limitsChanged(name))
+                low.grid(row = row + 1, column = 1)
+                high = Scale(compositeWindow, from_ = 0, to = 255, orient = HORIZONTAL, label = "High",
+                             command = lambda value, name = name: limitsChanged(name))
+                high.grid(row = row + 1, column = 2)
+                controls[name] = (visible, low, high)
+        showLimits()
+
+        def export():
+                image = composite.render()
+                fileName = 'composite' + str(captureCount) + EXPORT_FORMATS[var8.get()].extension
+                print exporter.write(image, fileName, var8.get())
+        Button(compositeWindow, text = "Export composite", command = export).grid(row = 1, column = 3)
+
+        # New frames arrive from the capture threads.
+        shown = [composite.version]
+        def poll():
+                if not compositeWindow.winfo_exists():
+                        return
+                if composite.version != shown[0] and set(composite.names()) == set(controls):
+                        shown[0] = composite.version
+                        showLimits()
+                        redraw()
+                compositeWindow.after(200, poll)
+        redraw()
+        poll()
+
+
+# Zoom and pan on the most recently taken image (or the one given, e.g. from
+# the gallery) at full resolution.
+# The image is reduced to 1/2, 1/4 and 1/8 once and every level cut in tiles
+# (see pyramid.py); only the tiles on the canvas are scaled and converted,
+# and the last ones shown are kept in an LRU cache, so dragging over what
+# was already seen only moves canvas items. Drag to pan, wheel to zoom,
+# double click to fit the whole image.
+ZOOM_VIEW_SIZE = (800, 600)
+ZOOM_TILE_CACHE = 256
+imagePyramid = None
+# Buffer of the image held by imagePyramid, as toneMapperLease.
+pyramidLease = None
+
+def zoomView(image = None, bits = 8, title = "Zoom"):
+        global imagePyramid
+        global pyramidLease
+        if image is not None:
+                pyramid = ImagePyramid(image, bits = bits)
+        elif imgLease is None:
+                messagebox.showerror("Error", "Image has not been taken, please take an image.")
+                return
+        else:
+                # The pyramid is built once per captured image.
+                if imagePyramid is None or pyramidLease is not imgLease:
+                        imagePyramid = ImagePyramid(imgaux, bits = imgBits)
+                        if pyramidLease is not None:
+                                pyramidLease.release()
+                        pyramidLease = imgLease.retain()
+                pyramid = imagePyramid
+        view = Viewport(pyramid, ZOOM_VIEW_SIZE)
+        tiles = LRUCache(ZOOM_TILE_CACHE)
+
+        zoomWindow = Toplevel()
+        zoomWindow.title(title)
+        canvas4 = Canvas(zoomWindow, width = ZOOM_VIEW_SIZE[0], height = ZOOM_VIEW_SIZE[1], bg = "black")
+        canvas4.grid(row=0, column=0)
+        zoomLabel = Label(zoomWindow, text = "")
+        zoomLabel.grid(row=1, column=0, sticky=W)
+
+        # Tiles are only scaled once per zoom, their size does not change
+        # while panning.
+        def loadTile(key):
+                level, tx, ty, w, h = key
+                tile = pyramid.tileImage(level, tx, ty)
+                interpolation = cv2.INTER_NEAREST if w > tile.shape[1] else cv2.INTER_AREA
+                tile = cv2.resize(tile, (w, h), interpolation = interpolation)
+                return ImageTk.PhotoImage(image = Image.fromarray(tile))
+
+        def redraw():
+                canvas4.delete('tile')
+                visible = view.visibleTiles()
+                for level, tx, ty, sx, sy, w, h in visible:
+                        imgtk4 = tiles.fetch((level, tx, ty, w, h), loadTile)
+                        canvas4.create_image(sx, sy, image = imgtk4, anchor = NW, tags = 'tile')
+                zoomLabel.config(text = "Zoom %d%%, level 1/%d, %d tiles (cache: %s)" % (
+                        round(view.zoom * 100), 2 ** visible[0][0], len(visible), tiles.stats()))
+
+        drag = [0, 0]
+        def startDrag(event):
+                drag[0], drag[1] = event.x, event.y
+        def moveDrag(event):
+                view.pan(event.x - drag[0], event.y - drag[1])
+                drag[0], drag[1] = event.x, event.y
+                redraw()
+        def wheel(event):
+                if event.num == 4 or event.delta > 0:
+                        view.zoomAt(1.25, event.x, event.y)
+                else:
+                        view.zoomAt(0.8, event.x, event.y)
+                redraw()
+        def fit(event):
+                view.fit()
+                redraw()
+
+        canvas4.bind('<ButtonPress-1>', startDrag)
+        canvas4.bind('<B1-Motion>', moveDrag)
+        canvas4.bind('<MouseWheel>', wheel)
+        canvas4.bind('<Button-4>', wheel)
+        canvas4.bind('<Button-5>', wheel)
+        canvas4.bind('<Double-Button-1>', fit)
+        redraw()
+
+
+# Browses the captures of the working directory (see gallery.py).
+# Only the thumbnails of the rows on screen are asked for; those not cached
+# yet are decoded by the worker threads of "thumbnails", which hand them
+# back through a queue polled here, and requests for rows scrolled past are
+# dropped. Clicking a thumbnail reads the full image on a thread and opens
+# it in the zoom viewer.
+GALLERY_COLUMNS = 5
+GALLERY_ROWS = 4
+
+def galleryView():
+        galleryWindow = Toplevel()
+        galleryWindow.title("Gallery")
+        arrived = Queue.Queue()
+        captures = []
+        first = [0]
+        # Capture key of every cell shown, to place thumbnails as they come.
+        shown = {}
+        cells = []
+        blank = PhotoImage(width = thumbnails.size[0], height = thumbnails.size[1])
+        cellFrame = Frame(galleryWindow)
+        cellFrame.grid(row=0, column=0)
+        for i in range(GALLERY_COLUMNS * GALLERY_ROWS):
+                cell = Button(cellFrame, image = blank, compound = TOP, width = thumbnails.size[0] + 8,
+                              font = ("TkDefaultFont", 8), command = lambda i = i: openCapture(i))
+                cell.grid(row = i // GALLERY_COLUMNS, column = i % GALLERY_COLUMNS)
+                cells.append(cell)
+        scroll = Scrollbar(galleryWindow, orient = VERTICAL)
+        scroll.grid(row=0, column=1, sticky=N+S)
+        statusLabel = Label(galleryWindow, text = "")
+        statusLabel.grid(row=1, column=0, sticky=W)
+
+        def rows():
+                return (len(captures) + GALLERY_COLUMNS - 1) // GALLERY_COLUMNS
+
+        def setThumbnail(cell, thumbnail):
+                imgtk5 = ImageTk.PhotoImage(image = Image.fromarray(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)))
+                cell.config(image = imgtk5)
+                cell.imgtk5 = imgtk5
+
+        def show():
+                thumbnails.cancel()
+                shown.clear()
+                for i, cell in enumerate(cells):
+                        index = first[0] * GALLERY_COLUMNS + i
+                        if index >= len(captures):
+                                cell.config(image = blank, text = "", state = DISABLED)
+                                continue
+                        capture = captures[index]
+                        shown[capture.key] = cell
+                        cell.config(image = blank, text = capture.name, state = NORMAL)
+                        thumbnail = thumbnails.request(capture, lambda capture, thumbnail: arrived.put(('thumbnail', capture, thumbnail)))
+                        if thumbnail is not None:
+                                setThumbnail(cell, thumbnail)
+                total = max(1, rows())
+                scroll.set(first[0] / float(total), min(1.0, (first[0] + GALLERY_ROWS) / float(total)))
+                statusLabel.config(text = "%d captures, thumbnails: %s" % (len(captures), thumbnails.stats()))
+
+        def scrollTo(row):
+                row = max(0, min(row, rows() - GALLERY_ROWS))
+                if row != first[0]:
+                        first[0] = row
+                        show()
+
+        def scrollCommand(action, amount, unit = None):
+                if action == 'moveto':
+                        scrollTo(int(round(float(amount) * rows())))
+                else:
+                        scrollTo(first[0] + int(amount) * (GALLERY_ROWS if unit == 'pages' else 1))
+        scroll.config(command = scrollCommand)
+
+        def wheel(event):
+                scrollTo(first[0] + (-1 if event.num == 4 or event.delta > 0 else 1))
+        galleryWindow.bind('<MouseWheel>', wheel)
+        galleryWindow.bind('<Button-4>', wheel)
+        galleryWindow.bind('<Button-5>', wheel)
+
+        def refresh():
+                captures[:] = listCaptures('.')
+                # Newest at the bottom, as they are listed.
+                first[0] = max(0, rows() - GALLERY_ROWS)
+                show()
+        Button(galleryWindow, text = "Refresh", command = refresh).grid(row=1, column=0, sticky=E)
+
+        def openCapture(i):
+                capture = captures[first[0] * GALLERY_COLUMNS + i]
+                def run():
+                        try:
+                                arrived.put(('image', capture, loadImage(capture)))
+                        except Exception as e:
+                                arrived.put(('image', capture, e))
+                thread = threading.Thread(target = run)
+                thread.daemon = True
+                thread.start()
+
+        def poll():
+                if not galleryWindow.winfo_exists():
+                        thumbnails.cancel()
+                        return
+                while True:
+                        try:
+                                kind, capture, result = arrived.get_nowait()
+                        except Queue.Empty:
+                                break
+                        if kind == 'thumbnail':
+                                if result is not None and capture.key in shown:
+                                        setThumbnail(shown[capture.key], result)
+                        elif isinstance(result, Exception):
+                                print "Could not open", capture.name + ":", result
+                        else:
+                                zoomView(result, imageBits(result), capture.name)
+                statusLabel.config(text = "%d captures, thumbnails: %s" % (len(captures), thumbnails.stats()))
+                galleryWindow.after(100, poll)
+        refresh()
+        poll()
 
 
 # This function helps to the correctly closing of the program, by turning off
 # the LEDs and camera.
 def on_closing():
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
-                GPIO.output(pin, GPIO.LOW)
-                GPIO.output(pin2, GPIO.LOW)
-                GPIO.output(pin3, GPIO.LOW)
-                GPIO.output(pin4, GPIO.LOW)
-                camera.close()
+                # The camera may still be starting (or have failed to).
+                if GPIO is not None:
+                        GPIO.output(pin, GPIO.LOW)
+                        GPIO.output(pin2, GPIO.LOW)
+                        GPIO.output(pin3, GPIO.LOW)
+                        GPIO.output(pin4, GPIO.LOW)
+                if livePreview is not None:
+                        livePreview.stop()
+                if capturePipeline is not None:
+                        capturePipeline.close()
+                if metadataIndex is not None:
+                        metadataIndex.close()
+                if exporter is not None:
+                        exporter.close()
+                if camera is not None:
+                        camera.close()
                 root.destroy()
                 
 def about_sw():
@@ -762,13 +1702,31 @@ root.title("The BioARTS Lab Mini-microscope")
 #Centering window on screen and declaring size of the window.
 centre_window(1030, 525) #-225,330. 800x480 para tablet
 #Let's make some menu bars
-camera.awb_mode
 #-----------------------------------Menu bar----------------------------------------------------#
 menubar = Menu(root)
 filemenu = Menu(menubar, tearoff = 0)
 filemenu.add_command(label = "Exit", command = on_closing)
 menubar.add_cascade(label = "File", menu = filemenu)
 
+calibrationmenu = Menu(menubar, tearoff = 0)
+calibrationmenu.add_command(label = "Record dark frame", command = lambda: recordCalibration('dark'))
+calibrationmenu.add_command(label = "Record flat field", command = lambda: recordCalibration('flat'))
+menubar.add_cascade(label = "Calibration", menu = calibrationmenu)
+
+cameramenu = Menu(menubar, tearoff = 0)
+cameramenu.add_command(label = "Settings latency", command = settingsLatency)
+menubar.add_cascade(label = "Camera", menu = cameramenu)
+
+recordTiming = IntVar(root, value = int(tracer.enabled))
+showTiming = IntVar(root, value = 0)
+timingmenu = Menu(menubar, tearoff = 0)
+timingmenu.add_checkbutton(label = "Record timings", variable = recordTiming, command = enableTiming)
+timingmenu.add_checkbutton(label = "Show overlay", variable = showTiming, command = toggleTimingOverlay)
+timingmenu.add_command(label = "Export CSV...", command = lambda: exportTiming('csv'))
+timingmenu.add_command(label = "Export Chrome trace...", command = lambda: exportTiming('trace'))
+timingmenu.add_command(label = "Clear", command = tracer.clear)
+menubar.add_cascade(label = "Timing", menu = timingmenu)
+
 helpmenu = Menu(menubar, tearoff = 0)
 helpmenu.add_command(label = "Instructions", command = instructions)
 helpmenu.add_command(label = "Troubleshooting", command = troubleshooting)
@@ -790,9 +1748,8 @@ cameraParameters.grid(row=0,column=0, sticky="n")
 space1 = Frame(root, width = 15, height = 350)
 space1.grid(row=0, column=1, sticky="n")
 
-img = Image.open('start.gif')
-img = img.resize((480/2, 594/2), Image.ANTIALIAS)
-img = ImageTk.PhotoImage(img)
+# Tk reads GIF files itself, PIL is not needed to show them.
+img = PhotoImage(file = 'start.gif').subsample(2)
 canvasframe = Frame(root, width = 510, height = 400)
 canvasframe.grid(row=0, column=2, sticky=W+E+N+S)
 canvas=Canvas(canvasframe, width=510, height=383)
@@ -802,12 +1759,20 @@ canvas.grid(row=0, column=0)
 previewlabel = Label(canvasframe, text="   Capture Preview   ")
 previewlabel.grid(row=1, column=0, columnspan = 5)
 
+focusCanvas = Canvas(canvasframe, width=510, height=16, bg="gray85", highlightthickness=0)
+focusBar = focusCanvas.create_rectangle(0, 0, 0, 16, fill="pale green", width=0)
+focusPeak = focusCanvas.create_line(0, 0, 0, 16, fill="red", width=2)
+focusText = focusCanvas.create_text(4, 8, text="Focus: -", anchor=W)
+focusCanvas.bind("<Button-1>", resetFocusPeak)
+focusCanvas.grid(row=2, column=0, columnspan = 5)
+
 paramlabel = Label(cameraParameters, text="   Camera Parameters   ")
 paramlabel.grid(row=0, column=0, columnspan = 2)
 
 var1 = StringVar(root)
 var1.set("auto") # initial value
-optionAWBModes = OptionMenu(cameraParameters, var1, "B Field","Red EmF", "Green EmF", "auto", "sunlight", "cloudy", "shade", "tungsten", "fluorescent", "incandescent", "flash", "horizon","off", command = awb_modes)
+# The presets of presets.json are added by hardwareReady().
+optionAWBModes = OptionMenu(cameraParameters, var1, *AWB_MODES, command = awb_modes)
 optionAWBModes.grid(row =1, column = 1)
 var1label = Label(cameraParameters, text="AWB")
 var1label.grid(row=1, column=0)
@@ -842,43 +1807,32 @@ var5label.grid(row=4, column=0)
 
 sBright = Scale(cameraParameters, from_=25, to=75, resolution=1, orient=HORIZONTAL, command = brightnessScale)
 sBright.grid(row=5, column=1)
-sBright.set(camera.brightness)
 ##print "Brightness", camera.brightness
 sBrightlabel = Label(cameraParameters, text="Brightness")
 sBrightlabel.grid(row=5, column=0)
-root.update()
 
 sContrs = Scale(cameraParameters, from_=-50, to=50, resolution=1, orient=HORIZONTAL, command = contrastScale)
 sContrs.grid(row=6, column=1)
-sContrs.set(camera.contrast)
 ##print "Contrast", camera.contrast
 sContrslabel = Label(cameraParameters, text="Contrast")
 sContrslabel.grid(row=6, column=0)
 
 sSat = Scale(cameraParameters, from_=-100, to=100, resolution=1, orient=HORIZONTAL, command = saturationScale)
 sSat.grid(row=7, column=1)
-sSat.set(camera.saturation)
 ##print "Saturation", camera.saturation
-root.update()
 sSatlabel= Label(cameraParameters, text="Saturation")
 sSatlabel.grid(row=7, column=0)
-root.update()
 
 sSharp = Scale(cameraParameters, from_=-100, to=100, resolution=10, orient=HORIZONTAL, command = sharpnessScale)
 sSharp.grid(row=8, column=1)
-sSharp.set(camera.sharpness)
-root.update()
 sSharplabel= Label(cameraParameters, text="Sharpness")
 sSharplabel.grid(row=8, column=0)
-root.update()
 
-sExpT = Scale(cameraParameters, from_=0, to=1000, resolution = 50,orient=HORIZONTAL,  command = exposureTimeScale)
+sExpT = Scale(cameraParameters, from_=0, to=1000, resolution = 1,orient=HORIZONTAL,  command = exposureTimeScale)
 sExpT.grid(row=9, column=1)
 ##print "Exposure Time ms", camera.shutter_speed
-root.update()
 sexpt= Label(cameraParameters, text="Exposure Time ms")
 sexpt.grid(row=9, column=0)
-root.update()
 
 yy = Scale(cameraParameters, from_=0, to=20, resolution=1, orient=HORIZONTAL)
 yy.grid(row=10, column=1)
@@ -889,6 +1843,12 @@ if timelapse == 0:
 yz = Label(cameraParameters, text="Timelapse delay min")
 yz.grid(row=10, column=0)
 
+stackN = Scale(cameraParameters, from_=2, to=64, resolution=1, orient=HORIZONTAL)
+stackN.grid(row=11, column=1)
+stackN.set(16)
+stackNlabel = Label(cameraParameters, text="Stack frames")
+stackNlabel.grid(row=11, column=0)
+
 #####################################################################################################
 ### Enable these scale bars to use with the code for the AWB gins modification.
 
@@ -953,6 +1913,24 @@ previewButton.grid(row=1, column=0)
 takeStillButton = Button(capOpt, text="   Take still  ", command=still)
 takeStillButton.grid(row=2,column=0)
 
+canvasPreview = IntVar()
+canvasPreviewCheck = Checkbutton(capOpt, text="In canvas", variable=canvasPreview)
+canvasPreviewCheck.grid(row=3, column=0)
+
+rawMode = IntVar()
+rawModeCheck = Checkbutton(capOpt, text="Raw 16-bit", variable=rawMode)
+rawModeCheck.grid(row=3, column=1)
+
+stackButton = Button(capOpt, text="   Take stack  ", command=stack)
+stackButton.grid(row=3, column=2)
+
+autoExposureButton = Button(capOpt, text=" Auto exposure ", command=autoExposure)
+autoExposureButton.grid(row=4, column=0)
+
+flatField = IntVar()
+flatFieldCheck = Checkbutton(capOpt, text="Flat-field", variable=flatField)
+flatFieldCheck.grid(row=4, column=1)
+
 TLbtn_text = StringVar()
 TLButton = Button(capOpt, textvariable=TLbtn_text, command=startLapse)
 TLbtn_text.set("Start Time Lapse")
@@ -964,6 +1942,13 @@ stopTLbtn_text.set("Stop Time Lapse")
 stopTLButton.config(state = DISABLED)
 stopTLButton.grid(row=2, column=1)
 
+allChannels = IntVar()
+allChannelsCheck = Checkbutton(capOpt, text="All channels", variable=allChannels)
+allChannelsCheck.grid(row=1, column=2)
+
+multichannelButton = Button(capOpt, text=" Multichannel ", command=multichannel)
+multichannelButton.grid(row=2, column=2)
+
 #-----------------------------------Image Processing----------------------------------------------
 IPFrame = Frame(root, width = 500, height = 400)
 IPFrame.grid(row=0, column=4, sticky=W+E+N+S)
@@ -978,7 +1963,8 @@ compresslabel.grid(row=11, column=0, columnspan = 3)
 
 var8 = StringVar(root)
 var8.set("TIFF") # initial value
-optionExp = OptionMenu(IPFrame, var8, 'TIFF', 'JPEG', 'PNG', 'BMP', 'DATA')
+# The formats come from export.py, loaded with the camera (see hardwareReady()).
+optionExp = OptionMenu(IPFrame, var8, "TIFF")
 optionExp.grid(row =12, column = 1)
 var8label = Label(IPFrame, text="File Options")
 var8label.grid(row=12, column=0)
@@ -993,6 +1979,15 @@ exportbtn = Button(IPFrame, textvariable=exportbtn_text, command=export_image)
 exportbtn_text.set("Export Image")
 exportbtn.grid(row=14, column=1)
 
+compositebtn = Button(IPFrame, text="Composite", command=compositeView)
+compositebtn.grid(row=15, column=1)
+
+zoombtn = Button(IPFrame, text="Zoom", command=zoomView)
+zoombtn.grid(row=16, column=1)
+
+gallerybtn = Button(IPFrame, text="Gallery", command=galleryView)
+gallerybtn.grid(row=17, column=1)
+
 #-----Quit Section---
 quitframe = Frame(root, width = 500, height = 150)
 quitframe.grid(row=1,column=4, sticky="n")
@@ -1002,12 +1997,35 @@ space3.grid(row=0, column=0, sticky="n")
 quitButton = Button(quitframe, bg="pink", text="       Quit      ", command=on_closing)
 quitButton.grid(row=1, rowspan = 2, column=1)
 
+# Shows "Starting..." until the camera is open and the controls are enabled.
+readyLabel = Label(quitframe, text = "Starting...", fg = "dark orange")
+readyLabel.grid(row=3, column=1)
+storageLabel = Label(quitframe, text = "", justify = LEFT, wraplength = 160, font = ("TkDefaultFont", 8))
+storageLabel.grid(row=4, column=1)
+
 #------App icon-----
-ico = Image.open('microscopeicon.gif')
-ico = ico.resize((480/2, 594/2), Image.ANTIALIAS)
-ico = ImageTk.PhotoImage(ico)
+ico = PhotoImage(file = 'microscopeicon.gif')
+
+# Controls that need the camera, the LEDs or the export engine, disabled until
+# loadHardware() is done.
+hardwareControls = [optionAWBModes, optionEffects, optionExpMode, ISOOption,
+                    sBright, sContrs, sSat, sSharp, sExpT,
+                    ledButton, gfluorledButton, bfluorledButton, rfluorledButton,
+                    previewButton, takeStillButton, stackButton, TLButton,
+                    multichannelButton, autoExposureButton, gammabtn, exportbtn, compositebtn,
+                    zoombtn, gallerybtn]
+for widget in hardwareControls:
+        widget.config(state = DISABLED)
 
 root.config(menu = menubar)
 root.tk.call('wm', 'iconphoto',root._w,ico)
 root.protocol("WM_DELETE_WINDOW", on_closing)
+# Paints the window before anything slow is loaded.
+root.update()
+startupTimer.mark('window')
+hardwareThread = threading.Thread(target = loadHardware, name = "startup")
+hardwareThread.daemon = True
+hardwareThread.start()
+root.after(50, pollCaptureEvents)
+root.after(2000, pollStorage)
 root.mainloop()
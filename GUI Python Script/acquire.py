@@ -0,0 +1,399 @@
+## ======== HEADLESS ACQUISITION ======== ##
+
+# Runs an acquisition protocol without the GUI, e.g. over SSH:
+#     python acquire.py protocol.json
+# The protocol is a JSON file describing the channels and the time lapse:
+#     {
+#         "name": "hela-gfp",
+#         "channels": ["BrFld",
+#                      {"name": "Green", "shutter_speed": 400000,
+#                       "iso": 200, "awb_gains": [1.2, 1.2]}],
+#         "interval": 60,
+#         "duration": 3600,
+#         "output": "stack"
+#     }
+# Channels given by name take the settings of DEFAULT_CHANNELS (see
+# sequencer.py); a channel given as an object may change any of them
+# ("led" is the LED of another channel or a GPIO pin). "duration" (seconds)
+# or "timepoints" sets the length of the run, without either it runs until
+# stopped. "output" is "stack" for a single OME-TIFF with every timepoint
+# and channel (see stackwriter.py) or the name of an export format (see
+# export.py) for one file per image. Optional keys: "directory",
+# "resolution" ([width, height]), "camera" (brightness, contrast,
+# saturation, sharpness) and "storage", what to do when the card fills up
+# or falls behind (see storage.py): the seconds left at which to "warn",
+# "compress", "reduce" the resolution or "pause", "min_free" (MB),
+# "max_busy" and the "actions" allowed, e.g.
+#     "storage": {"warn": 3600, "min_free": 500, "actions": ["warn", "pause"]}
+# The storage status is printed at every timepoint.
+# The camera, the LEDs and the multichannel sequencer are the ones of the
+# GUI, but Tk, PIL.ImageTk and pygame are never imported, so it starts
+# faster and uses less memory. The settings every image was taken with are
+# recorded in captures.sqlite in the output directory (see metadata.py).
+# Ctrl-C (or SIGTERM) stops after the current
+# timepoint, turns the LEDs off and closes the files.
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import time
+
+from bufferpool import BufferPool
+from export import EXPORT_FORMATS, Exporter
+from hardware import LED_PINS, openHardware
+from metadata import INDEX_FILE, MetadataIndex, captureRecord
+from sequencer import (DEFAULT_CHANNELS, Channel, MultichannelSequencer,
+                       timingReport)
+from stackwriter import StackWriter, uniqueFileName
+from storage import (ACTIONS, COMPRESSED_FORMAT, COMPRESSION, STACK_ACTIONS,
+                     StorageMonitor, StoragePolicy, reduceImage)
+from timelapse import TimelapseScheduler
+
+RESOLUTION = (3280, 2464)
+PROTOCOL_KEYS = ('name', 'channels', 'interval', 'timepoints', 'duration',
+                 'output', 'directory', 'resolution', 'camera', 'storage')
+CAMERA_SETTINGS = ('brightness', 'contrast', 'saturation', 'sharpness')
+CHANNEL_SETTINGS = ('shutter_speed', 'iso', 'awb_gains', 'framerate',
+                    'exposure_mode')
+STORAGE_SETTINGS = ('warn', 'compress', 'reduce', 'pause', 'min_free',
+                    'max_busy', 'actions')
+
+
+class Protocol(object):
+    def __init__(self, name, channels, interval=0, timepoints=None,
+                 output='stack', directory='.', resolution=RESOLUTION,
+                 camera=None, storage=None):
+        self.name = name
+        self.channels = channels
+        self.interval = interval
+        self.timepoints = timepoints
+        self.output = output
+        self.directory = directory
+        self.resolution = tuple(resolution)
+        self.camera = camera or {}
+        self.storage = storage or StoragePolicy()
+
+    def describe(self):
+        lines = ["Protocol %s: %s timepoints every %g s, %dx%d, output %s" % (
+            self.name, self.timepoints or "unlimited", self.interval,
+            self.resolution[0], self.resolution[1], self.output)]
+        for channel in self.channels:
+            lines.append("  %-8s pin %2d  shutter %7d us  ISO %3d  AWB %s  "
+                         "%g fps  exposure %s" % (
+                             channel.name, channel.pin, channel.shutter_speed,
+                             channel.iso, channel.awb_gains or 'auto',
+                             channel.framerate, channel.exposure_mode))
+        return "\n".join(lines)
+
+
+def defaultChannel(name):
+    for channel in DEFAULT_CHANNELS:
+        if channel.name == name:
+            return channel
+    raise ValueError("Unknown channel %r, expected one of %s" % (
+        name, ", ".join(c.name for c in DEFAULT_CHANNELS)))
+
+
+# Channel of the protocol: a channel name or an object with "name" and the
+# settings that differ from the default channel of that name (if any).
+def parseChannel(entry):
+    if not isinstance(entry, dict):
+        return defaultChannel(entry)
+    if 'name' not in entry:
+        raise ValueError("Channel without a name: %r" % (entry,))
+    unknown = set(entry) - set(CHANNEL_SETTINGS) - set(('name', 'led'))
+    if unknown:
+        raise ValueError("Unknown settings of channel %s: %s" % (
+            entry['name'], ", ".join(sorted(unknown))))
+    try:
+        base = defaultChannel(entry.get('led', entry['name']))
+        settings = dict((p, getattr(base, p)) for p in CHANNEL_SETTINGS)
+        pin = base.pin
+    except ValueError:
+        if 'led' not in entry:
+            raise
+        settings = {}
+        pin = entry['led']
+        if pin not in LED_PINS.values():
+            raise ValueError("Channel %s: unknown LED %r" % (entry['name'],
+                                                              pin))
+    settings.update((p, entry[p]) for p in CHANNEL_SETTINGS if p in entry)
+    if settings.get('awb_gains') is not None:
+        settings['awb_gains'] = tuple(settings['awb_gains'])
+    return Channel(entry['name'], pin, **settings)
+
+
+# Checks a protocol (the decoded JSON) and returns it as a Protocol. Raises
+# ValueError with the reason when it is not valid.
+def parseProtocol(data, name='protocol'):
+    if not isinstance(data, dict):
+        raise ValueError("The protocol must be a JSON object")
+    unknown = set(data) - set(PROTOCOL_KEYS)
+    if unknown:
+        raise ValueError("Unknown protocol keys: %s" % ", ".join(
+            sorted(unknown)))
+    channels = [parseChannel(entry) for entry in data.get('channels', [])]
+    if not channels:
+        raise ValueError("The protocol has no channels")
+    names = [channel.name for channel in channels]
+    if len(set(names)) != len(names):
+        raise ValueError("Channel names must be unique: %s" % ", ".join(names))
+    interval = float(data.get('interval', 0))
+    if interval < 0:
+        raise ValueError("Negative interval")
+    timepoints = data.get('timepoints')
+    if 'duration' in data:
+        if timepoints is not None:
+            raise ValueError("Give either duration or timepoints, not both")
+        if interval <= 0:
+            raise ValueError("A duration needs an interval")
+        timepoints = int(float(data['duration']) // interval) + 1
+    if timepoints is not None and int(timepoints) < 1:
+        raise ValueError("At least one timepoint is needed")
+    output = data.get('output', 'stack')
+    if output != 'stack' and output not in EXPORT_FORMATS:
+        raise ValueError("Unknown output %r, expected stack or one of %s" % (
+            output, ", ".join(EXPORT_FORMATS)))
+    camera = data.get('camera', {})
+    unknown = set(camera) - set(CAMERA_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown camera settings: %s" % ", ".join(
+            sorted(unknown)))
+    resolution = data.get('resolution', RESOLUTION)
+    if len(resolution) != 2:
+        raise ValueError("Resolution must be [width, height]")
+    return Protocol(data.get('name', name), channels, interval,
+                    None if timepoints is None else int(timepoints), output,
+                    data.get('directory', '.'),
+                    tuple(int(v) for v in resolution), camera,
+                    parseStorage(data.get('storage', {})))
+
+
+# StoragePolicy of the "storage" object of a protocol.
+def parseStorage(entry):
+    unknown = set(entry) - set(STORAGE_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown storage settings: %s" % ", ".join(
+            sorted(unknown)))
+    settings = dict((p, entry[p]) for p in ('warn', 'compress', 'reduce',
+                                            'pause') if p in entry)
+    if 'min_free' in entry:
+        settings['minFree'] = int(float(entry['min_free']) * (1 << 20))
+    if 'max_busy' in entry:
+        settings['maxBusy'] = float(entry['max_busy'])
+    if 'actions' in entry:
+        settings['actions'] = tuple(entry['actions'])
+    return StoragePolicy(**settings)
+
+
+def loadProtocol(fileName):
+    with open(fileName) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError("%s is not valid JSON: %s" % (fileName, e))
+    name = os.path.basename(fileName).split('.')[0]
+    return parseProtocol(data, name)
+
+
+class Acquisition(object):
+    # protocol: Protocol to run.
+    # camera, gpio: PiCamera and RPi.GPIO (or compatible) objects.
+    # settings: CameraSettings of the program, if any (see sequencer.py).
+    def __init__(self, protocol, camera, gpio, exporter=None, settings=None):
+        self.protocol = protocol
+        self.camera = camera
+        self.gpio = gpio
+        self.exporter = exporter or Exporter()
+        self.pins = list(LED_PINS.values())
+        # One timepoint being captured and one waiting for the encoder.
+        self.pool = BufferPool(protocol.resolution,
+                               2 * len(protocol.channels))
+        self.sequencer = MultichannelSequencer(camera, gpio, self.pins,
+                                               self._capture,
+                                               settings=settings)
+        self.base = os.path.join(protocol.directory, protocol.name + '-' +
+                                 time.strftime('%Y-%m-%d-%H%M%S'))
+        self.index = MetadataIndex(os.path.join(protocol.directory,
+                                                INDEX_FILE))
+        self.storage = StorageMonitor(protocol.directory, protocol.storage)
+        self.writer = None
+        self.files = 0
+        self.scheduler = None
+
+    def _capture(self, channel, timepoint):
+        buf = self.pool.acquire()
+        try:
+            self.camera.capture(buf.raw, 'bgr')
+        except:
+            buf.release()
+            raise
+        return buf
+
+    def _prepare(self):
+        for pin in self.pins:
+            self.gpio.setup(pin, self.gpio.OUT)
+            self.gpio.output(pin, self.gpio.LOW)
+        if self.camera.resolution != self.protocol.resolution:
+            self.camera.resolution = self.protocol.resolution
+        for name, value in self.protocol.camera.items():
+            setattr(self.camera, name, value)
+
+    def _timepoint(self, frame):
+        results = self.sequencer.runTimepoint(self.protocol.channels, frame)
+        print("Timepoint %d" % (frame + 1))
+        print(timingReport(results))
+        print("Storage: %s" % self.storage.status())
+        return [(channel, buf, t['state']) for channel, buf, t in results]
+
+    def _supported(self):
+        return ACTIONS if self.writer is None else STACK_ACTIONS
+
+    # Skips the timepoint while the storage policy says pause.
+    def _hold(self):
+        scheduler = self.scheduler
+        self.storage.setQueue(scheduler.encodeQueue.qsize(),
+                              scheduler.encodeQueue.maxsize)
+        status, action = self.storage.check(self._supported())
+        return action == 'pause'
+
+    def _write(self, frame, data):
+        for channel, buf, state in data:
+            name = channel.name
+            try:
+                status, action = self.storage.check(self._supported())
+                image = buf.array
+                if self.writer is not None:
+                    if action == 'compress' and (self.writer.compression,
+                                                 self.writer.level) != \
+                            COMPRESSION:
+                        self.writer.setCompression(*COMPRESSION)
+                    start = time.time()
+                    end = self.writer.end
+                    self.writer.append(frame, name, image)
+                    self.storage.recordWrite(self.writer.end - end,
+                                             time.time() - start)
+                    fileName = self.writer.fileName
+                    page = (frame, self.writer.channelIndex(name))
+                else:
+                    output = self.protocol.output
+                    if action == 'reduce':
+                        image = reduceImage(image)
+                    if action in ('compress', 'reduce'):
+                        output = COMPRESSED_FORMAT
+                    format = EXPORT_FORMATS[output]
+                    fileName = '%s-t%04d-%s%s' % (self.base, frame + 1, name,
+                                                  format.extension)
+                    result = self.exporter.write(image, fileName, output)
+                    self.storage.recordExport(result)
+                    print(result)
+                    page = None
+                self.index.add(captureRecord(fileName, image, state, name,
+                                             channel.pin, page))
+                self.files += 1
+            finally:
+                buf.release()
+
+    def _finish(self):
+        if self.writer is not None:
+            self.writer.close()
+            print("Saved %d images to %s" % (len(self.writer.pages),
+                                             self.writer.fileName))
+        else:
+            print("Saved %d images to %s-*" % (self.files, self.base))
+
+    def start(self):
+        protocol = self.protocol
+        if protocol.output == 'stack':
+            self.writer = StackWriter(
+                uniqueFileName(self.base, '.ome.tiff'),
+                [channel.name for channel in protocol.channels],
+                exporter=self.exporter, interval=protocol.interval)
+        self.scheduler = TimelapseScheduler(
+            protocol.interval, self._timepoint, self._write,
+            prepare=self._prepare, maxFrames=protocol.timepoints,
+            queueDepth=1, onFinish=self._finish, hold=self._hold)
+        self.storage.reset(protocol.interval)
+        self.scheduler.start()
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+    # Waits until the run is over; returns the error that ended it, if any.
+    # The timeout lets Python deliver the signals to the main thread.
+    def wait(self):
+        while self.scheduler.is_alive():
+            self.scheduler.join(0.5)
+        return self.scheduler.error
+
+    def close(self):
+        for pin in self.pins:
+            self.gpio.output(pin, self.gpio.LOW)
+        self.camera.close()
+        self.exporter.close()
+        self.index.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs an acquisition protocol of the microscope without "
+                    "the GUI")
+    parser.add_argument('protocol', help="protocol file (JSON)")
+    parser.add_argument('--backend', default=None,
+                        choices=('sim', 'picamera', 'auto'),
+                        help="camera backend (default: $MICROSCOPE_BACKEND "
+                             "or auto)")
+    parser.add_argument('--output', default=None,
+                        help="directory for the images (overrides the "
+                             "protocol)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="check the protocol and print it, without "
+                             "opening the camera")
+    args = parser.parse_args(argv)
+
+    try:
+        protocol = loadProtocol(args.protocol)
+    except (IOError, ValueError, TypeError) as e:
+        print("Invalid protocol: %s" % e, file=sys.stderr)
+        return 2
+    if args.output is not None:
+        protocol.directory = args.output
+    print(protocol.describe())
+    if args.dry_run:
+        return 0
+    if not os.path.isdir(protocol.directory):
+        os.makedirs(protocol.directory)
+
+    camera, gpio = openHardware(args.backend)
+    gpio.setmode(gpio.BCM)
+    gpio.setwarnings(False)
+    acquisition = Acquisition(protocol, camera, gpio)
+    # Keeps the protocol next to the images it produced.
+    shutil.copyfile(args.protocol, acquisition.base + '.json')
+
+    def interrupt(signum, frame):
+        print("Stopping after the current timepoint")
+        acquisition.stop()
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        acquisition.start()
+        error = acquisition.wait()
+    finally:
+        acquisition.close()
+        gpio.cleanup()
+    if error is not None:
+        print("Acquisition failed: %s" % error, file=sys.stderr)
+        return 1
+    print(acquisition.scheduler.stats.summary())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+## ======== AUTO EXPOSURE ======== ##
+
+# Finds the exposure time of a channel from small video port frames, so the
+# full resolution image is captured once with the right exposure instead of
+# after several trial shots.
+# The histogram of the brightest colour of every pixel is accumulated over a
+# couple of frames (cv2.calcHist with accumulate=True, into the same array)
+# and the exposure is scaled so that a chosen percentile of it reaches the
+# target level. The sensor response is linear in the exposure time, so this
+# usually lands within the tolerance in two or three steps. When too many
+# pixels are clipped the percentile says nothing about the right exposure:
+# the exposure is halved, and later steps stay between the longest exposure
+# that did not clip and the shortest one that did.
+# Only shutter_speed is changed: the ISO, white balance gains and framerate
+# of the channel are left as they are (set them, and freeze the gains with
+# exposure_mode 'off' if wanted, before running). The framerate limits the
+# longest exposure, fluorescence channels use 1 fps for up to 1 s.
+
+from __future__ import division
+
+import cv2
+import numpy as np
+
+from hardware import rgbArray
+
+AE_SIZE = (320, 240)
+PERCENTILE = 99.0
+# Target of the percentile, as a fraction of the full scale (255).
+TARGET = 0.75
+TOLERANCE = 0.1
+# Pixels at or above CLIP_LEVEL count as clipped; at most MAX_CLIPPED of
+# them (as a fraction) are accepted.
+CLIP_LEVEL = 250
+MAX_CLIPPED = 0.001
+# Largest change of the exposure in one step.
+MAX_STEP = 8.0
+MIN_SHUTTER = 100
+MAX_ITERATIONS = 8
+# Frames read after a change of the exposure before it is measured, and
+# frames accumulated in each histogram.
+SKIP_FRAMES = 2
+HISTOGRAM_FRAMES = 2
+
+
+class ExposureResult(object):
+    def __init__(self, shutter_speed, iso, awb_gains, framerate, level,
+                 clipped, iterations, converged, history):
+        self.shutter_speed = shutter_speed
+        self.iso = iso
+        self.awb_gains = awb_gains
+        self.framerate = framerate
+        self.level = level
+        self.clipped = clipped
+        self.iterations = iterations
+        self.converged = converged
+        # (shutter_speed, level, clipped) of every step.
+        self.history = history
+
+    # Camera settings to capture with, as keyword arguments of a Channel.
+    def settings(self):
+        return {'shutter_speed': self.shutter_speed, 'iso': self.iso,
+                'awb_gains': self.awb_gains, 'framerate': self.framerate}
+
+    def __str__(self):
+        return ("Exposure %.1f ms (ISO %s), level %.0f, %.2f%% clipped, "
+                "%d steps%s" % (self.shutter_speed / 1000, self.iso or "auto",
+                                self.level, self.clipped * 100,
+                                self.iterations,
+                                "" if self.converged else " (not converged)"))
+
+
+# Value below which "percentile" percent of the histogram lies.
+def histogramPercentile(hist, percentile):
+    cumulative = np.cumsum(hist)
+    total = cumulative[-1]
+    if total == 0:
+        return 0.0
+    return float(np.searchsorted(cumulative, total * percentile / 100.0))
+
+
+class AutoExposure(object):
+    # camera:     PiCamera (or compatible) object, with the LED of the
+    #             channel on. The caller holds the camera lock, if any.
+    # percentile: percentile of the brightest colour that should reach
+    #             "target" (fraction of the full scale) within "tolerance"
+    #             (relative).
+    # maxShutter: longest exposure in microseconds, by default the frame
+    #             period.
+    def __init__(self, camera, size=AE_SIZE, percentile=PERCENTILE,
+                 target=TARGET, tolerance=TOLERANCE, maxClipped=MAX_CLIPPED,
+                 minShutter=MIN_SHUTTER, maxShutter=None,
+                 maxIterations=MAX_ITERATIONS):
+        self.camera = camera
+        self.size = size
+        self.percentile = percentile
+        self.target = target * 255
+        self.tolerance = tolerance
+        self.maxClipped = maxClipped
+        self.minShutter = minShutter
+        self.maxShutter = maxShutter
+        self.maxIterations = maxIterations
+        self.brightest = np.empty((size[1], size[0]), np.uint8)
+        self.hist = np.zeros((256, 1), np.float32)
+
+    # Accumulates the histogram of the brightest colour of the next frames.
+    def _measure(self, stream, output):
+        self.hist[...] = 0
+        for n in range(SKIP_FRAMES + HISTOGRAM_FRAMES):
+            next(stream)
+            frame = output.array
+            output.truncate(0)
+            if n < SKIP_FRAMES:
+                continue
+            cv2.max(frame[:, :, 0], frame[:, :, 1], dst=self.brightest)
+            cv2.max(self.brightest, frame[:, :, 2], dst=self.brightest)
+            cv2.calcHist([self.brightest], [0], None, [256], [0, 256],
+                         hist=self.hist, accumulate=True)
+        hist = self.hist[:, 0]
+        clipped = hist[CLIP_LEVEL:].sum() / hist.sum()
+        return histogramPercentile(hist, self.percentile), float(clipped)
+
+    # Next exposure from the last one and what it gave. "unclipped" and
+    # "clipping" are the longest exposure that did not clip and the shortest
+    # one that did, so far (or None).
+    def _nextShutter(self, shutter, level, clipped, unclipped, clipping):
+        if clipped > self.maxClipped:
+            if unclipped is None:
+                return int(shutter / 2)
+            return int((unclipped + clipping) / 2)
+        if level < 1:
+            factor = MAX_STEP
+        else:
+            factor = min(MAX_STEP, max(1 / MAX_STEP, self.target / level))
+        following = int(shutter * factor)
+        if clipping is not None and following >= clipping:
+            following = int((shutter + clipping) / 2)
+        return following
+
+    # Adjusts camera.shutter_speed and returns an ExposureResult. The camera
+    # is left with the exposure found.
+    def run(self):
+        camera = self.camera
+        maxShutter = self.maxShutter or int(1e6 / float(camera.framerate))
+        shutter = camera.shutter_speed or camera.exposure_speed
+        shutter = min(maxShutter, max(self.minShutter, shutter))
+        history = []
+        converged = False
+        unclipped = clipping = None
+        output = rgbArray(camera, size=self.size)
+        stream = camera.capture_continuous(output, format='bgr',
+                                           use_video_port=True,
+                                           resize=self.size)
+        try:
+            while len(history) < self.maxIterations:
+                camera.shutter_speed = shutter
+                level, clipped = self._measure(stream, output)
+                history.append((shutter, level, clipped))
+                if clipped > self.maxClipped:
+                    clipping = min(clipping or shutter, shutter)
+                else:
+                    if abs(level - self.target) <= self.tolerance * self.target:
+                        converged = True
+                        break
+                    unclipped = max(unclipped or shutter, shutter)
+                    if clipping is not None and \
+                            clipping - unclipped <= self.tolerance * unclipped:
+                        # The target cannot be reached without clipping,
+                        # the longest exposure below it is as close as it
+                        # gets.
+                        converged = True
+                        break
+                following = min(maxShutter, max(
+                    self.minShutter, self._nextShutter(
+                        shutter, level, clipped, unclipped, clipping)))
+                if following == shutter:
+                    # Stuck at a limit of the exposure.
+                    break
+                shutter = following
+        finally:
+            stream.close()
+        # Best step: unclipped and closest to the target, else the least
+        # clipped.
+        shutter, level, clipped = min(history, key=lambda h: (
+            h[2] > self.maxClipped, h[2] if h[2] > self.maxClipped
+            else abs(h[1] - self.target)))
+        camera.shutter_speed = shutter
+        return ExposureResult(shutter, camera.iso,
+                              camera.awb_gains if camera.awb_mode == 'off'
+                              else None, camera.framerate, level, clipped,
+                              len(history), converged, history)
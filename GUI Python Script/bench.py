@@ -0,0 +1,368 @@
+## ======== BENCHMARKS ======== ##
+
+# Measures where the time goes between the sensor and the disk.
+# Every stage runs the code used by the GUI: the capture of the still
+# pipeline, the resize and colour conversion of the thumbnail, the
+# PhotoImage shown on the canvas, the gamma correction of the exported image
+# and every format of the export engine (see export.py); the formats whose
+# compression library is not installed are reported as skipped. A short time
+# lapse (TimelapseScheduler appending each timepoint to a StackWriter) and
+# the whole still pipeline (capture, thumbnail and writer threads) are also
+# timed end to end.
+# Each stage is repeated and reported with its throughput, latency
+# percentiles, file size and compression ratio (for the writers) and the
+# peak resident memory of the process while it ran.
+# By default the simulated camera is used (see hardware.py) with its sensor
+# latencies turned off, so the numbers only depend on the code and the
+# computer and can be compared from commit to commit:
+#     python bench.py --csv bench.csv
+# On the Raspberry Pi, "--backend picamera" measures the real camera.
+
+from __future__ import division, print_function
+
+import argparse
+import numbers
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from bufferpool import BufferPool, memoryUsage, resetPeakMemory
+from capture_pipeline import CaptureJob, CapturePipeline
+from export import ALL_FORMATS, EXPORT_FORMATS, Exporter
+from hardware import openHardware
+from stackwriter import StackWriter, indexFileName
+from timelapse import TimelapseScheduler
+from tonemap import ToneMapper
+
+RESOLUTIONS = {
+    'full': (3280, 2464),
+    'binned': (1640, 1232),
+    'vga': (640, 480),
+}
+PREVIEW_SIZE = (510, 384)
+STILL_FORMAT = 'TIFF'
+GAMMA = 2.4
+REPEAT = 5
+COLUMNS = ('label', 'stage', 'resolution', 'runs', 'mean_ms', 'p50_ms',
+           'p90_ms', 'p99_ms', 'max_ms', 'per_s', 'mb_per_s', 'file_bytes',
+           'peak_mb', 'ratio', 'error')
+
+
+class StageResult(object):
+    def __init__(self, stage, resolution, times, nbytes=0, fileBytes=None,
+                 peak=None, error=None):
+        self.stage = stage
+        self.resolution = resolution
+        self.times = times
+        self.nbytes = nbytes
+        self.fileBytes = fileBytes
+        self.peak = peak
+        self.error = error
+
+    def percentile(self, p):
+        return float(np.percentile(self.times, p)) if self.times else 0.0
+
+    def ratio(self):
+        return self.nbytes / self.fileBytes if self.fileBytes else 0.0
+
+    def mean(self):
+        return sum(self.times) / len(self.times) if self.times else 0.0
+
+    def row(self, label=''):
+        mean = self.mean()
+        return (label, self.stage, '%dx%d' % self.resolution, len(self.times),
+                '%.2f' % (mean * 1000), '%.2f' % (self.percentile(50) * 1000),
+                '%.2f' % (self.percentile(90) * 1000),
+                '%.2f' % (self.percentile(99) * 1000),
+                '%.2f' % (max(self.times) * 1000 if self.times else 0),
+                '%.2f' % (1 / mean if mean else 0),
+                '%.1f' % (self.nbytes / mean / 1e6 if mean else 0),
+                '' if self.fileBytes is None else self.fileBytes,
+                '' if self.peak is None else '%.1f' % (self.peak / 2**20),
+                '%.2f' % self.ratio() if self.fileBytes else '',
+                self.error or '')
+
+    def __str__(self):
+        if self.error and not self.times:
+            return "%-16s %9s  %s" % (self.stage, '%dx%d' % self.resolution,
+                                      self.error)
+        text = ("%-16s %9s  mean %8.2f ms  p50 %8.2f  p90 %8.2f  p99 %8.2f"
+                "  %7.2f/s  %7.1f MB/s  peak %6.1f MB" % (
+                    self.stage, '%dx%d' % self.resolution, self.mean() * 1000,
+                    self.percentile(50) * 1000, self.percentile(90) * 1000,
+                    self.percentile(99) * 1000,
+                    1 / self.mean() if self.mean() else 0,
+                    self.nbytes / self.mean() / 1e6 if self.mean() else 0,
+                    (self.peak or 0) / 2**20))
+        if self.fileBytes is not None:
+            text += "  file %7.2f MB  ratio %.2f" % (self.fileBytes / 1e6,
+                                                     self.ratio())
+        if self.error:
+            text += "  (%s)" % self.error
+        return text
+
+
+# Runs fn() "repeat" times after one warm up call. Writers return the size
+# of the file they wrote (an integer), anything else is ignored.
+def timeStage(stage, resolution, fn, repeat, nbytes=0):
+    times = []
+    fileBytes = None
+    try:
+        fn()
+        resetPeakMemory()
+        for _ in range(repeat):
+            start = time.time()
+            size = fn()
+            times.append(time.time() - start)
+            if isinstance(size, numbers.Integral):
+                fileBytes = size
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, ' '.join(str(e).split()))
+        return StageResult(stage, resolution, times, nbytes, fileBytes,
+                           memoryUsage()[1], error)
+    return StageResult(stage, resolution, times, nbytes, fileBytes,
+                       memoryUsage()[1])
+
+
+# Tk root for the PhotoImage stage, None when there is no display.
+def tkRoot():
+    try:
+        import Tkinter as tk
+    except ImportError:
+        import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return None
+    root.withdraw()
+    return root
+
+
+def benchmarkResolution(camera, resolution, directory, repeat, exporter,
+                        tk=None):
+    results = []
+    pipeline = CapturePipeline(
+        camera, resolution=resolution, previewSize=PREVIEW_SIZE,
+        write=lambda fileName, image: exporter.write(image, fileName,
+                                                     STILL_FORMAT))
+    width, height = resolution
+    frameBytes = width * height * 3
+
+    # Capture, as done by the capture stage of the pipeline.
+    def capture():
+        job = CaptureJob(0, None)
+        pipeline._captureFrame(job)
+        job.buffer.release()
+    results.append(timeStage('capture', resolution, capture, repeat,
+                             frameBytes))
+
+    job = CaptureJob(0, None)
+    image = pipeline._captureFrame(job)
+    resized = np.empty((PREVIEW_SIZE[1], PREVIEW_SIZE[0], 3), np.uint8)
+    rgb = np.empty_like(resized)
+    results.append(timeStage(
+        'resize', resolution,
+        lambda: cv2.resize(image, PREVIEW_SIZE, dst=resized), repeat,
+        frameBytes))
+    results.append(timeStage(
+        'cvtColor', resolution,
+        lambda: cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=rgb), repeat,
+        rgb.nbytes))
+    if tk is not None:
+        from PIL import Image, ImageTk
+        results.append(timeStage(
+            'PhotoImage', resolution,
+            lambda: ImageTk.PhotoImage(image=Image.fromarray(rgb)), repeat,
+            rgb.nbytes))
+    else:
+        results.append(StageResult('PhotoImage', resolution, [],
+                                   error="skipped, no display"))
+
+    # Gamma correction of export_image_corrected().
+    toneMapper = ToneMapper(image, PREVIEW_SIZE)
+    out = BufferPool(resolution, 1).acquire()
+    results.append(timeStage(
+        'gamma', resolution, lambda: toneMapper.export(GAMMA, out=out.array),
+        repeat, frameBytes))
+    out.release()
+
+    for format in ALL_FORMATS:
+        name = format.name
+        if name not in EXPORT_FORMATS:
+            results.append(StageResult(name, resolution, [],
+                                       error="skipped, not available"))
+            continue
+        fileName = os.path.join(directory, 'bench' + format.extension)
+
+        def write():
+            return exporter.write(image, fileName, name).fileBytes
+        results.append(timeStage(name, resolution, write, repeat,
+                                 frameBytes))
+        if os.path.exists(fileName):
+            os.remove(fileName)
+    job.buffer.release()
+
+    results.append(benchmarkTimelapse(pipeline, resolution, directory,
+                                      repeat, exporter))
+
+    # End to end still pipeline, as still() does.
+    fileNames = [os.path.join(directory, 'still%d.tiff' % i)
+                 for i in range(repeat)]
+    errors = []
+    pipeline.onWritten = lambda job: job.error and errors.append(job.error)
+    resetPeakMemory()
+    start = time.time()
+    for i, fileName in enumerate(fileNames):
+        pipeline.submit(i, fileName, block=True)
+    pipeline.close()
+    elapsed = time.time() - start
+    result = StageResult('pipeline ' + STILL_FORMAT, resolution,
+                         [elapsed / repeat] * repeat, frameBytes,
+                         peak=memoryUsage()[1],
+                         error=str(errors[0]) if errors else None)
+    if os.path.exists(fileNames[-1]):
+        result.fileBytes = os.path.getsize(fileNames[-1])
+    for fileName in fileNames:
+        if os.path.exists(fileName):
+            os.remove(fileName)
+    results.append(result)
+    return results
+
+
+# Time lapse without waits between the deadlines: each timepoint is
+# captured on the scheduler thread and appended to a single OME-TIFF on the
+# encoder thread, as startLapse() does.
+def benchmarkTimelapse(pipeline, resolution, directory, repeat, exporter):
+    camera = pipeline.camera
+    fileName = os.path.join(directory, 'bench.ome.tiff')
+    writer = StackWriter(fileName, ['BrFld'], exporter=exporter)
+
+    def capture(frame):
+        with pipeline.cameraLock:
+            if camera.resolution != resolution:
+                camera.resolution = resolution
+            buf = pipeline.pool.acquire()
+            try:
+                camera.capture(buf.raw, 'bgr')
+            except Exception:
+                buf.release()
+                raise
+        return buf
+
+    def write(frame, buf):
+        try:
+            writer.append(frame, 'BrFld', buf.array)
+        finally:
+            buf.release()
+
+    scheduler = TimelapseScheduler(0, capture, write, maxFrames=repeat,
+                                   onFinish=writer.close)
+    resetPeakMemory()
+    start = time.time()
+    scheduler.start()
+    scheduler.join()
+    elapsed = time.time() - start
+    width, height = resolution
+    result = StageResult('timelapse stack', resolution,
+                         [elapsed / repeat] * repeat, width * height * 3,
+                         peak=memoryUsage()[1],
+                         error=str(scheduler.error) if scheduler.error
+                         else None)
+    if os.path.exists(fileName):
+        result.fileBytes = os.path.getsize(fileName) // repeat
+    for name in (fileName, indexFileName(fileName)):
+        if os.path.exists(name):
+            os.remove(name)
+    return result
+
+
+# Name of the code being measured, e.g. the abbreviated git commit.
+def currentRevision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def writeCSV(fileName, results, label):
+    new = not os.path.exists(fileName)
+    with open(fileName, 'a') as f:
+        if new:
+            f.write(','.join(COLUMNS) + '\n')
+        for result in results:
+            f.write(','.join('"%s"' % v.replace('"', "'")
+                             if isinstance(v, str) and ',' in v else str(v)
+                             for v in result.row(label)) + '\n')
+
+
+def parseResolution(text):
+    if text in RESOLUTIONS:
+        return RESOLUTIONS[text]
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the capture to disk path of the "
+                    "microscope")
+    parser.add_argument('--backend', default='sim',
+                        choices=('sim', 'picamera', 'auto'))
+    parser.add_argument('--resolutions', default='full,binned',
+                        help="comma separated list of full, binned, vga or "
+                             "WIDTHxHEIGHT (default: full,binned)")
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--time-scale', type=float, default=0.0,
+                        help="sensor latency of the simulated camera, 1 is "
+                             "real time (default: 0, no latency)")
+    parser.add_argument('--dir', default=None,
+                        help="directory for the files written (default: a "
+                             "temporary directory)")
+    parser.add_argument('--csv', default=None,
+                        help="append the results to this CSV file")
+    parser.add_argument('--label', default=None,
+                        help="label of the run in the CSV (default: git "
+                             "revision)")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.backend != 'picamera':
+        options['timeScale'] = args.time_scale
+    camera, gpio = openHardware(args.backend, **options)
+    directory = args.dir or tempfile.mkdtemp(prefix='microscope-bench-')
+    label = currentRevision() if args.label is None else args.label
+    tk = tkRoot()
+    exporter = Exporter()
+    results = []
+    try:
+        for text in args.resolutions.split(','):
+            resolution = parseResolution(text.strip())
+            print("%dx%d, %d runs per stage" % (resolution + (args.repeat,)))
+            for result in benchmarkResolution(camera, resolution, directory,
+                                              args.repeat, exporter, tk):
+                print("  " + str(result))
+                results.append(result)
+    finally:
+        camera.close()
+        exporter.close()
+        if tk is not None:
+            tk.destroy()
+        if args.dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    if args.csv:
+        writeCSV(args.csv, results, label)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
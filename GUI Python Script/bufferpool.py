@@ -0,0 +1,121 @@
+## ======== FRAME BUFFER POOL ======== ##
+
+# Preallocated NumPy buffers for full resolution captures.
+# A 3280x2464 BGR frame takes ~24 MB. Allocating one per capture fragments
+# the memory left to Linux once the GPU split is taken, which shows up as
+# allocation stalls and MemoryErrors during long sessions. The pool
+# allocates its buffers once; the camera captures straight into them and the
+# stages of the pipeline borrow and return them.
+# Buffers are reference counted: every stage (or the GUI) holding a frame
+# calls retain() and release(), and the buffer goes back to the pool when
+# the last holder releases it. If the pool is empty a temporary buffer is
+# allocated and counted as an overflow, so a burst never blocks a capture.
+
+from __future__ import division
+
+import resource
+import threading
+
+import numpy as np
+
+
+# Shape of the buffer the camera writes for a given resolution: the GPU pads
+# the width to a multiple of 32 and the height to a multiple of 16.
+def paddedShape(resolution, channels=3):
+    width, height = resolution
+    return (((height + 15) // 16) * 16, ((width + 31) // 32) * 32, channels)
+
+
+class FrameBuffer(object):
+    def __init__(self, pool, resolution, channels, dtype, pooled=True):
+        width, height = resolution
+        self.pool = pool
+        self.pooled = pooled
+        # Padded buffer handed to camera.capture().
+        self.raw = np.empty(paddedShape(resolution, channels), dtype)
+        # Touch every page now, so the memory is really committed at start
+        # up and not on the first capture.
+        self.raw.fill(0)
+        # The image itself, without the padding.
+        self.array = self.raw[:height, :width]
+        self.refs = 0
+
+    def retain(self):
+        with self.pool.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            if self.pooled:
+                self.pool.free.append(self)
+
+
+class BufferPool(object):
+    # resolution: (width, height) of the frames.
+    # count:      number of buffers allocated up front.
+    def __init__(self, resolution, count=4, channels=3, dtype=np.uint8):
+        self.resolution = tuple(resolution)
+        self.channels = channels
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.count = count
+        self.overflows = 0
+        self.free = [FrameBuffer(self, self.resolution, channels, dtype)
+                     for _ in range(count)]
+
+    # Returns a buffer with one reference held by the caller.
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                buf = self.free.pop()
+                buf.refs = 1
+                return buf
+            self.overflows += 1
+        buf = FrameBuffer(self, self.resolution, self.channels, self.dtype,
+                          pooled=False)
+        buf.refs = 1
+        return buf
+
+    def available(self):
+        with self.lock:
+            return len(self.free)
+
+    def nbytes(self):
+        return self.count * int(np.prod(paddedShape(self.resolution,
+                                                    self.channels))) * \
+            np.dtype(self.dtype).itemsize
+
+
+# Resets the peak resident memory of the process (Linux 4.0 and newer), so
+# that memoryUsage() reports the peak since this call.
+def resetPeakMemory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# Returns (resident, peak resident) memory of the process in bytes.
+def memoryUsage():
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if rss is None:
+        rss = peak
+    return rss, peak
@@ -0,0 +1,82 @@
+## ======== LRU CACHE ======== ##
+
+# Bounded cache that forgets the least recently used entries, shared by the
+# zoom viewer (tiles of the image pyramid, see pyramid.py) and the gallery
+# (thumbnails, see gallery.py).
+# The limit is a number of entries, or a total size when a size function is
+# given (e.g. the bytes of each array). Entries can be used from several
+# threads.
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    # capacity: maximum number of entries, or of size units with "size".
+    # size:     optional, size(value) of an entry, 1 by default.
+    # onEvict:  optional, onEvict(key, value) when an entry is dropped to
+    #           make room.
+    def __init__(self, capacity, size=None, onEvict=None):
+        self.capacity = capacity
+        self.size = size or (lambda value: 1)
+        self.onEvict = onEvict
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    # Value of "key", which becomes the most recently used; "default" if it
+    # is not cached.
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total -= old[1]
+            size = self.size(value)
+            self.entries[key] = (value, size)
+            self.total += size
+            while self.total > self.capacity and len(self.entries) > 1:
+                oldKey, (oldValue, oldSize) = self.entries.popitem(last=False)
+                self.total -= oldSize
+                evicted.append((oldKey, oldValue))
+        if self.onEvict is not None:
+            for oldKey, oldValue in evicted:
+                self.onEvict(oldKey, oldValue)
+
+    # Value of "key", computed with load(key) and stored if missing.
+    def fetch(self, key, load):
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
+
+    def stats(self):
+        with self.lock:
+            return "%d entries, %d hits, %d misses" % (
+                len(self.entries), self.hits, self.misses)
@@ -0,0 +1,179 @@
+## ======== FLAT-FIELD CALIBRATION ======== ##
+
+# Dark frame and flat-field correction of the images, per channel and
+# exposure time.
+# The illumination of the LEDs is uneven and the optics vignette, so the
+# same sample looks brighter in the centre of the field than at the edges.
+# For each channel and exposure two maps are recorded, averaging several
+# full frames:
+#   - dark: the sensor with the LEDs off (offset and hot pixels).
+#   - flat: a blank slide with the LED of the channel on, minus the dark.
+# The flat is stored as its reciprocal, normalised to a mean of 1 per colour
+# plane, so the correction is a subtraction and a multiplication:
+#     corrected = (image - dark) * gain
+# done with vectorised OpenCV operations on the whole frame.
+# The maps are float32 .npy files under calibration/, named after the
+# channel, the exposure and the image size, e.g.
+# "Green-700000us-3280x2464-dark.npy". They are memory mapped when first
+# needed (a full resolution map is ~97 MB) and the most recently used ones
+# are kept open, up to CACHE_SIZE channel/exposure pairs, so the operating
+# system keeps them in its page cache instead of reading them per capture.
+
+from __future__ import division
+
+import collections
+import os
+import threading
+
+import cv2
+import numpy as np
+
+CALIBRATION_DIRECTORY = 'calibration'
+CACHE_SIZE = 2
+CALIBRATION_FRAMES = 8
+KINDS = ('dark', 'flat')
+# Flat field values below this fraction of the mean are treated as no light,
+# their gain is capped instead of growing without bound.
+MIN_FLAT = 0.05
+
+
+# File name of a map. exposure is the shutter speed in microseconds (0 for
+# automatic exposure), shape the (height, width[, planes]) of the images.
+def mapFileName(directory, kind, channel, exposure, shape):
+    return os.path.join(directory, '%s-%dus-%dx%d-%s.npy' % (
+        channel, exposure, shape[1], shape[0],
+        'dark' if kind == 'dark' else 'gain'))
+
+
+# Mean of a sequence of frames, as float32.
+def averageFrames(frames):
+    total = None
+    count = 0
+    for frame in frames:
+        if total is None:
+            total = np.zeros(frame.shape, np.float32)
+        cv2.accumulate(frame, total)
+        count += 1
+    if count == 0:
+        raise ValueError("No frames to average")
+    total /= count
+    return total
+
+
+# Reciprocal of a flat field (dark already subtracted), normalised so that
+# each colour plane keeps its mean brightness.
+def flatGain(flat):
+    planes = flat.reshape(-1, flat.shape[-1]) if flat.ndim == 3 else \
+        flat.reshape(-1, 1)
+    mean = planes.mean(axis=0).astype(np.float32)
+    floor = np.maximum(mean * MIN_FLAT, 1e-6)
+    gain = np.maximum(flat, floor)
+    np.divide(mean, gain, out=gain)
+    return gain
+
+
+class Calibration(object):
+    # dark, gain: memory mapped maps, either may be None.
+    def __init__(self, dark, gain):
+        self.dark = dark
+        self.gain = gain
+
+
+class CalibrationStore(object):
+    # directory: where the maps are stored.
+    # cacheSize: number of channel/exposure pairs kept open.
+    def __init__(self, directory=CALIBRATION_DIRECTORY, cacheSize=CACHE_SIZE):
+        self.directory = directory
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._work = None
+
+    def _writeMap(self, fileName, array):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        out = np.lib.format.open_memmap(fileName + '.part', 'w+',
+                                        np.float32, array.shape)
+        out[...] = array
+        out.flush()
+        del out
+        os.rename(fileName + '.part', fileName)
+
+    # Records the dark or flat map ("kind") of a channel and exposure from
+    # the frames given (any iterable of images of the same size). A flat
+    # uses the dark of the same channel and exposure if there is one, so
+    # record the dark first. Returns the file written.
+    def record(self, kind, channel, exposure, frames):
+        if kind not in KINDS:
+            raise ValueError("Unknown calibration: %s" % kind)
+        mean = averageFrames(frames)
+        if kind == 'flat':
+            calibration = self.get(channel, exposure, mean.shape)
+            if calibration is not None and calibration.dark is not None:
+                cv2.subtract(mean, calibration.dark, dst=mean)
+            mean = flatGain(mean)
+        fileName = mapFileName(self.directory, kind, channel, exposure,
+                               mean.shape)
+        with self.lock:
+            # The maps open for this pair are now out of date.
+            self.cache.pop((channel, exposure, mean.shape), None)
+        self._writeMap(fileName, mean)
+        return fileName
+
+    # Calibration of a channel and exposure for images of "shape", or None
+    # if neither map has been recorded.
+    def get(self, channel, exposure, shape):
+        key = (channel, exposure, tuple(shape))
+        with self.lock:
+            calibration = self.cache.pop(key, None)
+            if calibration is None:
+                maps = []
+                for kind in KINDS:
+                    fileName = mapFileName(self.directory, kind, channel,
+                                           exposure, shape)
+                    maps.append(np.load(fileName, mmap_mode='r')
+                                if os.path.exists(fileName) else None)
+                calibration = Calibration(*maps)
+            self.cache[key] = calibration
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        if calibration.dark is None and calibration.gain is None:
+            return None
+        return calibration
+
+    def calibrated(self, channel, exposure, shape):
+        return self.get(channel, exposure, shape) is not None
+
+    # Corrects "image" with the maps of the channel and exposure. The result
+    # has the type of the image and goes to "out" (which may be the image
+    # itself); the image is returned unchanged when there is no calibration.
+    def correct(self, image, channel, exposure, out=None):
+        calibration = self.get(channel, exposure, image.shape)
+        if calibration is None:
+            return image
+        if out is None:
+            out = np.empty_like(image)
+        if np.issubdtype(image.dtype, np.integer):
+            top = np.iinfo(image.dtype).max
+        else:
+            top = None
+        # A single working frame shared by the threads that correct images.
+        with self.lock:
+            work = self._work
+            if work is None or work.shape != image.shape:
+                work = self._work = np.empty(image.shape, np.float32)
+            if calibration.dark is not None:
+                cv2.subtract(image, calibration.dark, dst=work,
+                             dtype=cv2.CV_32F)
+            else:
+                work[...] = image
+            if calibration.gain is not None:
+                cv2.multiply(work, calibration.gain, dst=work)
+            if top is None:
+                out[...] = work
+            else:
+                # Rounded and saturated to the range of the image type.
+                np.add(work, 0.5, out=work)
+                np.clip(work, 0, top, out=work)
+                np.copyto(out, work, casting='unsafe')
+        return out
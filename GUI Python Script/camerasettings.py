@@ -0,0 +1,254 @@
+## ======== CAMERA SETTINGS ======== ##
+
+# Desired and applied state of the camera settings changed from the GUI.
+# Every write of a property goes to the firmware of the camera, and some of
+# them (ISO, framerate) reconfigure the sensor, so the controls do not write
+# to the camera themselves: they set the desired value and the settings are
+# applied
+#   - by a background thread, COALESCE_DELAY seconds after the first
+#     change not applied yet, so dragging a slider writes a value every
+#     50 ms (the preview follows it) instead of one per step;
+#   - right before a capture (apply() in the prepare function of the
+#     capture pipeline), so a still never waits for the delay.
+# Only the properties whose desired value differs from the last one written
+# are applied, in APPLY_ORDER, and the time each write takes is measured
+# (report(), and as "setting" timing spans, see tracing.py). Every write is
+# made with the camera lock held, so a setting never changes in the middle
+# of a capture or of a multichannel sequence: the background thread waits
+# for them to finish (the live preview steps aside). A write that fails is
+# retried every RETRY_DELAY seconds until it succeeds or the value changes.
+# As apply() and write() may wait for a whole capture or sequence, the Tk
+# thread only sets values and leaves the writes to the background thread.
+# The multichannel sequencer writes the settings of its channels with
+# write(), which leaves the desired values alone; restore() then writes them
+# back. Code that writes to the camera directly (auto exposure,
+# calibration) must call invalidate() afterwards, so the desired values are
+# written again.
+# Presets are named sets of values, e.g. the white balance gains of each
+# observation mode, read from presets.json:
+#     {"Green EmF": {"awb_mode": "off", "awb_gains": [1.2, 1.2]},
+#      "Blue 500ms": {"awb_mode": "off", "awb_gains": [1.2, 1.2],
+#                     "shutter_speed": 500000, "iso": 200}}
+# DEFAULT_PRESETS are used when there is no file.
+
+from __future__ import division, print_function
+
+import collections
+import json
+import os
+import threading
+
+from clock import monotonic
+from tracing import tracer
+
+# Order in which the changed properties are written. The ones handled by
+# the image processor go first, they only take effect on the next frame;
+# then the sensor ones, the framerate before the exposure time it limits;
+# the exposure mode last, because 'off' freezes the gains reached with the
+# new ISO and exposure.
+APPLY_ORDER = ('brightness', 'contrast', 'saturation', 'sharpness',
+               'image_effect', 'awb_mode', 'awb_gains', 'framerate',
+               'shutter_speed', 'iso', 'exposure_mode')
+COALESCE_DELAY = 0.05
+RETRY_DELAY = 1.0
+PRESETS_FILE = 'presets.json'
+DEFAULT_PRESETS = collections.OrderedDict([
+    ('B Field', {'awb_mode': 'off', 'awb_gains': (1.5, 1.2)}),
+    ('Red EmF', {'awb_mode': 'off', 'awb_gains': (1.1, 1.1)}),
+    ('Green EmF', {'awb_mode': 'off', 'awb_gains': (1.2, 1.2)}),
+])
+
+
+def checkProperties(values, what):
+    unknown = set(values) - set(APPLY_ORDER)
+    if unknown:
+        raise ValueError("%s: unknown camera settings %s" % (
+            what, ", ".join(sorted(unknown))))
+
+
+# Presets of the file, in its order, or DEFAULT_PRESETS if it does not
+# exist. Raises ValueError when the file is not valid.
+def loadPresets(fileName=PRESETS_FILE):
+    if not os.path.exists(fileName):
+        return collections.OrderedDict(DEFAULT_PRESETS)
+    with open(fileName) as f:
+        try:
+            data = json.load(f, object_pairs_hook=collections.OrderedDict)
+        except ValueError as e:
+            raise ValueError("%s is not valid JSON: %s" % (fileName, e))
+    presets = collections.OrderedDict()
+    for name, values in data.items():
+        checkProperties(values, "Preset %s" % name)
+        values = dict(values)
+        if values.get('awb_gains') is not None:
+            values['awb_gains'] = tuple(values['awb_gains'])
+        presets[name] = values
+    return presets
+
+
+# Time taken by the writes of a property.
+class Latency(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def __str__(self):
+        return "%4d writes, last %6.1f ms, mean %6.1f ms, max %6.1f ms" % (
+            self.count, self.last * 1000, self.total / self.count * 1000,
+            self.max * 1000)
+
+
+class CameraSettings(object):
+    # camera:     PiCamera (or compatible) object.
+    # cameraLock: CameraLock held while writing to the camera, a lock of
+    #             its own if not given.
+    # presets:    {name: {property: value}}, DEFAULT_PRESETS by default.
+    # delay:      seconds from a change to the write of the changes.
+    def __init__(self, camera, cameraLock=None, presets=None,
+                 delay=COALESCE_DELAY):
+        self.camera = camera
+        self.cameraLock = cameraLock or threading.RLock()
+        self.presets = presets if presets is not None else \
+            collections.OrderedDict(DEFAULT_PRESETS)
+        self.delay = delay
+        self.desired = {}
+        self.applied = {}
+        self.latency = collections.OrderedDict()
+        self.lock = threading.Condition()
+        # One apply() or write() at a time, taken after the camera lock.
+        self.applyLock = threading.Lock()
+        # When the oldest change not applied yet was made, or None.
+        self._changed = None
+        self._lastError = None
+        self._thread = threading.Thread(target=self._applyLoop,
+                                        name="camera-settings")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set(self, name, value):
+        self.update(**{name: value})
+
+    # Sets desired values; they are applied after the delay, or by the next
+    # apply().
+    def update(self, **values):
+        checkProperties(values, "CameraSettings")
+        with self.lock:
+            self.desired.update(values)
+            if self._changed is None:
+                self._changed = monotonic()
+            self.lock.notify()
+
+    # Sets the values of a preset and returns them.
+    def preset(self, name):
+        values = self.presets[name]
+        self.update(**values)
+        return values
+
+    # Names of the properties to write, in APPLY_ORDER.
+    def pending(self):
+        with self.lock:
+            return [name for name in APPLY_ORDER if name in self.desired and
+                    (name not in self.applied or
+                     self.applied[name] != self.desired[name])]
+
+    # Forgets what was written (all the properties, or those given), e.g.
+    # after another part of the program changed the camera.
+    def invalidate(self, *names):
+        with self.lock:
+            if not names:
+                self.applied.clear()
+            for name in names:
+                self.applied.pop(name, None)
+        self.restore()
+
+    # Has the desired values that differ from the ones on the camera written
+    # after the delay, e.g. once the sequencer is done with its channels.
+    def restore(self):
+        with self.lock:
+            if self._changed is None and self.pending():
+                self._changed = monotonic()
+                self.lock.notify()
+
+    # Writes the properties that changed, now. Returns their names.
+    def apply(self):
+        with self.cameraLock:
+            with self.applyLock:
+                with self.lock:
+                    changes = [(name, self.desired[name])
+                               for name in self.pending()]
+                self._write(changes)
+                with self.lock:
+                    # Changes made during the writes are left for the
+                    # background thread.
+                    if not self.pending():
+                        self._changed = None
+        return [name for name, value in changes]
+
+    # Writes "values" now, skipping the ones already on the camera, without
+    # changing the desired values (see restore()).
+    def write(self, **values):
+        checkProperties(values, "CameraSettings")
+        with self.cameraLock:
+            with self.applyLock:
+                with self.lock:
+                    changes = [(name, values[name]) for name in APPLY_ORDER
+                               if name in values and
+                               (name not in self.applied or
+                                self.applied[name] != values[name])]
+                self._write(changes)
+
+    # Writes every change, even after a failure; raises the first error once
+    # done.
+    def _write(self, changes):
+        error = None
+        for name, value in changes:
+            start = monotonic()
+            try:
+                setattr(self.camera, name, value)
+            except Exception as e:
+                error = error or e
+                continue
+            elapsed = monotonic() - start
+            tracer.record('setting', start, elapsed, name)
+            with self.lock:
+                self.applied[name] = value
+                self.latency.setdefault(name, Latency()).add(elapsed)
+        if error is not None:
+            raise error
+
+    def _applyLoop(self):
+        while True:
+            with self.lock:
+                while self._changed is None:
+                    self.lock.wait()
+                wait = self._changed + self.delay - monotonic()
+                if wait > 0:
+                    # More changes may come in the meantime.
+                    self.lock.wait(wait)
+                    continue
+            try:
+                self.apply()
+                self._lastError = None
+            except Exception as e:
+                if str(e) != self._lastError:
+                    print("Camera settings not applied: %s" % e)
+                    self._lastError = str(e)
+                with self.lock:
+                    # A new change wakes the thread up before the retry.
+                    self.lock.wait(RETRY_DELAY)
+
+    # Write latency of every property written so far.
+    def report(self):
+        with self.lock:
+            if not self.latency:
+                return "No camera settings written yet"
+            return "\n".join("%-14s %s" % (name, latency)
+                             for name, latency in self.latency.items())
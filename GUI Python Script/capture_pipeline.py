@@ -0,0 +1,327 @@
+## ======== CAPTURE PIPELINE ======== ##
+
+# Staged capture pipeline used by the GUI to take still images without
+# freezing the Tk main thread.
+# A capture goes through three stages, each one running on its own thread:
+#   1. Capture:   the camera is configured and the full resolution frame is
+#                 read from the sensor.
+#   2. Thumbnail: the frame is reduced to the size of the preview canvas and
+#                 handed back to the GUI as soon as it is ready.
+#   3. Writer:    the full resolution frame is written to disk from a bounded
+#                 queue, so the SD card can lag behind without blocking the GUI.
+# When the writer queue is full the capture stage waits (backpressure), and
+# new requests are refused instead of piling up 24 MB frames in memory.
+# None of the callbacks run on the Tk thread; the GUI must hand the results
+# over to the main loop itself (see pollCaptureEvents() in the GUI script).
+# The onThumbnail callback is the only place where job.image is guaranteed to
+# be set, it is released once the file has been written.
+# Frames and thumbnails live in preallocated buffers (see bufferpool.py). A
+# consumer that keeps job.image or job.thumbnail after its callback returns
+# must retain() job.buffer / job.thumbnailBuffer and release() them later.
+# With a metadata index (see metadata.py) the state of the camera is read
+# right after each capture, under the camera lock, and recorded with the
+# file name once the file is written.
+# Every stage is also measured with a timing span (see tracing.py).
+
+from __future__ import division
+
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import cv2
+import numpy as np
+
+from bufferpool import BufferPool, memoryUsage, resetPeakMemory
+from metadata import cameraState, captureRecord
+from tracing import tracer
+
+FULL_RESOLUTION = (3280, 2464)
+PREVIEW_SIZE = (510, 384)
+WRITE_QUEUE_DEPTH = 2
+
+
+# Re-entrant lock that serialises the use of the camera between threads.
+# Long running users, such as the live preview, hold it across many frames
+# and check wanted() to step aside while a capture is waiting for it.
+class CameraLock(object):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._waiting = 0
+        self._countLock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        with self._countLock:
+            self._waiting += 1
+        try:
+            return self._lock.acquire(blocking)
+        finally:
+            with self._countLock:
+                self._waiting -= 1
+
+    def release(self):
+        self._lock.release()
+
+    def wanted(self):
+        return self._waiting > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# A single capture request travelling through the pipeline. The file name is
+# decided when the request is made, so the numbering of the images does not
+# depend on the order in which the stages finish.
+class CaptureJob(object):
+    def __init__(self, number, fileName, prepare=None, capture=None,
+                 process=None, metadata=None, resolution=None):
+        self.number = number
+        self.fileName = fileName
+        self.prepare = prepare
+        self.capture = capture
+        self.process = process
+        # Sensor resolution of the capture, the pipeline's one when None.
+        self.resolution = resolution
+        # Channel and LED of the capture, and the camera state once read:
+        # {'channel': name, 'led': pin, 'state': cameraState()}.
+        self.metadata = dict(metadata or {})
+        # Significant bits of the image, 8 unless the capture says otherwise
+        # (e.g. 10 for raw sensor data stored in 16-bit arrays).
+        self.bits = 8
+        self.image = None
+        self.buffer = None
+        self.thumbnail = None
+        self.thumbnailBuffer = None
+        self.memory = None
+        self.written = None
+        self.error = None
+        self.times = {}
+        self.requested = time.time()
+
+
+class CapturePipeline(object):
+    # camera:      PiCamera (or compatible) object used for the captures.
+    # queueDepth:  number of full resolution frames allowed to wait for the
+    #              writer. Each one of them costs ~24 MB of RAM.
+    # onThumbnail: called with the job once the preview image is ready.
+    # onWritten:   called with the job once the file is on disk (or failed,
+    #              in which case job.error is set).
+    # pool:        BufferPool of full resolution frames; by default one with
+    #              a buffer per frame that can be in flight.
+    # write:       write(fileName, image) used by the writer stage (e.g.
+    #              Exporter.write), cv2.imwrite by default. Its result is
+    #              kept in job.written.
+    # index:       MetadataIndex where every file written is recorded.
+    def __init__(self, camera, queueDepth=WRITE_QUEUE_DEPTH,
+                 resolution=FULL_RESOLUTION, previewSize=PREVIEW_SIZE,
+                 onThumbnail=None, onWritten=None, cameraLock=None,
+                 pool=None, write=None, index=None):
+        self.camera = camera
+        self.resolution = resolution
+        self.previewSize = previewSize
+        self.onThumbnail = onThumbnail
+        self.onWritten = onWritten
+        self.write = write
+        self.index = index
+        self.cameraLock = cameraLock or CameraLock()
+        self.captureQueue = queue.Queue()
+        self.writeQueue = queue.Queue(maxsize=max(1, int(queueDepth)))
+        # One frame being captured, the ones waiting for the writer and the
+        # one being written.
+        self.maxPending = self.writeQueue.maxsize + 2
+        self.pool = pool or BufferPool(resolution, self.maxPending)
+        # One more thumbnail than frames in flight, for the one on display.
+        self.thumbnailPool = BufferPool(previewSize, self.maxPending + 1)
+        width, height = previewSize
+        self._resized = np.empty((height, width, 3), np.uint8)
+        self._pending = 0
+        self._pendingLock = threading.Condition()
+        self._captureThread = threading.Thread(target=self._captureLoop,
+                                               name="capture-stage")
+        self._writerThread = threading.Thread(target=self._writerLoop,
+                                              name="writer-stage")
+        self._captureThread.daemon = True
+        self._writerThread.daemon = True
+        self._captureThread.start()
+        self._writerThread.start()
+
+    # Number of captures requested but not yet written to disk.
+    def pending(self):
+        with self._pendingLock:
+            return self._pending
+
+    # Requests a new capture. "prepare" is an optional function that pushes
+    # the camera settings; it runs on the capture thread right before the
+    # sensor is read, so settings never change in the middle of a capture.
+    # Returns the job, or None when the pipeline is saturated (the writer is
+    # behind and maxPending captures are already in flight). With block=True
+    # the call waits for room instead; never do that from the Tk thread.
+    # "capture" replaces the default BGR capture (e.g. RawCapture.captureInto):
+    # it is called with the job while the camera lock is held, must set
+    # job.buffer and return the image.
+    # "process" corrects the captured image (e.g. CalibrationStore.correct):
+    # process(job, image) runs on the capture thread once the camera lock is
+    # released, before the thumbnail, and returns the image to keep (it may
+    # work in place on job.buffer).
+    # "metadata" gives the channel and LED recorded in the index.
+    # "resolution" is the sensor resolution to capture at when it is not the
+    # pipeline's (e.g. BurstStacker.resolution for a burst on the video
+    # port), so the camera is only reconfigured once.
+    def submit(self, number, fileName, prepare=None, block=False,
+               capture=None, process=None, metadata=None, resolution=None):
+        return self._enqueue(CaptureJob(number, fileName, prepare, capture,
+                                        process, metadata, resolution),
+                             block)
+
+    # Same as submit() for a frame that has already been captured elsewhere
+    # (e.g. by the multichannel sequencer); only the thumbnail and writer
+    # stages are run. If the frame lives in a FrameBuffer, pass it as
+    # "buffer": the pipeline takes over its reference and releases it once
+    # the file is written. Its metadata should include the camera state
+    # read when it was captured ('state').
+    def submitFrame(self, number, fileName, image, block=False, buffer=None,
+                    metadata=None):
+        job = CaptureJob(number, fileName, metadata=metadata)
+        job.image = image
+        job.buffer = buffer
+        if self._enqueue(job, block) is None:
+            return None
+        return job
+
+    def _enqueue(self, job, block):
+        with self._pendingLock:
+            while self._pending >= self.maxPending:
+                if not block:
+                    return None
+                self._pendingLock.wait()
+            self._pending += 1
+        self.captureQueue.put(job)
+        return job
+
+    # Stops accepting captures, waits for the queued files to be written and
+    # terminates the stage threads.
+    def close(self, timeout=None):
+        self.captureQueue.put(None)
+        self._captureThread.join(timeout)
+        self._writerThread.join(timeout)
+
+    # The camera writes straight into a pooled buffer (padded to the size
+    # the GPU produces), so no frame is allocated per capture.
+    def _captureFrame(self, job):
+        with self.cameraLock:
+            if job.prepare is not None:
+                with tracer.span('prepare'):
+                    job.prepare()
+            resolution = job.resolution or self.resolution
+            if self.camera.resolution != resolution:
+                self.camera.resolution = resolution
+            # Exposure, read out and the ISP of the GPU.
+            with tracer.span('sensor'):
+                if job.capture is not None:
+                    image = job.capture(job)
+                else:
+                    job.buffer = self.pool.acquire()
+                    self.camera.capture(job.buffer.raw, 'bgr')
+                    image = job.buffer.array
+            if self.index is not None:
+                job.metadata['state'] = cameraState(self.camera)
+        return image
+
+    def _makeThumbnail(self, job):
+        job.thumbnailBuffer = self.thumbnailPool.acquire()
+        if job.image.dtype == np.uint8:
+            cv2.resize(job.image, self.previewSize, dst=self._resized)
+        else:
+            # Deeper images are scaled down to 8 bits for the display only.
+            small = cv2.resize(job.image, self.previewSize)
+            cv2.convertScaleAbs(small, dst=self._resized,
+                                alpha=255.0 / ((1 << job.bits) - 1))
+        cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB,
+                     dst=job.thumbnailBuffer.array)
+        return job.thumbnailBuffer.array
+
+    # Gives back the buffers still held by the pipeline for this job.
+    def _releaseBuffers(self, job):
+        for name in ('buffer', 'thumbnailBuffer'):
+            buf = getattr(job, name)
+            if buf is not None:
+                buf.release()
+                setattr(job, name, None)
+
+    def _captureLoop(self):
+        while True:
+            job = self.captureQueue.get()
+            if job is None:
+                self.writeQueue.put(None)
+                return
+            try:
+                resetPeakMemory()
+                if job.image is None:
+                    start = time.time()
+                    job.image = self._captureFrame(job)
+                    job.times['capture'] = time.time() - start
+                if job.process is not None:
+                    start = time.time()
+                    with tracer.span('process'):
+                        job.image = job.process(job, job.image)
+                    job.times['process'] = time.time() - start
+                start = time.time()
+                with tracer.span('thumbnail'):
+                    job.thumbnail = self._makeThumbnail(job)
+                job.times['thumbnail'] = time.time() - start
+                job.memory = memoryUsage()
+            except Exception as e:
+                job.error = e
+                self._finish(job)
+                continue
+            if self.onThumbnail is not None:
+                self.onThumbnail(job)
+            # Blocks while the writer is behind; this is the backpressure
+            # that keeps the number of frames held in memory bounded.
+            self.writeQueue.put(job)
+
+    def _writerLoop(self):
+        while True:
+            job = self.writeQueue.get()
+            if job is None:
+                return
+            try:
+                start = time.time()
+                with tracer.span('write'):
+                    if self.write is not None:
+                        job.written = self.write(job.fileName, job.image)
+                    elif not cv2.imwrite(job.fileName, job.image):
+                        raise IOError("Could not write " + job.fileName)
+                job.times['write'] = time.time() - start
+                self._record(job)
+            except Exception as e:
+                job.error = e
+            self._finish(job)
+
+    def _record(self, job):
+        if self.index is None or 'state' not in job.metadata:
+            return
+        self.index.add(captureRecord(
+            job.fileName, job.image, job.metadata['state'],
+            job.metadata.get('channel'), job.metadata.get('led'),
+            bits=job.bits))
+
+    def _finish(self, job):
+        # The frame is no longer needed by the pipeline; whoever still wants
+        # it must have retained its buffer (e.g. the GUI).
+        self._releaseBuffers(job)
+        job.image = None
+        job.thumbnail = None
+        with self._pendingLock:
+            self._pending -= 1
+            self._pendingLock.notify()
+        if self.onWritten is not None:
+            self.onWritten(job)
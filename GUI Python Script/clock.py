@@ -0,0 +1,28 @@
+## ======== CLOCK ======== ##
+
+# Monotonic clock used to schedule and measure the acquisitions. Unlike
+# time.time() it never jumps when the system time is corrected (e.g. by NTP
+# once the Raspberry Pi reaches the network).
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2.7 has no monotonic clock in the standard library; read
+    # CLOCK_MONOTONIC directly from the C library.
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or None,
+                                 use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        t = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
@@ -0,0 +1,170 @@
+## ======== CHANNEL COMPOSITE ======== ##
+
+# False colour merge of the fluorescence (and brightfield) channels.
+# The latest frame of every channel is kept as a single intensity plane (the
+# brightest colour of each pixel), at full resolution and reduced to the
+# preview size. Each channel is painted with its colour through a lookup
+# table that also applies its contrast limits, and the channels are added
+# together (saturating), as in the "composite" mode of ImageJ.
+# The preview is blended from the small planes only, so moving a contrast
+# limit rebuilds a 256 entry table and blends ~200k pixels per channel; the
+# full resolution planes are only blended by render(), when exporting.
+
+from __future__ import division
+
+import collections
+import threading
+
+import cv2
+import numpy as np
+
+PREVIEW_SIZE = (510, 384)
+# Colour (blue, green, red) of the channels of the microscope, by name.
+CHANNEL_COLOURS = {
+    'BrFld': (1.0, 1.0, 1.0),
+    'Green': (0.0, 1.0, 0.0),
+    'Blue': (1.0, 0.0, 0.0),
+    'Red': (0.0, 0.0, 1.0),
+}
+DEFAULT_COLOUR = (1.0, 0.0, 1.0)
+# Percentiles of the preview used as initial contrast limits.
+AUTO_LOW = 0.5
+AUTO_HIGH = 99.5
+
+
+# Lookup table painting intensities in "colour", black below "low" and full
+# colour from "high" up; (1, 256, 3) uint8 for cv2.LUT.
+def colourLUT(colour, low, high):
+    ramp = (np.arange(256, dtype=np.float32) - low) / max(1, high - low)
+    np.clip(ramp, 0, 1, out=ramp)
+    lut = np.empty((1, 256, 3), np.uint8)
+    for i, c in enumerate(colour):
+        lut[0, :, i] = np.round(ramp * (255 * c))
+    return lut
+
+
+# Brightest colour of every pixel of a BGR (or single plane) image, scaled
+# to 8 bits, into "out".
+def intensityPlane(image, bits, out):
+    if image.dtype == np.uint8:
+        if image.ndim == 3:
+            cv2.max(image[:, :, 0], image[:, :, 1], dst=out)
+            cv2.max(out, image[:, :, 2], dst=out)
+        else:
+            out[...] = image
+        return out
+    if image.ndim == 3:
+        plane = cv2.max(image[:, :, 0], image[:, :, 1])
+        cv2.max(plane, image[:, :, 2], dst=plane)
+    else:
+        plane = image
+    cv2.convertScaleAbs(plane, dst=out, alpha=255.0 / ((1 << bits) - 1))
+    return out
+
+
+class ChannelLayer(object):
+    def __init__(self, name, colour):
+        self.name = name
+        self.colour = colour
+        self.low = 0
+        self.high = 255
+        self.visible = True
+        self.full = None
+        self.small = None
+        self.lut = colourLUT(colour, self.low, self.high)
+
+    def setLimits(self, low, high):
+        self.low = int(low)
+        self.high = max(int(high), self.low + 1)
+        self.lut = colourLUT(self.colour, self.low, self.high)
+
+
+class Composite(object):
+    def __init__(self, previewSize=PREVIEW_SIZE, colours=None):
+        self.previewSize = previewSize
+        self.colours = colours or CHANNEL_COLOURS
+        self.layers = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented whenever a frame arrives, so a window showing the
+        # composite knows when to redraw.
+        self.version = 0
+        width, height = previewSize
+        self._preview = np.empty((height, width, 3), np.uint8)
+        self._previewPlane = np.empty((height, width, 3), np.uint8)
+        self._painted = np.empty((height, width, 3), np.uint8)
+
+    # Keeps "image" (BGR or single plane, with "bits" significant bits) as
+    # the latest frame of the channel. Runs on any thread; the image is
+    # copied, the caller keeps its buffer. With autoContrast the limits are
+    # set from the percentiles of the new frame.
+    def setFrame(self, name, image, bits=8, autoContrast=True):
+        height, width = image.shape[:2]
+        with self.lock:
+            layer = self.layers.get(name)
+            if layer is None:
+                layer = ChannelLayer(name, self.colours.get(name,
+                                                            DEFAULT_COLOUR))
+                self.layers[name] = layer
+            if layer.full is None or layer.full.shape != (height, width):
+                layer.full = np.empty((height, width), np.uint8)
+                layer.small = np.empty((self.previewSize[1],
+                                        self.previewSize[0]), np.uint8)
+            intensityPlane(image, bits, layer.full)
+            cv2.resize(layer.full, self.previewSize, dst=layer.small,
+                       interpolation=cv2.INTER_AREA)
+            if autoContrast:
+                low, high = np.percentile(layer.small, (AUTO_LOW, AUTO_HIGH))
+                layer.setLimits(low, high)
+            self.version += 1
+
+    def names(self):
+        with self.lock:
+            return list(self.layers)
+
+    def limits(self, name):
+        with self.lock:
+            layer = self.layers[name]
+            return layer.low, layer.high
+
+    def setLimits(self, name, low, high):
+        with self.lock:
+            self.layers[name].setLimits(low, high)
+
+    def setVisible(self, name, visible):
+        with self.lock:
+            self.layers[name].visible = bool(visible)
+
+    # Paints every visible plane with its table and adds them into "out".
+    def _blend(self, planes, out, scratch, painted):
+        out[...] = 0
+        for layer, plane in planes:
+            cv2.cvtColor(plane, cv2.COLOR_GRAY2BGR, dst=scratch)
+            cv2.LUT(scratch, layer.lut, dst=painted)
+            cv2.add(out, painted, dst=out)
+        return out
+
+    # Composite at the preview size, BGR uint8. The array is reused by the
+    # next call.
+    def preview(self):
+        with self.lock:
+            planes = [(layer, layer.small)
+                      for layer in self.layers.values()
+                      if layer.visible and layer.small is not None]
+            return self._blend(planes, self._preview, self._previewPlane,
+                               self._painted)
+
+    # Composite at full resolution, BGR uint8, for export. Channels captured
+    # at another resolution than the first one are resized to it.
+    def render(self):
+        with self.lock:
+            planes = [(layer, layer.full) for layer in self.layers.values()
+                      if layer.visible and layer.full is not None]
+            if not planes:
+                return None
+            height, width = planes[0][1].shape
+            planes = [(layer, plane if plane.shape == (height, width)
+                       else cv2.resize(plane, (width, height)))
+                      for layer, plane in planes]
+            out = np.empty((height, width, 3), np.uint8)
+            return self._blend(planes, out, np.empty_like(out),
+                               np.empty_like(out))
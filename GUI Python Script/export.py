@@ -0,0 +1,330 @@
+## ======== EXPORT ENGINE ======== ##
+
+# Writes the captured images in the formats offered by the GUI.
+# TIFF files are tiled (256x256 tiles) and each tile is compressed on its
+# own, so the tiles are compressed in parallel by a pool of threads (zlib and
+# zstd release the GIL while they work) and written in order as they are
+# ready. The compression (none, LZW, zlib/deflate or zstd) and its level can
+# be chosen; a horizontal predictor is applied before compressing, which
+# makes microscope images noticeably smaller.
+# zlib is always available. zstd needs the "zstandard" (or "imagecodecs")
+# package and LZW needs "imagecodecs"; without them those formats are left
+# out of EXPORT_FORMATS, so every TIFF offered is tiled and multi-threaded.
+# Raw data is written as NumPy .npy files: a short header with the shape and
+# type followed by the pixels. The file is written through a memory map, so
+# padded frames are not copied first, and can be opened the same way with
+# numpy.load(fileName, mmap_mode='r').
+# PNG, JPEG and BMP go through cv2.imwrite with an explicit level.
+# Every export returns an ExportResult with the time taken, the throughput
+# and the compression ratio, to choose the best speed/size point for the SD
+# card. Each write is a timing span named "export" (see tracing.py).
+
+from __future__ import division
+
+import collections
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+from tracing import tracer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+TILE_SIZE = 256
+SOFTWARE = 'BioARTS Microscope'
+
+# TIFF compression codes.
+COMPRESSION_NONE = 1
+COMPRESSION_LZW = 5
+COMPRESSION_DEFLATE = 8
+COMPRESSION_ZSTD = 50000
+COMPRESSION_CODES = {
+    'none': COMPRESSION_NONE,
+    'lzw': COMPRESSION_LZW,
+    'zlib': COMPRESSION_DEFLATE,
+    'zstd': COMPRESSION_ZSTD,
+}
+# TIFF field types: (code, struct format).
+TIFF_TYPES = {
+    'ASCII': (2, 's'),
+    'SHORT': (3, 'H'),
+    'LONG': (4, 'I'),
+    'LONG8': (16, 'Q'),
+}
+
+
+# A file format of the export menu. "level" is the compression level for
+# zlib (0-9), zstd (1-22) and PNG (0-9) and the quality for JPEG (0-100).
+class ExportFormat(object):
+    def __init__(self, name, extension, kind, compression=None, level=None):
+        self.name = name
+        self.extension = extension
+        self.kind = kind
+        self.compression = compression
+        self.level = level
+
+
+# Every format of the engine, see EXPORT_FORMATS for those available here.
+ALL_FORMATS = (
+    ExportFormat('TIFF', '.tiff', 'tiff', 'zlib', 1),
+    ExportFormat('TIFF zlib 6', '.tiff', 'tiff', 'zlib', 6),
+    ExportFormat('TIFF zstd', '.tiff', 'tiff', 'zstd', 3),
+    ExportFormat('TIFF LZW', '.tiff', 'tiff', 'lzw'),
+    ExportFormat('TIFF none', '.tiff', 'tiff', 'none'),
+    ExportFormat('PNG', '.png', 'png', level=1),
+    ExportFormat('JPEG', '.jpeg', 'jpeg', level=95),
+    ExportFormat('BMP', '.bmp', 'bmp'),
+    ExportFormat('NPY', '.npy', 'npy'),
+)
+
+
+class ExportResult(object):
+    def __init__(self, format, fileName, seconds, rawBytes, fileBytes,
+                 threads=1):
+        self.format = format
+        self.fileName = fileName
+        self.seconds = seconds
+        self.rawBytes = rawBytes
+        self.fileBytes = fileBytes
+        self.threads = threads
+        # Image bytes exported per second, and size of the image over the
+        # size of the file.
+        self.bytesPerSecond = rawBytes / seconds if seconds else 0.0
+        self.ratio = rawBytes / fileBytes if fileBytes else 0.0
+
+    def __str__(self):
+        return ("%s: %s, %.1f MB in %.0f ms (%.1f MB/s, %d threads), "
+                "ratio %.2f" % (self.format, self.fileName,
+                                self.fileBytes / 1e6, self.seconds * 1000,
+                                self.bytesPerSecond / 1e6, self.threads,
+                                self.ratio))
+
+
+# Builds an image file directory at "offset": the entries, sorted by tag,
+# followed by the values that do not fit in an entry. tags is a list of
+# (tag, type, values) with values a string for ASCII or a sequence. With
+# big=True the directory has the BigTIFF layout (64-bit counts and offsets).
+def buildIFD(tags, offset, nextIFD=0, big=False):
+    if big:
+        countFormat, entryFormat, inline, nextFormat = '<Q', '<HHQ', 8, '<Q'
+    else:
+        countFormat, entryFormat, inline, nextFormat = '<H', '<HHI', 4, '<I'
+    tags = sorted(tags)
+    extra = (offset + struct.calcsize(countFormat) +
+             len(tags) * (struct.calcsize(entryFormat) + inline) +
+             struct.calcsize(nextFormat))
+    entries = []
+    data = b''
+    for tag, kind, values in tags:
+        code, fmt = TIFF_TYPES[kind]
+        if kind == 'ASCII':
+            payload = values.encode('ascii') + b'\0'
+            count = len(payload)
+        else:
+            count = len(values)
+            payload = struct.pack('<%d%s' % (count, fmt), *values)
+        if len(payload) <= inline:
+            entries.append(struct.pack(entryFormat, tag, code, count) +
+                           payload.ljust(inline, b'\0'))
+        else:
+            if (extra + len(data)) % 2:
+                data += b'\0'
+            entries.append(struct.pack(entryFormat, tag, code, count) +
+                           struct.pack(entryFormat[0] + entryFormat[-1],
+                                       extra + len(data)))
+            data += payload
+    return (struct.pack(countFormat, len(tags)) + b''.join(entries) +
+            struct.pack(nextFormat, nextIFD) + data)
+
+
+# Tags describing a tiled image, without the tile offsets and byte counts.
+def imageTags(image, compression, predictor, tile=TILE_SIZE,
+              description=None):
+    height, width = image.shape[:2]
+    samples = image.shape[2] if image.ndim == 3 else 1
+    bits = image.dtype.itemsize * 8
+    tags = [
+        (256, 'LONG', [width]),
+        (257, 'LONG', [height]),
+        (258, 'SHORT', [bits] * samples),
+        (259, 'SHORT', [compression]),
+        (262, 'SHORT', [2 if samples == 3 else 1]),
+        (277, 'SHORT', [samples]),
+        (284, 'SHORT', [1]),
+        (305, 'ASCII', SOFTWARE),
+        (322, 'LONG', [tile]),
+        (323, 'LONG', [tile]),
+    ]
+    if predictor:
+        tags.append((317, 'SHORT', [2]))
+    if description:
+        tags.append((270, 'ASCII', description))
+    return tags
+
+
+# Compression function for a TIFF compression name, or None when no
+# library available here can produce it tile by tile.
+def tileCompressor(compression, level=None):
+    if compression == 'none':
+        return lambda data: data
+    if compression == 'zlib':
+        level = 6 if level is None else level
+        return lambda data: zlib.compress(data, level)
+    if compression == 'zstd':
+        level = 3 if level is None else level
+        if zstandard is not None:
+            # Compressor objects are not thread safe, one per tile.
+            return lambda data: zstandard.ZstdCompressor(level).compress(data)
+        if imagecodecs is not None:
+            return lambda data: imagecodecs.zstd_encode(data, level)
+        return None
+    if compression == 'lzw':
+        if imagecodecs is not None:
+            return imagecodecs.lzw_encode
+        return None
+    raise ValueError("Unknown TIFF compression: %s" % compression)
+
+
+# Formats offered by the menus: a TIFF compression is only listed when a
+# library installed here can compress it tile by tile.
+EXPORT_FORMATS = collections.OrderedDict(
+    (f.name, f) for f in ALL_FORMATS
+    if f.kind != 'tiff' or tileCompressor(f.compression) is not None)
+
+
+# Tile at (y, x) of an image, padded with zeros to the full tile size, with
+# BGR turned into RGB and the horizontal predictor applied if asked.
+def extractTile(image, y, x, tile=TILE_SIZE, predictor=False):
+    block = image[y:y + tile, x:x + tile]
+    if image.ndim == 3:
+        out = np.zeros((tile, tile, image.shape[2]), image.dtype)
+        out[:block.shape[0], :block.shape[1]] = block[:, :, ::-1]
+    else:
+        out = np.zeros((tile, tile), image.dtype)
+        out[:block.shape[0], :block.shape[1]] = block
+    if predictor:
+        # Wrapping differences between neighbouring samples of each row.
+        out[:, 1:] -= out[:, :-1].copy()
+    return out.astype(out.dtype.newbyteorder('<'), copy=False).tobytes()
+
+
+class Exporter(object):
+    # threads: number of threads compressing TIFF tiles, by default one per
+    #          processor core.
+    def __init__(self, threads=None, tile=TILE_SIZE):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.tile = tile
+        self._pool = None
+        # The exporter is shared by the pipeline writer, the time lapse
+        # encoder and the GUI, only one of them may create the pool.
+        self._poolLock = threading.Lock()
+
+    def close(self):
+        with self._poolLock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def pool(self):
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+            return self._pool
+
+    # Writes "image" (BGR or single channel, 8 or 16 bits) to "fileName" in
+    # the format called "formatName" (see EXPORT_FORMATS). "level"
+    # overrides the level of the format. Returns an ExportResult; raises
+    # IOError if the file could not be written.
+    def write(self, image, fileName, formatName='TIFF', level=None):
+        with tracer.span('export', formatName):
+            return self._write(image, fileName, formatName, level)
+
+    def _write(self, image, fileName, formatName, level):
+        format = EXPORT_FORMATS[formatName]
+        if level is None:
+            level = format.level
+        start = time.time()
+        threads = 1
+        if format.kind == 'tiff':
+            threads = self.threads
+            self.writeTiff(image, fileName, format.compression,
+                           tileCompressor(format.compression, level))
+        elif format.kind == 'npy':
+            self.writeNpy(image, fileName)
+        elif format.kind == 'png':
+            self._imwrite(fileName, image,
+                          [cv2.IMWRITE_PNG_COMPRESSION, level])
+        elif format.kind == 'jpeg':
+            self._imwrite(fileName, image, [cv2.IMWRITE_JPEG_QUALITY, level])
+        else:
+            self._imwrite(fileName, image, [])
+        seconds = time.time() - start
+        return ExportResult(formatName, fileName, seconds, image.nbytes,
+                            os.path.getsize(fileName), threads)
+
+    @staticmethod
+    def writeNpy(image, fileName):
+        out = np.lib.format.open_memmap(fileName, 'w+', image.dtype,
+                                        image.shape)
+        out[...] = image
+        out.flush()
+        del out
+
+    @staticmethod
+    def _imwrite(fileName, image, params):
+        if not cv2.imwrite(fileName, image, params):
+            raise IOError("Could not write " + fileName)
+
+    # Compressed tiles of an image, in TIFF order. They are compressed by the
+    # pool and yielded as they come out, so they can be written meanwhile.
+    def encodeTiles(self, image, compressor, predictor):
+        tile = self.tile
+        height, width = image.shape[:2]
+        positions = [(y, x) for y in range(0, height, tile)
+                     for x in range(0, width, tile)]
+
+        def encode(position):
+            return compressor(extractTile(image, position[0], position[1],
+                                          tile, predictor))
+
+        return self.pool().imap(encode, positions, chunksize=4)
+
+    # Tiled TIFF: the tiles are written as they are compressed, in order;
+    # the directory goes at the end of the file.
+    def writeTiff(self, image, fileName, compression, compressor,
+                  description=None):
+        predictor = compression != 'none'
+        offsets = []
+        counts = []
+        with open(fileName, 'wb') as f:
+            f.write(b'II*\0' + struct.pack('<I', 0))
+            offset = 8
+            for data in self.encodeTiles(image, compressor, predictor):
+                f.write(data)
+                offsets.append(offset)
+                counts.append(len(data))
+                offset += len(data)
+            if offset % 2:
+                f.write(b'\0')
+                offset += 1
+            tags = imageTags(image, COMPRESSION_CODES[compression], predictor,
+                             self.tile, description)
+            tags += [(324, 'LONG', offsets), (325, 'LONG', counts)]
+            f.write(buildIFD(tags, offset))
+            f.seek(4)
+            f.write(struct.pack('<I', offset))
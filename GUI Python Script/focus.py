@@ -0,0 +1,146 @@
+## ======== FOCUS METRIC ======== ##
+
+# Sharpness score of the image, to focus the microscope on a number instead
+# of by eye.
+# Two classic metrics are offered:
+#   - 'laplacian': variance of the Laplacian of the image.
+#   - 'tenengrad': mean squared Sobel gradient magnitude.
+# Both grow as the sample comes into focus and peak at the best focus. Only a
+# region of interest (by default the central half of the frame) is scored,
+# converted to grey and downsampled first, so a video port frame takes well
+# under a millisecond and the score can follow the live preview. Every
+# intermediate image is kept between calls, nothing is allocated per frame.
+# FocusTracker keeps the latest score and the peak seen so far for the GUI;
+# measureFocus() reads frames from the video port and scores them, for
+# routines that move the focus and look for the peak.
+
+from __future__ import division
+
+import threading
+
+import cv2
+import numpy as np
+
+from clock import monotonic
+from hardware import rgbArray
+from livepreview import RateMeter
+
+METHODS = ('laplacian', 'tenengrad')
+# Fraction of the width and height of the frame scored, centred.
+ROI_FRACTION = 0.5
+# The region is reduced by this factor before scoring.
+DOWNSAMPLE = 2
+MEASURE_SIZE = (320, 240)
+
+
+class FocusMetric(object):
+    # method:     'laplacian' or 'tenengrad'.
+    # roi:        (x, y, width, height) in pixels of the frames, or None for
+    #             the central ROI_FRACTION of each frame.
+    # downsample: reduction factor of the region before scoring.
+    def __init__(self, method='laplacian', roi=None, downsample=DOWNSAMPLE):
+        if method not in METHODS:
+            raise ValueError("Unknown focus metric: %s" % method)
+        self.method = method
+        self.roi = roi
+        self.downsample = max(1, int(downsample))
+        self._shape = None
+
+    def region(self, shape):
+        height, width = shape[:2]
+        if self.roi is not None:
+            return self.roi
+        w = max(8, int(width * ROI_FRACTION))
+        h = max(8, int(height * ROI_FRACTION))
+        return (width - w) // 2, (height - h) // 2, w, h
+
+    # Buffers for frames of this shape, reallocated only when it changes.
+    def _allocate(self, shape):
+        x, y, w, h = self.region(shape)
+        self._region = (slice(y, y + h), slice(x, x + w))
+        self._gray = np.empty((h, w), np.uint8)
+        self._small = np.empty((max(1, h // self.downsample),
+                                max(1, w // self.downsample)), np.uint8)
+        self._dx = np.empty(self._small.shape, np.float32)
+        self._dy = np.empty(self._small.shape, np.float32)
+        self._shape = shape
+
+    # Score of a BGR (or grey) frame, higher is sharper.
+    def score(self, frame):
+        if frame.shape != self._shape:
+            self._allocate(frame.shape)
+        block = frame[self._region]
+        if frame.ndim == 3:
+            cv2.cvtColor(block, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        else:
+            self._gray[...] = block
+        small = self._small
+        cv2.resize(self._gray, (small.shape[1], small.shape[0]), dst=small,
+                   interpolation=cv2.INTER_AREA)
+        if self.method == 'laplacian':
+            cv2.Laplacian(small, cv2.CV_32F, dst=self._dx, ksize=3)
+            std = cv2.meanStdDev(self._dx)[1]
+            return float(std[0, 0] ** 2)
+        cv2.Sobel(small, cv2.CV_32F, 1, 0, dst=self._dx, ksize=3)
+        cv2.Sobel(small, cv2.CV_32F, 0, 1, dst=self._dy, ksize=3)
+        dx = self._dx.ravel()
+        dy = self._dy.ravel()
+        return float((np.dot(dx, dx) + np.dot(dy, dy)) / dx.size)
+
+
+# Latest score and peak so far, updated from the preview thread (see the
+# onFrame argument of VideoPortPreview) and read from the GUI.
+class FocusTracker(object):
+    def __init__(self, metric=None):
+        self.metric = metric or FocusMetric()
+        self.lock = threading.Lock()
+        self.rate = RateMeter()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.score = None
+            self.peak = None
+            self.peakTime = None
+
+    def update(self, frame):
+        score = self.metric.score(frame)
+        now = monotonic()
+        with self.lock:
+            self.score = score
+            if self.peak is None or score > self.peak:
+                self.peak = score
+                self.peakTime = now
+        self.rate.tick(now)
+        return score
+
+    # (score, peak), None before the first frame.
+    def values(self):
+        with self.lock:
+            return self.score, self.peak
+
+    def status(self):
+        score, peak = self.values()
+        if score is None:
+            return "Focus: -"
+        return "Focus %s %.1f  peak %.1f  (%.0f/s)" % (
+            self.metric.method, score, peak, self.rate.rate())
+
+
+# Scores "frames" consecutive video port frames of size "size" and returns
+# their mean score. The caller holds the camera lock, if there is one.
+def measureFocus(camera, metric=None, frames=3, size=MEASURE_SIZE):
+    metric = metric or FocusMetric()
+    output = rgbArray(camera, size=size)
+    stream = camera.capture_continuous(output, format='bgr',
+                                       use_video_port=True, resize=size)
+    scores = []
+    try:
+        for _ in stream:
+            scores.append(metric.score(output.array))
+            output.truncate(0)
+            if len(scores) >= frames:
+                break
+    finally:
+        stream.close()
+    return sum(scores) / len(scores)
@@ -0,0 +1,262 @@
+## ======== CAPTURE GALLERY ======== ##
+
+# Lists the images captured in a directory and makes their thumbnails
+# without holding up the GUI.
+# Captures are the stills and stacks of the GUI (image<N>.*, gc-image<N>.*,
+# composite<N>.*), the per-file time lapse images of acquire.py
+# (<name>-t0001-<channel>.*) and the OME-TIFF stacks (see stackwriter.py),
+# where every page (timepoint and channel) is a capture of its own.
+# Decoding a full resolution TIFF or PNG takes ~0.3 s on a desktop and much
+# longer on the Pi, so thumbnails are:
+#   - made by a pool of worker threads (OpenCV and zlib release the GIL),
+#     the most recently requested first, so the rows being looked at come
+#     before the ones scrolled past;
+#   - kept in memory in an LRU cache (see cache.py), up to MEMORY_CACHE
+#     bytes;
+#   - saved as small JPEGs under .thumbnails/, named after a hash of the
+#     path, modification time and page of the capture, so they survive a
+#     restart and a file that is overwritten gets a new one.
+# Full images are only read when asked for, with loadImage().
+
+from __future__ import division
+
+import hashlib
+import os
+import re
+import threading
+
+import cv2
+import numpy as np
+
+from cache import LRUCache
+from stackwriter import StackReader
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+THUMBNAIL_DIRECTORY = '.thumbnails'
+THUMBNAIL_SIZE = (128, 96)
+THUMBNAIL_QUALITY = 85
+MEMORY_CACHE = 32 << 20
+WORKERS = 2
+IMAGE_EXTENSIONS = ('.tiff', '.tif', '.png', '.jpeg', '.jpg', '.bmp', '.npy')
+CAPTURE_PATTERN = re.compile(
+    r'^((gc-)?image\d+|composite\d+|.+-t\d{4,}-[^.]+)[^.]*\.[a-z]+$',
+    re.IGNORECASE)
+STACK_SUFFIX = '.ome.tiff'
+
+
+# A captured image: a file, or a page (t, c) of a stack.
+class Capture(object):
+    def __init__(self, path, mtime, size, page=None, channel=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.page = page
+        self.channel = channel
+
+    @property
+    def key(self):
+        return (self.path, self.mtime, self.page)
+
+    @property
+    def name(self):
+        name = os.path.basename(self.path)
+        if self.page is None:
+            return name
+        return '%s t%d %s' % (name[:-len(STACK_SUFFIX)], self.page[0] + 1,
+                              self.channel or 'c%d' % self.page[1])
+
+
+# Pages of a stack as captures, in (t, c) order.
+def stackCaptures(path, mtime, size):
+    reader = StackReader(path)
+    try:
+        channels = reader.channels
+        return [Capture(path, mtime, size, (t, c),
+                        channels[c] if c < len(channels) else None)
+                for t, c in sorted(reader.pages)]
+    finally:
+        reader.close()
+
+
+# Captures in "directory", oldest first. Files that cannot be read (e.g. a
+# stack still being created) are left out.
+def listCaptures(directory='.'):
+    captures = []
+    for name in os.listdir(directory):
+        lower = name.lower()
+        isStack = lower.endswith(STACK_SUFFIX)
+        if not isStack and not (lower.endswith(IMAGE_EXTENSIONS) and
+                                CAPTURE_PATTERN.match(name)):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            info = os.stat(path)
+            if isStack:
+                captures.extend(stackCaptures(path, info.st_mtime,
+                                              info.st_size))
+            else:
+                captures.append(Capture(path, info.st_mtime, info.st_size))
+        except (IOError, OSError, ValueError):
+            continue
+    captures.sort(key=lambda capture: (capture.mtime, capture.path,
+                                       capture.page))
+    return captures
+
+
+# Full resolution image of a capture, BGR (or single plane) as written.
+# Raw .npy files are memory mapped.
+def loadImage(capture):
+    if capture.page is not None:
+        reader = StackReader(capture.path)
+        try:
+            return reader.read(*capture.page)
+        finally:
+            reader.close()
+    if capture.path.lower().endswith('.npy'):
+        return np.load(capture.path, mmap_mode='r')
+    image = cv2.imread(capture.path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError("Could not read %s" % capture.path)
+    return image
+
+
+# Significant bits of an image: 8, or those of the largest value of a 16-bit
+# one (raw data uses 10 of them).
+def imageBits(image):
+    if image.dtype == np.uint8:
+        return 8
+    return max(8, int(image.max()).bit_length())
+
+
+# "image" reduced to fit in "size" (width, height), 8-bit BGR.
+def makeThumbnail(image, size=THUMBNAIL_SIZE):
+    height, width = image.shape[:2]
+    scale = min(size[0] / width, size[1] / height, 1)
+    small = cv2.resize(np.asarray(image), (max(1, int(width * scale)),
+                                           max(1, int(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    if small.dtype != np.uint8:
+        small = cv2.convertScaleAbs(
+            small, alpha=255.0 / ((1 << imageBits(small)) - 1))
+    if small.ndim == 2:
+        small = cv2.cvtColor(small, cv2.COLOR_GRAY2BGR)
+    return small
+
+
+# Reads only what a thumbnail needs where the codec allows it: JPEGs are
+# decoded at 1/8 of their size.
+def decodeThumbnail(capture, size=THUMBNAIL_SIZE):
+    if capture.page is None and \
+            capture.path.lower().endswith(('.jpeg', '.jpg')):
+        image = cv2.imread(capture.path, cv2.IMREAD_REDUCED_COLOR_8)
+        if image is not None:
+            return makeThumbnail(image, size)
+    return makeThumbnail(loadImage(capture), size)
+
+
+class ThumbnailCache(object):
+    # directory:   where the thumbnails are saved, None to keep them in
+    #              memory only.
+    # memoryBytes: size of the in-memory cache.
+    # workers:     number of decoding threads.
+    def __init__(self, directory=THUMBNAIL_DIRECTORY, size=THUMBNAIL_SIZE,
+                 memoryBytes=MEMORY_CACHE, workers=WORKERS):
+        self.directory = directory
+        self.size = size
+        self.memory = LRUCache(memoryBytes, size=lambda image: image.nbytes)
+        # Most recent request first.
+        self.requests = queue.LifoQueue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.decoded = 0
+        self.fromDisk = 0
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _fileName(self, capture):
+        digest = hashlib.sha1(repr((os.path.abspath(capture.path),
+                                    capture.mtime, capture.page,
+                                    self.size)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.jpeg')
+
+    def _readDisk(self, capture):
+        if self.directory is None:
+            return None
+        fileName = self._fileName(capture)
+        if not os.path.exists(fileName):
+            return None
+        return cv2.imread(fileName, cv2.IMREAD_COLOR)
+
+    def _writeDisk(self, capture, thumbnail):
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Made by another worker in the meantime.
+                pass
+        ok, data = cv2.imencode('.jpeg', thumbnail,
+                                [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        if not ok:
+            return
+        fileName = self._fileName(capture)
+        with open(fileName + '.part', 'wb') as f:
+            f.write(data.tobytes())
+        os.rename(fileName + '.part', fileName)
+
+    # Thumbnail of a capture (BGR uint8) if it is in memory, otherwise None
+    # and callback(capture, thumbnail) is called from a worker thread once
+    # it is ready (thumbnail is None if the file could not be read).
+    def request(self, capture, callback):
+        thumbnail = self.memory.get(capture.key)
+        if thumbnail is not None:
+            return thumbnail
+        with self.lock:
+            if capture.key in self.pending:
+                return None
+            self.pending.add(capture.key)
+        self.requests.put((capture, callback))
+        return None
+
+    # Forgets the requests not started yet, e.g. when the gallery scrolls
+    # away from them.
+    def cancel(self):
+        while True:
+            try:
+                capture, callback = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.pending.discard(capture.key)
+
+    def _work(self):
+        while True:
+            capture, callback = self.requests.get()
+            try:
+                thumbnail = self._readDisk(capture)
+                if thumbnail is not None:
+                    self.fromDisk += 1
+                else:
+                    thumbnail = decodeThumbnail(capture, self.size)
+                    self.decoded += 1
+                    self._writeDisk(capture, thumbnail)
+                self.memory.put(capture.key, thumbnail)
+            except Exception as e:
+                print("Thumbnail of %s failed: %s" % (capture.name, e))
+                thumbnail = None
+            with self.lock:
+                self.pending.discard(capture.key)
+            callback(capture, thumbnail)
+
+    def stats(self):
+        return "%d decoded, %d from disk, memory %s" % (
+            self.decoded, self.fromDisk, self.memory.stats())
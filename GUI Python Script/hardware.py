@@ -0,0 +1,553 @@
+## ======== HARDWARE BACKEND ======== ##
+
+# Camera and LED (GPIO) backend of the microscope.
+# openHardware() returns the camera and GPIO objects used by the GUI and the
+# acquisition modules: on the Raspberry Pi they are picamera.PiCamera and
+# RPi.GPIO; anywhere else (or when MICROSCOPE_BACKEND=sim) they are the
+# simulated implementations below, so the capture, time lapse and processing
+# code can be run, benchmarked and tested on an ordinary Linux computer.
+# The simulated camera has the properties and capture calls used by this
+# program (resolution, framerate, shutter_speed, iso, awb_gains, exposure
+# mode, capture, capture_continuous, capture_sequence, previews, Bayer data)
+# and produces a deterministic synthetic sample: the same cells at every
+# resolution, a fixed noise pattern that only depends on the seed and the
+# number of frames taken, and an illumination that follows the LED pins that
+# are on (brightfield or one of the fluorescence colours). The exposure time
+# and ISO scale the signal. Sensor latencies are configurable and can be
+# turned off to measure only the processing code.
+# The remaining image settings (brightness, contrast, effects, flips...) are
+# stored but do not change the synthetic image.
+
+from __future__ import division
+
+import collections
+import os
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from bufferpool import paddedShape
+from clock import monotonic
+from rawcapture import HEADER_SIZE, RAW_BITS, RAW_BLOCK_SIZES, packRaw10
+
+BACKEND_VARIABLE = 'MICROSCOPE_BACKEND'
+
+SENSOR_RESOLUTIONS = {
+    'IMX219': (3280, 2464),
+    'OV5647': (2592, 1944),
+}
+BAYER_ORDER = 2    # BGGR, see rawcapture.BAYER_OFFSETS
+# GPIO (BCM) pins of the LEDs, per channel: brightfield (white LED) and the
+# excitation of the green (blue LED), blue (UV LED) and red (green-amber LED)
+# fluorescence.
+LED_PINS = collections.OrderedDict([
+    ('BrFld', 18),
+    ('Green', 24),
+    ('Blue', 23),
+    ('Red', 25),
+])
+# Light each LED pin switches on in the simulation, with the exposure (in
+# microseconds, at ISO 100) that fills the synthetic sample to its nominal
+# brightness.
+DEFAULT_LIGHTS = {
+    LED_PINS['BrFld']: ('brightfield', 10000),
+    LED_PINS['Green']: ('green', 1000000),
+    LED_PINS['Blue']: ('blue', 1000000),
+    LED_PINS['Red']: ('red', 1000000),
+}
+# Emission colour (BGR) of the fluorescence channels and the fraction of the
+# cells they label.
+FLUORESCENCE = {
+    'green': ((40, 230, 60), 1.0),
+    'blue': ((230, 120, 40), 1.0),
+    'red': ((30, 50, 220), 0.4),
+}
+AUTO_AWB_GAINS = (1.5, 1.5)
+STILL_LATENCY = 0.3
+NOISE_MARGIN = 64
+NOISE_LEVEL = 16
+SAMPLE_CACHE_SIZE = 4
+
+
+## ======== SIMULATED GPIO ======== ##
+
+# Drop-in replacement of the RPi.GPIO module functions used by the program.
+# Every output change is recorded in "events" as (time, pin, value).
+class SimulatedGPIO(object):
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, history=1000):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.warnings = True
+        self.directions = {}
+        self.levels = {}
+        self.events = collections.deque(maxlen=history)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def setwarnings(self, flag):
+        self.warnings = flag
+
+    def setup(self, channels, direction, pull_up_down=None, initial=None):
+        if self.mode is None:
+            raise RuntimeError("Please set pin numbering mode using "
+                               "GPIO.setmode(GPIO.BOARD) or "
+                               "GPIO.setmode(GPIO.BCM)")
+        for channel in self._channels(channels):
+            with self.lock:
+                self.directions[channel] = direction
+                self.levels.setdefault(channel, self.LOW)
+            if direction == self.OUT and initial is not None:
+                self.output(channel, initial)
+
+    def output(self, channels, values):
+        channels = self._channels(channels)
+        if not isinstance(values, (list, tuple)):
+            values = [values] * len(channels)
+        now = monotonic()
+        with self.lock:
+            for channel, value in zip(channels, values):
+                if self.directions.get(channel) != self.OUT:
+                    raise RuntimeError("The GPIO channel has not been set up "
+                                       "as an OUTPUT")
+                value = self.HIGH if value else self.LOW
+                self.levels[channel] = value
+                self.events.append((now, channel, value))
+
+    def input(self, channel):
+        with self.lock:
+            if channel not in self.directions:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            return self.levels[channel]
+
+    def cleanup(self, channels=None):
+        with self.lock:
+            if channels is None:
+                self.directions.clear()
+                self.levels.clear()
+                self.mode = None
+                return
+            for channel in self._channels(channels):
+                self.directions.pop(channel, None)
+                self.levels.pop(channel, None)
+
+    # Pins currently high, in order.
+    def lit(self):
+        with self.lock:
+            return sorted(channel for channel, value in self.levels.items()
+                          if value == self.HIGH and
+                          self.directions.get(channel) == self.OUT)
+
+    @staticmethod
+    def _channels(channels):
+        if isinstance(channels, (list, tuple)):
+            return list(channels)
+        return [channels]
+
+
+## ======== SIMULATED CAMERA ======== ##
+
+# Cells of the synthetic sample, in coordinates relative to the field of
+# view so that every resolution shows the same sample:
+# (x, y, half width, half height, angle, nucleus size, labelled fraction).
+def sampleCells(seed=0, count=160):
+    rng = np.random.RandomState(seed)
+    cells = []
+    for _ in range(count):
+        size = rng.uniform(0.008, 0.025)
+        cells.append((rng.uniform(0, 1), rng.uniform(0, 1),
+                      size * rng.uniform(1.0, 1.8), size,
+                      rng.uniform(0, 180), rng.uniform(0.3, 0.5),
+                      rng.uniform(0, 1)))
+    return cells
+
+
+# Draws the noiseless sample at "resolution" for a light ('brightfield', one
+# of FLUORESCENCE or 'dark'), as a BGR uint8 image.
+def renderSample(cells, resolution, light):
+    width, height = resolution
+    if light == 'dark':
+        return np.zeros((height, width, 3), np.uint8)
+    scale = min(width, height)
+    if light == 'brightfield':
+        # Transmitted light with some vignetting; cells absorb it.
+        y, x = np.ogrid[-1:1:height * 1j, -1:1:width * 1j]
+        shade = 1.0 - 0.25 * (x * x + y * y)
+        image = np.empty((height, width, 3), np.uint8)
+        image[...] = (np.multiply.outer(shade, (205, 210, 200))
+                      .astype(np.uint8))
+    else:
+        image = np.zeros((height, width, 3), np.uint8)
+        colour, labelled = FLUORESCENCE[light]
+    for x, y, a, b, angle, nucleus, label in cells:
+        centre = (int(x * width), int(y * height))
+        axes = (max(1, int(a * scale)), max(1, int(b * scale)))
+        inner = (max(1, int(a * scale * nucleus)),
+                 max(1, int(b * scale * nucleus)))
+        if light == 'brightfield':
+            cv2.ellipse(image, centre, axes, angle, 0, 360, (120, 135, 125),
+                        -1, cv2.LINE_AA)
+            cv2.ellipse(image, centre, inner, angle, 0, 360, (80, 90, 95),
+                        -1, cv2.LINE_AA)
+        elif light == 'blue':
+            # Nuclear stain.
+            cv2.ellipse(image, centre, inner, angle, 0, 360, colour, -1,
+                        cv2.LINE_AA)
+        elif label < labelled:
+            dim = tuple(int(c * 0.6) for c in colour)
+            cv2.ellipse(image, centre, axes, angle, 0, 360, dim, -1,
+                        cv2.LINE_AA)
+            cv2.ellipse(image, centre, inner, angle, 0, 360, colour, -1,
+                        cv2.LINE_AA)
+    blur = max(1, scale // 400) * 2 + 1
+    return cv2.GaussianBlur(image, (blur, blur), 0)
+
+
+# Output object for video port captures, with the interface of
+# picamera.array.PiRGBArray used by this program (array and truncate()).
+class SimulatedRGBArray(object):
+    def __init__(self, size=None):
+        self.size = size
+        self.array = None
+
+    def write(self, frame):
+        # Like PiRGBArray, every frame gets a new array, so a consumer can
+        # keep the previous one.
+        self.array = frame.copy()
+
+    def truncate(self, size=None):
+        pass
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def close(self):
+        self.array = None
+
+
+# Video port output for "camera": PiRGBArray on the Raspberry Pi, a
+# SimulatedRGBArray for the simulated camera.
+def rgbArray(camera, size=None):
+    if isinstance(camera, SimulatedCamera):
+        return SimulatedRGBArray(size)
+    import picamera.array
+    return picamera.array.PiRGBArray(camera, size=size)
+
+
+class SimulatedCamera(object):
+    # gpio:         SimulatedGPIO whose LED pins light the sample; without
+    #               it the sample is always seen in brightfield.
+    # lights:       {pin: (light, nominal exposure)}, see DEFAULT_LIGHTS.
+    # sensor:       'IMX219' (camera v2) or 'OV5647' (camera v1).
+    # seed:         seed of the sample and of the noise pattern.
+    # stillLatency: seconds taken by a still capture besides the exposure
+    #               (mode switch, ISP and encoder on the real camera).
+    # frameInterval: seconds between video port frames, None to follow the
+    #               framerate.
+    # timeScale:    multiplies every simulated delay, 0 captures as fast as
+    #               the computer can synthesize the frames.
+    def __init__(self, gpio=None, lights=None, sensor='IMX219', seed=0,
+                 stillLatency=STILL_LATENCY, frameInterval=None,
+                 timeScale=1.0):
+        self.gpio = gpio
+        self.lights = DEFAULT_LIGHTS if lights is None else lights
+        self.sensor = sensor
+        self.sensorResolution = SENSOR_RESOLUTIONS[sensor]
+        self.seed = seed
+        self.stillLatency = stillLatency
+        self.frameInterval = frameInterval
+        self.timeScale = timeScale
+        self.cells = sampleCells(seed)
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.closed = False
+        self.previewing = False
+        self._samples = collections.OrderedDict()
+        self._noise = None
+        self._lastFrame = None
+        # picamera settings and their defaults.
+        self.resolution = (1280, 720)
+        self.framerate = 30
+        self.shutter_speed = 0
+        self.iso = 0
+        self.awb_mode = 'auto'
+        self._awb_gains = AUTO_AWB_GAINS
+        self.exposure_mode = 'auto'
+        self.brightness = 50
+        self.contrast = 0
+        self.saturation = 0
+        self.sharpness = 0
+        self.image_effect = 'none'
+        self.rotation = 0
+        self.hflip = False
+        self.vflip = False
+        self.video_stabilization = False
+        self.preview_fullscreen = True
+        self.preview_window = None
+        self.analog_gain = 1.0
+        self.digital_gain = 1.0
+
+    def _get_resolution(self):
+        return self._resolution
+
+    def _set_resolution(self, value):
+        width, height = (int(v) for v in value)
+        self._resolution = (width, height)
+
+    resolution = property(_get_resolution, _set_resolution)
+
+    # Like picamera, the gains can only be read back once they are set.
+    def _get_awb_gains(self):
+        return self._awb_gains
+
+    def _set_awb_gains(self, value):
+        if isinstance(value, (int, float)):
+            value = (value, value)
+        self._awb_gains = (float(value[0]), float(value[1]))
+
+    awb_gains = property(_get_awb_gains, _set_awb_gains)
+
+    # Exposure time actually used, in microseconds: limited by the frame
+    # period, and fixed by the auto exposure when shutter_speed is 0.
+    @property
+    def exposure_speed(self):
+        period = 1e6 / float(self.framerate)
+        if self.shutter_speed:
+            return int(min(self.shutter_speed, period))
+        light, nominal = self._light()
+        return int(min(nominal, period))
+
+    def start_preview(self, **options):
+        self._check()
+        self.previewing = True
+
+    def stop_preview(self):
+        self.previewing = False
+
+    def close(self):
+        self.previewing = False
+        self.closed = True
+        self._samples.clear()
+        self._noise = None
+
+    def _check(self):
+        if self.closed:
+            raise RuntimeError("Camera is closed")
+
+    # Light on the sample and its nominal exposure.
+    def _light(self):
+        if self.gpio is None:
+            return DEFAULT_LIGHTS[LED_PINS['BrFld']]
+        for pin in self.gpio.lit():
+            if pin in self.lights:
+                return self.lights[pin]
+        return 'dark', float('inf')
+
+    # Noiseless sample for a resolution and light, rendered once.
+    def _sample(self, resolution, light):
+        key = (resolution, light)
+        sample = self._samples.pop(key, None)
+        if sample is None:
+            sample = renderSample(self.cells, resolution, light)
+        self._samples[key] = sample
+        while len(self._samples) > SAMPLE_CACHE_SIZE:
+            self._samples.popitem(last=False)
+        return sample
+
+    # Fixed noise pattern, larger than the sensor so that every frame reads
+    # it at a different offset; smaller frames read a part of it.
+    def _noisePattern(self, resolution):
+        width, height = resolution
+        noise = self._noise
+        if noise is None or noise.shape[0] < height + NOISE_MARGIN or \
+                noise.shape[1] < width + NOISE_MARGIN:
+            width = max(width, self.sensorResolution[0])
+            height = max(height, self.sensorResolution[1])
+            rng = np.random.RandomState(self.seed + 1)
+            noise = rng.randint(0, NOISE_LEVEL + 1,
+                                (height + NOISE_MARGIN,
+                                 width + NOISE_MARGIN, 3)).astype(np.uint8)
+            self._noise = noise
+        return noise
+
+    # Synthesizes the next frame at "resolution" with the current settings.
+    def _render(self, resolution):
+        light, nominal = self._light()
+        sample = self._sample(resolution, light)
+        if self.shutter_speed:
+            gain = self.exposure_speed / nominal * (self.iso or 100) / 100
+        else:
+            gain = 1.0
+        if self.awb_mode == 'off':
+            red, blue = self._awb_gains
+            scale = (blue / AUTO_AWB_GAINS[1], 1.0, red / AUTO_AWB_GAINS[0],
+                     0)
+        else:
+            scale = (1.0, 1.0, 1.0, 0)
+        frame = cv2.multiply(sample, scale, scale=gain)
+        width, height = resolution
+        n = self.frames
+        self.frames += 1
+        dy = (n * 7) % NOISE_MARGIN
+        dx = (n * 13) % NOISE_MARGIN
+        noise = self._noisePattern(resolution)[dy:dy + height, dx:dx + width]
+        cv2.subtract(frame, NOISE_LEVEL // 2, dst=frame)
+        cv2.add(frame, noise, dst=frame)
+        return frame
+
+    def _wait(self, seconds):
+        seconds *= self.timeScale
+        if seconds > 0:
+            time.sleep(seconds)
+
+    # Paces the video port frames.
+    def _waitFrame(self):
+        interval = self.frameInterval
+        if interval is None:
+            interval = max(1.0 / float(self.framerate),
+                           self.exposure_speed / 1e6)
+        interval *= self.timeScale
+        now = monotonic()
+        if self._lastFrame is not None:
+            delay = self._lastFrame + interval - now
+            if delay > 0:
+                time.sleep(delay)
+                now += delay
+        self._lastFrame = now
+
+    # Bayer data appended to a JPEG with bayer=True: the BRCM header and the
+    # 10-bit mosaic of the full sensor, in the layout read by rawcapture.py.
+    def _rawBlock(self):
+        width, height = self.sensorResolution
+        frame = self._render(self.sensorResolution)
+        noise = self._noisePattern(self.sensorResolution)
+        bayer = np.empty((height, width), np.uint16)
+        # BGGR: blue, green / green, red.
+        bayer[0::2, 0::2] = frame[0::2, 0::2, 0]
+        bayer[0::2, 1::2] = frame[0::2, 1::2, 1]
+        bayer[1::2, 0::2] = frame[1::2, 0::2, 1]
+        bayer[1::2, 1::2] = frame[1::2, 1::2, 2]
+        bayer <<= RAW_BITS - 8
+        bayer |= noise[:height, :width, 0] & 3
+        stride = ((width * 5 // 4 + 31) // 32) * 32
+        rows = (RAW_BLOCK_SIZES[self.sensor] - HEADER_SIZE) // stride
+        header = bytearray(HEADER_SIZE)
+        header[0:4] = b'BRCM'
+        struct.pack_into('<HH', header, 176 + 32, width, height)
+        struct.pack_into('<B', header, 176 + 68, BAYER_ORDER)
+        return bytes(header) + packRaw10(bayer, stride, rows).tobytes()
+
+    # Writes a frame to a picamera output: a file name, a file-like object,
+    # a NumPy array (padded like the GPU buffers) or an RGB array output.
+    def _write(self, output, frame, format, bayer=False):
+        if format is None:
+            if not isinstance(output, str):
+                raise ValueError("Unable to determine the format")
+            format = os.path.splitext(output)[1][1:].lower()
+        format = {'jpg': 'jpeg', 'tif': 'tiff'}.get(format, format)
+        if isinstance(output, np.ndarray):
+            if format not in ('bgr', 'rgb'):
+                raise ValueError("Arrays only accept bgr or rgb data")
+            self._writeArray(output, frame, format)
+            return
+        if format in ('bgr', 'rgb'):
+            if format == 'rgb':
+                frame = frame[:, :, ::-1]
+            if hasattr(output, 'array'):
+                output.write(frame)
+                return
+            data = np.zeros(paddedShape((frame.shape[1], frame.shape[0])),
+                            np.uint8)
+            data[:frame.shape[0], :frame.shape[1]] = frame
+            data = data.tobytes()
+        else:
+            ok, encoded = cv2.imencode('.' + format, frame)
+            if not ok:
+                raise ValueError("Unsupported format: %s" % format)
+            data = encoded.tobytes()
+            if bayer and format == 'jpeg':
+                data += self._rawBlock()
+        if isinstance(output, str):
+            with open(output, 'wb') as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    @staticmethod
+    def _writeArray(output, frame, format):
+        height, width = frame.shape[:2]
+        shape = paddedShape((width, height))
+        if output.dtype != np.uint8 or output.size < int(np.prod(shape)):
+            raise ValueError("Output array too small for %dx%d" %
+                             (width, height))
+        if output.ndim == 3 and output.shape[0] >= height and \
+                output.shape[1] >= width:
+            view = output
+        else:
+            view = output.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+        if format == 'rgb':
+            frame = frame[:, :, ::-1]
+        view[:height, :width] = frame
+
+    def capture(self, output, format=None, use_video_port=False, resize=None,
+                bayer=False, **options):
+        self._check()
+        with self.lock:
+            if use_video_port:
+                self._waitFrame()
+            else:
+                self._wait(self.stillLatency + self.exposure_speed / 1e6)
+            frame = self._render(tuple(resize or self.resolution))
+            self._write(output, frame, format, bayer and not use_video_port)
+
+    def capture_continuous(self, output, format=None, use_video_port=False,
+                           resize=None, **options):
+        while True:
+            self.capture(output, format, use_video_port, resize)
+            yield output
+
+    def capture_sequence(self, outputs, format='jpeg', use_video_port=False,
+                         resize=None, **options):
+        for output in outputs:
+            self.capture(output, format, use_video_port, resize)
+
+
+## ======== BACKEND SELECTION ======== ##
+
+# Returns (camera, gpio). backend is 'picamera', 'sim' or 'auto' (picamera
+# when it can be imported, the simulation otherwise); by default it is read
+# from the MICROSCOPE_BACKEND environment variable. Options are passed to
+# SimulatedCamera.
+def openHardware(backend=None, **options):
+    backend = backend or os.environ.get(BACKEND_VARIABLE, 'auto')
+    if backend not in ('auto', 'picamera', 'sim'):
+        raise ValueError("Unknown hardware backend: %s" % backend)
+    if backend != 'sim':
+        try:
+            import picamera
+            import RPi.GPIO as GPIO
+        except ImportError:
+            if backend == 'picamera':
+                raise
+            print("picamera or RPi.GPIO not available, using the simulated "
+                  "camera")
+        else:
+            return picamera.PiCamera(), GPIO
+    gpio = SimulatedGPIO()
+    return SimulatedCamera(gpio, **options), gpio
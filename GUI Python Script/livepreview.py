@@ -0,0 +1,150 @@
+## ======== LIVE PREVIEW ======== ##
+
+# Live preview drawn inside the GUI canvas instead of the GPU overlay.
+# Small frames are read continuously from the video port of the camera on a
+# background thread. Only the most recent frame is kept: if the GUI is slower
+# than the camera the older frames are dropped instead of queued, so what is
+# shown is never behind the sample.
+# The preview measures the frames per second that reach the screen, the
+# frames dropped and the latency between the arrival of a frame from the
+# camera and the moment it is displayed.
+# The preview steps aside (closes the video port stream and releases the
+# camera lock) whenever a capture is waiting for the camera, and resumes
+# once it is done.
+
+from __future__ import division
+
+import collections
+import threading
+
+from clock import monotonic
+from hardware import rgbArray
+
+PREVIEW_SIZE = (510, 384)
+# Sensor mode used while previewing (2x2 binned, full field of view). Still
+# captures set the full resolution back before reading the sensor.
+PREVIEW_RESOLUTION = (1640, 1232)
+
+
+# Single slot buffer where the newest frame replaces the previous one.
+class LatestFrame(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.timestamp = None
+        self.sequence = 0
+        self.taken = 0
+        self.dropped = 0
+
+    def put(self, frame, timestamp):
+        with self.lock:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.timestamp = timestamp
+            self.sequence += 1
+
+    # Returns (frame, timestamp, sequence) of the newest frame not taken yet,
+    # or None.
+    def take(self):
+        with self.lock:
+            if self.frame is None:
+                return None
+            item = (self.frame, self.timestamp, self.sequence)
+            self.frame = None
+            self.taken += 1
+            return item
+
+
+# Events per second over a sliding window of the last events.
+class RateMeter(object):
+    def __init__(self, window=30):
+        self.times = collections.deque(maxlen=window)
+
+    def tick(self, now=None):
+        self.times.append(monotonic() if now is None else now)
+
+    def rate(self):
+        if len(self.times) < 2 or self.times[-1] == self.times[0]:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class VideoPortPreview(threading.Thread):
+    # camera:     PiCamera (or compatible) object.
+    # cameraLock: CameraLock shared with the capture pipeline.
+    # size:       (width, height) of the frames, normally the canvas size.
+    # onFrame:    optional, called on the preview thread with every frame;
+    #             it must be fast (e.g. a focus metric on a small region).
+    def __init__(self, camera, cameraLock, size=PREVIEW_SIZE,
+                 resolution=PREVIEW_RESOLUTION, onFrame=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.camera = camera
+        self.cameraLock = cameraLock
+        self.size = size
+        self.resolution = resolution
+        self.onFrame = onFrame
+        self.latest = LatestFrame()
+        self.captureRate = RateMeter()
+        self.displayRate = RateMeter()
+        self.latency = collections.deque(maxlen=30)
+        self._shownTimestamp = None
+        self.error = None
+        self.stopEvent = threading.Event()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        try:
+            while not self.stopEvent.is_set():
+                with self.cameraLock:
+                    self._stream()
+                # Leave the camera to whoever asked for it.
+                self.stopEvent.wait(0.01)
+        except Exception as e:
+            self.error = e
+
+    # Reads frames until the preview is stopped or the camera is wanted by
+    # another thread.
+    def _stream(self):
+        if self.camera.resolution != self.resolution:
+            self.camera.resolution = self.resolution
+        output = rgbArray(self.camera, size=self.size)
+        stream = self.camera.capture_continuous(output, format='bgr',
+                                                use_video_port=True,
+                                                resize=self.size)
+        try:
+            for _ in stream:
+                now = monotonic()
+                frame = output.array
+                output.truncate(0)
+                self.captureRate.tick(now)
+                if self.onFrame is not None:
+                    self.onFrame(frame)
+                self.latest.put(frame, now)
+                if self.stopEvent.is_set() or self.cameraLock.wanted():
+                    return
+        finally:
+            stream.close()
+
+    # Called by the GUI when it is ready to draw: returns the newest BGR frame
+    # (or None if there is nothing new) and updates the display statistics.
+    # The latency is measured once the frame has been drawn, see displayed().
+    def poll(self):
+        item = self.latest.take()
+        if item is None:
+            return None
+        self._shownTimestamp = item[1]
+        return item[0]
+
+    def displayed(self):
+        now = monotonic()
+        self.displayRate.tick(now)
+        self.latency.append(now - self._shownTimestamp)
+
+    def status(self):
+        latency = sum(self.latency) / len(self.latency) if self.latency else 0
+        return "%4.1f fps  latency %3.0f ms  dropped %d" % (
+            self.displayRate.rate(), latency * 1000, self.latest.dropped)
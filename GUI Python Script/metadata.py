@@ -0,0 +1,338 @@
+## ======== CAPTURE METADATA ======== ##
+
+# Records the camera settings and the illumination of every capture, so an
+# image can be reproduced and thousands of time lapse frames filtered without
+# opening them.
+# The state of the camera (exposure, gains, ISO, white balance, brightness...)
+# is read right after each capture, while the camera lock is still held, and
+# kept with the file name, the channel and its LED pin. Each record goes to:
+#   - a SQLite index (captures.sqlite next to the images), one row per
+#     capture with the fields used to search as columns and the whole record
+#     as JSON. Rows are inserted by a thread of their own in batches (one
+#     transaction per BATCH_SIZE records or FLUSH_INTERVAL seconds), so the
+#     capture and writer threads never wait for the SD card to sync;
+#   - a JSON sidecar next to single image files (<file>.json). Pages of an
+#     OME-TIFF stack only go to the index.
+# Queries such as "Green frames of the last hour exposed longer than 500 ms"
+# use the (channel, timestamp) index and take milliseconds:
+#     python metadata.py captures.sqlite --channel Green --min-exposure 500
+# The database is in WAL mode, so it can be queried while it is written.
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from fractions import Fraction
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+INDEX_FILE = 'captures.sqlite'
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 2.0
+# Camera properties recorded, as named by picamera.
+CAMERA_PROPERTIES = ('shutter_speed', 'exposure_speed', 'exposure_mode',
+                     'iso', 'analog_gain', 'digital_gain', 'awb_mode',
+                     'awb_gains', 'brightness', 'contrast', 'saturation',
+                     'sharpness', 'framerate', 'resolution', 'image_effect',
+                     'hflip', 'vflip', 'rotation')
+# Columns of the index besides the JSON record, in order.
+COLUMNS = ('file', 't', 'c', 'channel', 'led', 'timestamp', 'shutter_speed',
+           'exposure_speed', 'iso', 'analog_gain', 'digital_gain', 'awb_red',
+           'awb_blue', 'brightness', 'width', 'height', 'bits')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    t INTEGER,
+    c INTEGER,
+    channel TEXT,
+    led INTEGER,
+    timestamp REAL NOT NULL,
+    shutter_speed INTEGER,
+    exposure_speed INTEGER,
+    iso INTEGER,
+    analog_gain REAL,
+    digital_gain REAL,
+    awb_red REAL,
+    awb_blue REAL,
+    brightness INTEGER,
+    width INTEGER,
+    height INTEGER,
+    bits INTEGER,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS captures_channel ON captures (channel, timestamp);
+CREATE INDEX IF NOT EXISTS captures_timestamp ON captures (timestamp);
+CREATE INDEX IF NOT EXISTS captures_file ON captures (file, t, c);
+"""
+
+
+# picamera returns Fractions (gains, framerate) and tuples; JSON and SQLite
+# take floats and lists.
+def plainValue(value):
+    if isinstance(value, Fraction):
+        return float(value)
+    if isinstance(value, (tuple, list)):
+        return [plainValue(v) for v in value]
+    return value
+
+
+# Settings of the camera right now, with the time they were read. Call it
+# right after the capture, with the camera lock held.
+def cameraState(camera):
+    state = {'timestamp': time.time()}
+    for name in CAMERA_PROPERTIES:
+        try:
+            state[name] = plainValue(getattr(camera, name))
+        except Exception:
+            # Not supported by this camera (or backend).
+            continue
+    return state
+
+
+# Record of a capture: the file (and page (t, c) of a stack), the image
+# size, the channel and LED, and the camera state from cameraState().
+def captureRecord(fileName, image, state, channel=None, led=None, page=None,
+                  bits=8):
+    record = dict(state)
+    record.update({
+        'file': fileName,
+        'channel': channel,
+        'led': led,
+        'width': image.shape[1],
+        'height': image.shape[0],
+        'dtype': str(image.dtype),
+        'bits': bits,
+    })
+    if page is not None:
+        record['t'], record['c'] = page
+    return record
+
+
+def sidecarFileName(fileName):
+    return fileName + '.json'
+
+
+def writeSidecar(record):
+    fileName = sidecarFileName(record['file'])
+    with open(fileName + '.part', 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.rename(fileName + '.part', fileName)
+
+
+def _row(record):
+    awb = record.get('awb_gains') or (None, None)
+    values = dict(record, awb_red=awb[0], awb_blue=awb[1])
+    return tuple(values.get(name) for name in COLUMNS) + (
+        json.dumps(record, sort_keys=True),)
+
+
+class MetadataIndex(object):
+    # path:      SQLite file, created if needed.
+    # sidecars:  also write <file>.json next to single image files.
+    # batchSize, flushInterval: records inserted per transaction, and the
+    #            longest time a record waits for one.
+    def __init__(self, path=INDEX_FILE, sidecars=True, batchSize=BATCH_SIZE,
+                 flushInterval=FLUSH_INTERVAL):
+        self.path = path
+        self.sidecars = sidecars
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.records = queue.Queue()
+        self.written = 0
+        self.error = None
+        self._local = threading.local()
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        self._thread = threading.Thread(target=self._writerLoop,
+                                        name="metadata-index")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    # Connection of the calling thread, for queries (SQLite connections
+    # cannot be shared between threads).
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    # Queues a record from captureRecord(); never blocks.
+    def add(self, record):
+        self.records.put(record)
+
+    # Waits until every record added so far is in the database.
+    def flush(self):
+        done = threading.Event()
+        self.records.put(done)
+        done.wait()
+
+    # Writes what is queued and stops the writer thread.
+    def close(self):
+        self.records.put(None)
+        self._thread.join()
+
+    def _insert(self, connection, batch):
+        try:
+            connection.executemany(
+                'INSERT INTO captures (%s, record) VALUES (%s)' % (
+                    ', '.join(COLUMNS), ', '.join('?' * (len(COLUMNS) + 1))),
+                [_row(record) for record in batch])
+            connection.commit()
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self.error = e
+            print("Metadata index: %d records lost, %s" % (len(batch), e))
+        if self.sidecars:
+            for record in batch:
+                if 't' in record:
+                    continue
+                try:
+                    writeSidecar(record)
+                except (IOError, OSError) as e:
+                    print("Metadata sidecar of %s: %s" % (record['file'], e))
+
+    def _writerLoop(self):
+        connection = self._connect()
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else \
+                max(0, deadline - time.time())
+            try:
+                item = self.records.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if isinstance(item, dict):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.time() + self.flushInterval
+                if len(batch) < self.batchSize:
+                    continue
+            # A full batch, the interval elapsed, a flush or close.
+            if batch:
+                self._insert(connection, batch)
+                batch = []
+            deadline = None
+            if item is None:
+                connection.close()
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+    # Records matching every filter given, oldest first. start and end are
+    # times (seconds since the epoch or datetimes), the exposures are in
+    # microseconds (the exposure actually used, exposure_speed).
+    def query(self, channel=None, start=None, end=None, minExposure=None,
+              maxExposure=None, fileName=None, limit=None):
+        conditions = []
+        values = []
+        for column, operator, value in (
+                ('channel', '=', channel),
+                ('timestamp', '>=', timestamp(start)),
+                ('timestamp', '<=', timestamp(end)),
+                ('exposure_speed', '>=', minExposure),
+                ('exposure_speed', '<=', maxExposure),
+                ('file', '=', fileName)):
+            if value is not None:
+                conditions.append('%s %s ?' % (column, operator))
+                values.append(value)
+        sql = 'SELECT record FROM captures'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp'
+        if limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+        return [json.loads(row[0])
+                for row in self.connection().execute(sql, values)]
+
+    def count(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM captures').fetchone()[0]
+
+
+def timestamp(value):
+    if isinstance(value, datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return value
+
+
+# Date and time given on the command line, e.g. 2019-05-01T14:30 or an
+# epoch timestamp.
+def parseTime(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S',
+                   '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return timestamp(datetime.strptime(text, format))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("invalid date: %s" % text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Lists the captures recorded in a metadata index")
+    parser.add_argument('index', nargs='?', default=INDEX_FILE,
+                        help="index file (default: %s)" % INDEX_FILE)
+    parser.add_argument('--channel', help="channel name, e.g. Green")
+    parser.add_argument('--after', type=parseTime, help="date and time")
+    parser.add_argument('--before', type=parseTime, help="date and time")
+    parser.add_argument('--min-exposure', type=float, help="milliseconds")
+    parser.add_argument('--max-exposure', type=float, help="milliseconds")
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--json', action='store_true',
+                        help="print the whole records")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.index):
+        print("No index at %s" % args.index, file=sys.stderr)
+        return 1
+    index = MetadataIndex(args.index, sidecars=False)
+    start = time.time()
+    records = index.query(
+        channel=args.channel, start=args.after, end=args.before,
+        minExposure=None if args.min_exposure is None
+        else args.min_exposure * 1000,
+        maxExposure=None if args.max_exposure is None
+        else args.max_exposure * 1000,
+        limit=args.limit)
+    elapsed = time.time() - start
+    for record in records:
+        if args.json:
+            print(json.dumps(record, sort_keys=True))
+            continue
+        page = ' t%d c%d' % (record['t'], record['c']) if 't' in record \
+            else ''
+        print("%s  %s%s  %-6s  %7.1f ms  ISO %s" % (
+            datetime.fromtimestamp(record['timestamp']).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            record['file'], page, record.get('channel') or '-',
+            (record.get('exposure_speed') or 0) / 1000,
+            record.get('iso') or 'auto'))
+    print("%d captures (%.1f ms)" % (len(records), elapsed * 1000),
+          file=sys.stderr)
+    index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+## ======== IMAGE PYRAMID ======== ##
+
+# Zoom and pan on a full resolution capture without resizing the whole
+# frame for every view.
+# The pyramid keeps the image at 1/1 (the capture itself, not a copy) and
+# reductions to 1/2, 1/4 and 1/8, each computed once from the previous one.
+# Every level is cut into square tiles. A Viewport works out which tiles of
+# which level cover the screen for the current zoom and centre, and only
+# those are converted for display (8-bit RGB, scaled to the zoom) and kept
+# in an LRU cache (see cache.py), so panning over what was already seen
+# only moves tiles around.
+# The level used is the smallest one that still has at least one pixel per
+# screen pixel, so a displayed tile never comes from more than twice its
+# size.
+
+from __future__ import division
+
+import math
+
+import cv2
+import numpy as np
+
+LEVELS = 4
+TILE_SIZE = 256
+MAX_ZOOM = 8.0          # screen pixels per image pixel
+
+
+class ImagePyramid(object):
+    # image: BGR (or single plane) image, 8 or 16 bits with "bits"
+    #        significant bits. It is not copied, the caller keeps it alive.
+    def __init__(self, image, levels=LEVELS, tile=TILE_SIZE, bits=8):
+        self.tile = tile
+        self.bits = bits
+        self.levels = [image]
+        for _ in range(1, levels):
+            previous = self.levels[-1]
+            height, width = previous.shape[:2]
+            if width < 2 or height < 2:
+                break
+            self.levels.append(cv2.resize(previous, (width // 2, height // 2),
+                                          interpolation=cv2.INTER_AREA))
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    # (columns, rows) of tiles of a level.
+    def tileCount(self, level):
+        height, width = self.levels[level].shape[:2]
+        return (width + self.tile - 1) // self.tile, \
+            (height + self.tile - 1) // self.tile
+
+    # Level to display at "zoom" screen pixels per full resolution pixel.
+    def bestLevel(self, zoom):
+        if zoom >= 1:
+            return 0
+        level = int(math.floor(math.log(1 / zoom, 2) + 1e-9))
+        return min(level, len(self.levels) - 1)
+
+    # Tile (tx, ty) of a level as 8-bit RGB, a new array (smaller than
+    # tile x tile at the right and bottom edges).
+    def tileImage(self, level, tx, ty):
+        t = self.tile
+        block = self.levels[level][ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+        if block.dtype != np.uint8:
+            block = cv2.convertScaleAbs(block,
+                                        alpha=255.0 / ((1 << self.bits) - 1))
+        if block.ndim == 2:
+            return cv2.cvtColor(block, cv2.COLOR_GRAY2RGB)
+        return cv2.cvtColor(block, cv2.COLOR_BGR2RGB)
+
+
+# What part of the pyramid is on a screen of "size" (width, height): the
+# zoom (screen pixels per full resolution pixel) and the full resolution
+# point shown at the centre.
+class Viewport(object):
+    def __init__(self, pyramid, size):
+        self.pyramid = pyramid
+        self.size = size
+        self.fit()
+
+    def fitZoom(self):
+        return min(self.size[0] / self.pyramid.width,
+                   self.size[1] / self.pyramid.height)
+
+    # Whole image in the view.
+    def fit(self):
+        self.zoom = self.fitZoom()
+        self.centre = (self.pyramid.width / 2, self.pyramid.height / 2)
+
+    def _clamp(self):
+        self.zoom = min(MAX_ZOOM, max(self.fitZoom(), self.zoom))
+        # The centre stays where the image still covers the view, or in
+        # the middle when the image is smaller than the view.
+        halfWidth = self.size[0] / 2 / self.zoom
+        halfHeight = self.size[1] / 2 / self.zoom
+        x, y = self.centre
+        width, height = self.pyramid.width, self.pyramid.height
+        x = width / 2 if halfWidth * 2 >= width else \
+            min(width - halfWidth, max(halfWidth, x))
+        y = height / 2 if halfHeight * 2 >= height else \
+            min(height - halfHeight, max(halfHeight, y))
+        self.centre = (x, y)
+
+    # Full resolution coordinates under the screen point (sx, sy).
+    def toImage(self, sx, sy):
+        return (self.centre[0] + (sx - self.size[0] / 2) / self.zoom,
+                self.centre[1] + (sy - self.size[1] / 2) / self.zoom)
+
+    # Multiplies the zoom by "factor" keeping the image point under the
+    # screen point (sx, sy) in place.
+    def zoomAt(self, factor, sx, sy):
+        x, y = self.toImage(sx, sy)
+        self.zoom *= factor
+        self._clamp()
+        self.centre = (x - (sx - self.size[0] / 2) / self.zoom,
+                       y - (sy - self.size[1] / 2) / self.zoom)
+        self._clamp()
+
+    # Moves the image by (dx, dy) screen pixels.
+    def pan(self, dx, dy):
+        self.centre = (self.centre[0] - dx / self.zoom,
+                       self.centre[1] - dy / self.zoom)
+        self._clamp()
+
+    # Tiles covering the screen: a list of (level, tx, ty, sx, sy, width,
+    # height) with the screen position and size of each one. The size only
+    # depends on the zoom, so a tile scaled once can be reused while
+    # panning; it is rounded up, neighbouring tiles overlap by at most a
+    # pixel instead of leaving gaps.
+    def visibleTiles(self):
+        pyramid = self.pyramid
+        level = pyramid.bestLevel(self.zoom)
+        scale = 2 ** level
+        # Screen pixels per pixel of the level.
+        step = self.zoom * scale
+        left, top = self.toImage(0, 0)
+        right, bottom = self.toImage(self.size[0], self.size[1])
+        t = pyramid.tile * scale
+        columns, rows = pyramid.tileCount(level)
+        height, width = pyramid.levels[level].shape[:2]
+        tiles = []
+        for ty in range(max(0, int(top // t)), min(rows, int(bottom // t) + 1)):
+            for tx in range(max(0, int(left // t)),
+                            min(columns, int(right // t) + 1)):
+                x0 = tx * pyramid.tile
+                y0 = ty * pyramid.tile
+                x1 = min(width, x0 + pyramid.tile)
+                y1 = min(height, y0 + pyramid.tile)
+                tiles.append((
+                    level, tx, ty,
+                    int(math.floor((x0 * scale - left) * self.zoom)),
+                    int(math.floor((y0 * scale - top) * self.zoom)),
+                    max(1, int(math.ceil((x1 - x0) * step))),
+                    max(1, int(math.ceil((y1 - y0) * step)))))
+        return tiles
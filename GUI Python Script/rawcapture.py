@@ -0,0 +1,166 @@
+## ======== RAW BAYER CAPTURE ======== ##
+
+# Raw capture mode for quantitative fluorescence.
+# The processed BGR images go through the gamma, denoise and white balance
+# of the camera ISP, so their intensities are not proportional to the light
+# that reached the sensor. In raw mode the JPEG is captured with the Bayer
+# data of the sensor appended (camera.capture(..., bayer=True)) and the
+# 10-bit values are unpacked here, with vectorized NumPy, into 16-bit arrays.
+# The result can be reduced by 2x2 binning (each 2x2 Bayer cell becomes one
+# BGR pixel, averaging the two greens) or demosaiced to full resolution.
+# Values are left as sensor counts (0-1023), so intensities stay linear.
+# This is the same data picamera.array.PiBayerArray exposes; it is decoded
+# here into preallocated buffers to keep it fast enough for time lapses.
+
+from __future__ import division
+
+import io
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from bufferpool import BufferPool
+
+RAW_BITS = 10
+HEADER_SIZE = 32768
+# Size of the Bayer block appended to the JPEG, per sensor.
+RAW_BLOCK_SIZES = {
+    'OV5647': 6404096,
+    'IMX219': 10270208,
+}
+# Position of the red, first green, second green and blue pixels inside a
+# 2x2 Bayer cell, as (row, column), for each bayer_order of the header.
+BAYER_OFFSETS = {
+    0: ((0, 0), (0, 1), (1, 0), (1, 1)),    # RGGB
+    1: ((1, 0), (0, 0), (1, 1), (0, 1)),    # GBRG
+    2: ((1, 1), (1, 0), (0, 1), (0, 0)),    # BGGR
+    3: ((0, 1), (0, 0), (1, 1), (1, 0)),    # GRBG
+}
+# OpenCV names the patterns after the second row, so they look swapped.
+DEMOSAIC_CODES = {
+    0: cv2.COLOR_BayerBG2BGR,
+    1: cv2.COLOR_BayerGR2BGR,
+    2: cv2.COLOR_BayerRG2BGR,
+    3: cv2.COLOR_BayerGB2BGR,
+}
+
+
+# Header of the Broadcom raw block: (width, height, bayer_order).
+def parseRawHeader(data, offset):
+    if data[offset:offset + 4] != b'BRCM':
+        raise ValueError("Raw data not found at the end of the capture")
+    width, height = struct.unpack_from('<HH', data, offset + 176 + 32)
+    order, = struct.unpack_from('<B', data, offset + 176 + 68)
+    return width, height, order
+
+
+# Unpacks RAW10 data: every 5 bytes hold the 8 high bits of 4 pixels
+# followed by a byte with their 2 low bits (pixel 0 in bits 0-1).
+# packed: (rows, stride) uint8 array, rows may include padding.
+def unpackRaw10(packed, width, height, out=None):
+    if out is None:
+        out = np.empty((height, width), np.uint16)
+    blocks = packed[:height, :width * 5 // 4].reshape(height, width // 4, 5)
+    quads = out.reshape(height, width // 4, 4)
+    np.left_shift(blocks[:, :, :4], 2, out=quads, dtype=np.uint16)
+    low = blocks[:, :, 4]
+    for i in range(4):
+        quads[:, :, i] |= (low >> (2 * i)) & 3
+    return out
+
+
+# Inverse of unpackRaw10(): packs (height, width) 10-bit values into rows of
+# "stride" bytes, as the camera stores them. Used by the simulated camera.
+def packRaw10(bayer, stride, rows=None):
+    height, width = bayer.shape
+    packed = np.zeros((rows or height, stride), np.uint8)
+    blocks = packed[:height, :width * 5 // 4].reshape(height, width // 4, 5)
+    quads = bayer.reshape(height, width // 4, 4)
+    np.right_shift(quads, 2, out=blocks[:, :, :4], casting='unsafe')
+    low = blocks[:, :, 4]
+    for i in range(4):
+        low |= ((quads[:, :, i] & 3) << (2 * i)).astype(np.uint8)
+    return packed
+
+
+# 2x2 binning of a Bayer mosaic into a half resolution BGR image.
+def binBayer(bayer, order, out=None):
+    height, width = bayer.shape
+    if out is None:
+        out = np.empty((height // 2, width // 2, 3), bayer.dtype)
+    (ry, rx), (gy, gx), (Gy, Gx), (by, bx) = BAYER_OFFSETS[order]
+    out[:, :, 0] = bayer[by::2, bx::2]
+    np.add(bayer[gy::2, gx::2], bayer[Gy::2, Gx::2], out=out[:, :, 1])
+    out[:, :, 1] >>= 1
+    out[:, :, 2] = bayer[ry::2, rx::2]
+    return out
+
+
+# Full resolution BGR image interpolated from the Bayer mosaic.
+def demosaic(bayer, order):
+    return cv2.cvtColor(bayer, DEMOSAIC_CODES[order])
+
+
+class RawCapture(object):
+    # camera:  PiCamera (or compatible) object.
+    # binning: True for half resolution binned BGR, False for demosaiced
+    #          full resolution BGR.
+    # count:   number of output buffers kept in the pool.
+    def __init__(self, camera, binning=True, count=2,
+                 sensorResolution=(3280, 2464)):
+        self.camera = camera
+        self.binning = binning
+        width, height = sensorResolution
+        self.stream = io.BytesIO()
+        self.bayer = np.empty((height, width), np.uint16)
+        self.order = None
+        if binning:
+            outResolution = (width // 2, height // 2)
+        else:
+            outResolution = (width, height)
+        self.pool = BufferPool(outResolution, count, dtype=np.uint16)
+
+    # Captures a JPEG with the Bayer data and returns (data, offset of the
+    # raw block).
+    def _read(self):
+        self.stream.seek(0)
+        self.stream.truncate()
+        self.camera.capture(self.stream, format='jpeg', bayer=True)
+        data = self.stream.getvalue()
+        for size in RAW_BLOCK_SIZES.values():
+            offset = len(data) - size
+            if offset >= 0 and data[offset:offset + 4] == b'BRCM':
+                return data, offset
+        raise ValueError("Raw data not found at the end of the capture")
+
+    # Unpacks the last capture into self.bayer. Returns the bayer_order.
+    def _decode(self, data, offset):
+        width, height, order = parseRawHeader(data, offset)
+        stride = ((width * 5 // 4 + 31) // 32) * 32
+        start = offset + HEADER_SIZE
+        rows = (len(data) - start) // stride
+        packed = np.frombuffer(data, np.uint8, rows * stride, start)
+        if self.bayer.shape != (height, width):
+            self.bayer = np.empty((height, width), np.uint16)
+        unpackRaw10(packed.reshape(rows, stride), width, height,
+                    out=self.bayer)
+        self.order = order
+        return order
+
+    # Capture function for CapturePipeline.submit(): the caller already
+    # holds the camera lock. Stores the pooled buffer in job.buffer and
+    # returns the linear 16-bit BGR image.
+    def captureInto(self, job):
+        data, offset = self._read()
+        start = time.time()
+        order = self._decode(data, offset)
+        job.buffer = self.pool.acquire()
+        if self.binning:
+            binBayer(self.bayer, order, out=job.buffer.array)
+        else:
+            job.buffer.array[...] = demosaic(self.bayer, order)
+        job.bits = RAW_BITS
+        job.times['unpack'] = time.time() - start
+        return job.buffer.array
@@ -0,0 +1,254 @@
+## ======== MULTICHANNEL SEQUENCER ======== ##
+
+# Captures brightfield and the fluorescence channels one after the other for
+# a single timepoint.
+# Each channel carries its own LED pin, exposure, ISO, AWB gains, framerate
+# and exposure mode. The channels are ordered so that consecutive channels
+# share as many of the slow settings (framerate, exposure mode, ISO) as
+# possible, and only the properties that change are written to the camera:
+# the writes go through the CameraSettings of the program (see
+# camerasettings.py), which knows what is on the camera whoever wrote it.
+# Instead of waiting a fixed time after switching the LED and the gains, the
+# sequencer watches small frames from the video port and continues as soon
+# as their statistics stop changing.
+# The time spent switching, settling and capturing each channel is reported
+# so the cycle of a multichannel timepoint can be tuned.
+
+from __future__ import division
+
+import time
+
+import numpy as np
+
+from camerasettings import CameraSettings
+from hardware import LED_PINS, rgbArray
+from metadata import cameraState
+
+SETTLE_SIZE = (128, 96)
+SETTLE_TOLERANCE = 0.02
+SETTLE_FRAMES = 2
+SETTLE_TIMEOUT = 5.0
+
+# Camera properties that force a reconfiguration of the sensor. Channels are
+# grouped by them to reduce the number of slow switches per timepoint.
+SLOW_PROPERTIES = ('framerate', 'exposure_mode', 'iso')
+
+
+class Channel(object):
+    # name:          label of the channel, also used in the file names.
+    # pin:           GPIO (BCM) pin of the LED of the channel.
+    # shutter_speed: exposure time in microseconds, 0 means automatic.
+    # iso:           0 means automatic.
+    # awb_gains:     (red, blue) gains, None keeps the automatic white balance.
+    def __init__(self, name, pin, shutter_speed=0, iso=0, awb_gains=None,
+                 framerate=30, exposure_mode='auto'):
+        self.name = name
+        self.pin = pin
+        self.shutter_speed = shutter_speed
+        self.iso = iso
+        self.awb_gains = awb_gains
+        self.framerate = framerate
+        self.exposure_mode = exposure_mode
+
+    def slowKey(self):
+        return tuple(getattr(self, p) for p in SLOW_PROPERTIES)
+
+    def __repr__(self):
+        return "Channel(%r)" % self.name
+
+
+# Channels of the microscope with their usual settings: brightfield and the
+# three fluorescence fields. Exposure times are in microseconds, 0 is
+# automatic. Fluorescence channels use a framerate of 1 fps to allow long
+# exposures.
+DEFAULT_CHANNELS = [
+    Channel('BrFld', LED_PINS['BrFld'], shutter_speed=0, iso=400,
+            awb_gains=(1.5, 1.2), framerate=30),
+    Channel('Green', LED_PINS['Green'], shutter_speed=700000, iso=200,
+            awb_gains=(1.2, 1.2), framerate=1),
+    Channel('Blue', LED_PINS['Blue'], shutter_speed=500000, iso=200,
+            awb_gains=(1.2, 1.2), framerate=1),
+    Channel('Red', LED_PINS['Red'], shutter_speed=500000, iso=200,
+            awb_gains=(1.1, 1.1), framerate=1, exposure_mode='off'),
+]
+
+
+# Number of slow properties that must be written to go from the settings "a"
+# to the ones of a channel with settings "b". Channels with the exposure mode
+# off settle in automatic mode first (see MultichannelSequencer._unfreeze).
+def switchCost(a, b):
+    if a is None:
+        return len(SLOW_PROPERTIES)
+    b = tuple('auto' if p == 'exposure_mode' and v == 'off' else v
+              for p, v in zip(SLOW_PROPERTIES, b))
+    return sum(1 for x, y in zip(a, b) if x != y)
+
+
+# Orders the channels to minimise the slow switches, starting from the slow
+# settings currently applied on the camera (if known). Channels sharing the
+# same slow settings keep the order in which they were given.
+def orderChannels(channels, current=None):
+    groups = []
+    for channel in channels:
+        for key, members in groups:
+            if key == channel.slowKey():
+                members.append(channel)
+                break
+        else:
+            groups.append((channel.slowKey(), [channel]))
+    ordered = []
+    while groups:
+        best = min(range(len(groups)),
+                   key=lambda i: switchCost(current, groups[i][0]))
+        current, members = groups.pop(best)
+        ordered.extend(members)
+    return ordered
+
+
+# Mean of each colour plane of a frame, used to decide if the image is stable.
+def frameStatistics(frame):
+    return frame.reshape(-1, frame.shape[-1]).mean(axis=0)
+
+
+# Reads small frames from the video port until the mean of every colour
+# plane changes less than "tolerance" (relative) during "stableFrames"
+# consecutive frames, or until "timeout" seconds have passed.
+# Returns (settled, elapsed seconds, frames read).
+def waitForSettle(camera, size=SETTLE_SIZE, tolerance=SETTLE_TOLERANCE,
+                  stableFrames=SETTLE_FRAMES, timeout=SETTLE_TIMEOUT):
+    start = time.time()
+    previous = None
+    stable = 0
+    frames = 0
+    output = rgbArray(camera, size=size)
+    stream = camera.capture_continuous(output, format='bgr',
+                                       use_video_port=True, resize=size)
+    try:
+        for _ in stream:
+            frames += 1
+            stats = frameStatistics(output.array)
+            output.truncate(0)
+            if previous is not None:
+                change = np.abs(stats - previous) / np.maximum(previous, 1.0)
+                stable = stable + 1 if change.max() < tolerance else 0
+            previous = stats
+            if stable >= stableFrames:
+                return True, time.time() - start, frames
+            if time.time() - start > timeout:
+                return False, time.time() - start, frames
+    finally:
+        stream.close()
+    return False, time.time() - start, frames
+
+
+class MultichannelSequencer(object):
+    # camera, gpio: PiCamera and RPi.GPIO (or compatible) objects.
+    # pins:         every LED pin, all of them but the active one are kept off.
+    # capture:      capture(channel, timepoint) takes the full resolution
+    #               image once the channel has settled and returns it. A
+    #               pooled buffer (with a release() method) is released
+    #               if a later channel of the timepoint fails.
+    # settle:       keyword arguments for waitForSettle().
+    # settings:     CameraSettings writing to the camera, one of its own if
+    #               not given. The desired values are left alone, call its
+    #               restore() after a timepoint to write them back.
+    def __init__(self, camera, gpio, pins, capture, cameraLock=None,
+                 settle=None, settings=None):
+        self.camera = camera
+        self.gpio = gpio
+        self.pins = pins
+        self.capture = capture
+        self.cameraLock = cameraLock
+        self.settle = settle or {}
+        self.settings = settings or CameraSettings(camera, cameraLock)
+
+    # Writes the properties of the channel that differ from the ones on the
+    # camera (in APPLY_ORDER: the framerate before the exposure time it
+    # limits).
+    def _apply(self, channel):
+        values = {'framerate': channel.framerate,
+                  'shutter_speed': channel.shutter_speed,
+                  'iso': channel.iso}
+        if channel.awb_gains is None:
+            values['awb_mode'] = 'auto'
+        else:
+            values['awb_mode'] = 'off'
+            values['awb_gains'] = channel.awb_gains
+        self.settings.write(**values)
+
+    def _setExposureMode(self, mode):
+        self.settings.write(exposure_mode=mode)
+
+    # Switching the exposure mode off freezes the gains, so channels using it
+    # settle in automatic mode and the mode is switched off afterwards.
+    def _unfreeze(self, channel):
+        if channel.exposure_mode == 'off':
+            self._setExposureMode('auto')
+        else:
+            self._setExposureMode(channel.exposure_mode)
+
+    def _lightOnly(self, pin):
+        for p in self.pins:
+            self.gpio.output(p, self.gpio.HIGH if p == pin else self.gpio.LOW)
+
+    # Captures every channel for one timepoint. Returns a list of
+    # (channel, image, timings) in capture order; timings holds the seconds
+    # spent in 'switch', 'settle' and 'capture', plus 'settled' (bool) and
+    # 'state', the camera settings the image was taken with (see
+    # metadata.py).
+    def runTimepoint(self, channels, timepoint=0):
+        results = []
+        with self.settings.lock:
+            current = tuple(self.settings.applied.get(p)
+                            for p in SLOW_PROPERTIES)
+        if None in current:
+            current = None
+        finished = False
+        if self.cameraLock is not None:
+            self.cameraLock.acquire()
+        try:
+            for channel in orderChannels(channels, current):
+                timings = {}
+                start = time.time()
+                self._unfreeze(channel)
+                self._apply(channel)
+                self._lightOnly(channel.pin)
+                timings['switch'] = time.time() - start
+                settled, elapsed, frames = waitForSettle(self.camera,
+                                                         **self.settle)
+                timings['settle'] = elapsed
+                timings['settled'] = settled
+                if channel.exposure_mode == 'off':
+                    self._setExposureMode('off')
+                start = time.time()
+                image = self.capture(channel, timepoint)
+                timings['capture'] = time.time() - start
+                timings['state'] = cameraState(self.camera)
+                results.append((channel, image, timings))
+            finished = True
+        finally:
+            self._lightOnly(None)
+            if self.cameraLock is not None:
+                self.cameraLock.release()
+            if not finished:
+                # The caller never gets the images already taken.
+                for channel, image, timings in results:
+                    if hasattr(image, 'release'):
+                        image.release()
+        return results
+
+
+# Human readable report of the timings returned by runTimepoint().
+def timingReport(results):
+    lines = []
+    total = 0.0
+    for channel, image, t in results:
+        spent = t['switch'] + t['settle'] + t['capture']
+        total += spent
+        lines.append("%-12s switch %6.0f ms  settle %6.0f ms%s  capture "
+                     "%6.0f ms  total %6.0f ms" % (
+                         channel.name, t['switch'] * 1000, t['settle'] * 1000,
+                         "" if t['settled'] else " (timeout)",
+                         t['capture'] * 1000, spent * 1000))
+    lines.append("Timepoint cycle: %.2f s" % total)
+    return "\n".join(lines)
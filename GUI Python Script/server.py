@@ -0,0 +1,755 @@
+## ======== REMOTE CONTROL SERVER ======== ##
+
+# Controls a microscope over the network, e.g. one sitting in an incubator,
+# without the GUI:
+#     python3 server.py --host 0.0.0.0 --port 8080
+# and open http://<pi>:8080/ in a browser. It needs Python 3.7 (asyncio);
+# the GUI itself stays on Python 2.7.
+# HTTP API (parameters as a JSON body or in the query string, replies in
+# JSON):
+#   GET  /status            LED, time lapse, stream and storage state.
+#   POST /still             captures a full resolution TIFF, replies once
+#                           it is written: {"file": ..., "times": ...}.
+#   POST /led               {"channel": "Green"} lights a channel with its
+#                           settings (see sequencer.py), "off" for none.
+#   GET  /settings          desired and applied camera settings, presets;
+#                           it changes nothing.
+#   POST /settings          {"brightness": 55, "preset": "Green EmF"...}
+#                           (see camerasettings.py), replies as GET.
+#   POST /timelapse/start   an acquisition protocol, as in acquire.py.
+#   POST /timelapse/stop
+#   GET  /stream            MJPEG live stream (multipart/x-mixed-replace).
+#   GET  /ws                WebSocket: the same commands as JSON messages,
+#                           {"id": 1, "command": "led", "channel": "Red"},
+#                           answered with {"id": 1, "result": ...} or
+#                           {"id": 1, "error": ...}, plus an {"event": ...}
+#                           message when a still is written or a time lapse
+#                           starts or ends.
+# Everything runs on one asyncio loop; what blocks is handed to threads:
+#   - the camera has a single owner, a one thread executor, so the requests
+#     of several clients are applied one after the other and never
+#     interleave on the camera. Stills go through the capture pipeline (see
+#     capture_pipeline.py), the time lapse is an Acquisition of acquire.py;
+#     both take the camera lock;
+#   - the stream reads small frames from the video port (see
+#     livepreview.py), which steps aside while a capture waits for the
+#     camera. Each frame is encoded to JPEG once, whatever the number of
+#     viewers, and every viewer is sent the newest one: a slow viewer skips
+#     frames instead of slowing the others down, and nothing is encoded
+#     while nobody watches.
+# There is no authentication: it listens on localhost unless --host says
+# otherwise, only open it on a trusted lab network.
+# Try it without a Raspberry Pi with the simulated camera:
+#     python3 server.py --backend sim
+#     curl -X POST localhost:8080/led -d '{"channel": "Green"}'
+#     curl -X POST localhost:8080/still
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import http
+import json
+import os
+import signal
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import cv2
+
+from acquire import Acquisition, parseProtocol
+from camerasettings import CameraSettings, loadPresets
+from capture_pipeline import CapturePipeline
+from export import Exporter
+from hardware import LED_PINS, openHardware
+from livepreview import VideoPortPreview
+from metadata import INDEX_FILE, MetadataIndex
+from sequencer import DEFAULT_CHANNELS
+from stackwriter import uniqueFileName
+from storage import StorageMonitor
+
+HOST = '127.0.0.1'
+PORT = 8080
+STILL_FORMAT = 'TIFF'
+STREAM_SIZE = (640, 480)
+STREAM_QUALITY = 80
+MAX_STREAM_FPS = 15
+MAX_BODY = 1 << 20
+BOUNDARY = 'frame'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# WebSocket opcodes.
+WS_CONTINUATION, WS_TEXT, WS_BINARY = 0x0, 0x1, 0x2
+WS_CLOSE, WS_PING, WS_PONG = 0x8, 0x9, 0xA
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><title>BioARTS Microscope</title></head>
+<body style="font-family: sans-serif">
+<img src="/stream" width="640" height="480"><br>
+<button onclick="send('/still')">Still</button>
+LED: %s <button onclick="send('/led', {channel: 'off'})">Off</button>
+<pre id="out"></pre>
+<script>
+function send(path, body) {
+  fetch(path, {method: 'POST', body: JSON.stringify(body || {})})
+    .then(r => r.text()).then(t => document.getElementById('out')
+    .textContent = t);
+}
+</script>
+</body></html>
+""" % " ".join("<button onclick=\"send('/led', {channel: '%s'})\">%s"
+               "</button>" % (name, name) for name in LED_PINS)
+
+
+# Refused request; "status" is the HTTP status of the reply.
+class CommandError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def channelByName(name):
+    for channel in DEFAULT_CHANNELS:
+        if channel.name == name:
+            return channel
+    raise CommandError("Unknown channel %r, expected off or one of %s" % (
+        name, ", ".join(c.name for c in DEFAULT_CHANNELS)))
+
+
+# Acquisition of acquire.py sharing the camera: the timepoints hold the
+# camera lock (the stream may have changed the resolution in between), and
+# the camera, the exporter and the LEDs outlive the run.
+class RemoteAcquisition(Acquisition):
+    def __init__(self, protocol, camera, gpio, exporter, cameraLock,
+                 settings):
+        Acquisition.__init__(self, protocol, camera, gpio, exporter,
+                             settings)
+        self.cameraLock = cameraLock
+
+    def _prepare(self):
+        with self.cameraLock:
+            Acquisition._prepare(self)
+
+    def _timepoint(self, frame):
+        with self.cameraLock:
+            if self.camera.resolution != self.protocol.resolution:
+                self.camera.resolution = self.protocol.resolution
+            return Acquisition._timepoint(self, frame)
+
+    def close(self):
+        for pin in self.pins:
+            self.gpio.output(pin, self.gpio.LOW)
+        self.index.close()
+
+
+# The camera, the LEDs and what uses them. The coroutines run on the loop,
+# the camera is only touched by the owner thread and the capture pipeline.
+class Microscope(object):
+    # camera, gpio: PiCamera and RPi.GPIO (or compatible) objects.
+    # directory:    where the stills and time lapses are written.
+    def __init__(self, camera, gpio, directory='.'):
+        self.camera = camera
+        self.gpio = gpio
+        self.directory = directory
+        self.pins = list(LED_PINS.values())
+        for pin in self.pins:
+            gpio.setup(pin, gpio.OUT)
+            gpio.output(pin, gpio.LOW)
+        self.exporter = Exporter()
+        self.index = MetadataIndex(os.path.join(directory, INDEX_FILE))
+        self.storage = StorageMonitor(directory)
+        self.pipeline = CapturePipeline(
+            camera, write=self._write, onWritten=self._written,
+            index=self.index)
+        self.cameraLock = self.pipeline.cameraLock
+        self.settings = CameraSettings(camera, self.cameraLock, loadPresets())
+        self.owner = ThreadPoolExecutor(max_workers=1)
+        self.channel = None
+        self.stills = 0
+        self.acquisition = None
+        self.loop = None
+        # Futures of the stills not written yet, by file name.
+        self._stills = {}
+        # Queues of the WebSocket clients, for the events.
+        self.listeners = set()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    # Runs function(*args) on the owner thread.
+    def call(self, function, *args):
+        return self.loop.run_in_executor(self.owner, function, *args)
+
+    def emit(self, event):
+        for listener in self.listeners:
+            listener.put_nowait(event)
+
+    def _write(self, fileName, image):
+        result = self.exporter.write(image, fileName, STILL_FORMAT)
+        self.storage.recordExport(result)
+        return result
+
+    # Capture pipeline writer thread.
+    def _written(self, job):
+        self.loop.call_soon_threadsafe(self._stillDone, job)
+
+    def _stillDone(self, job):
+        future = self._stills.pop(job.fileName, None)
+        result = {'file': job.fileName,
+                  'times': dict((name, round(seconds, 3))
+                                for name, seconds in job.times.items())}
+        if job.error is not None:
+            result['error'] = str(job.error)
+        self.emit(dict(result, event='still'))
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _checkIdle(self):
+        if self.acquisition is not None:
+            raise CommandError("A time lapse is running", 409)
+
+    async def still(self):
+        self._checkIdle()
+        fileName = uniqueFileName(os.path.join(
+            self.directory, time.strftime('still-%Y-%m-%d-%H%M%S')), '.tiff')
+        future = self.loop.create_future()
+        self._stills[fileName] = future
+        pin = LED_PINS.get(self.channel)
+        self.stills += 1
+        await self.call(lambda: self.pipeline.submit(
+            self.stills, fileName, self.settings.apply, block=True,
+            metadata={'channel': self.channel, 'led': pin}))
+        result = await future
+        if 'error' in result:
+            raise CommandError("Capture failed: %s" % result['error'], 500)
+        return result
+
+    def _light(self, channel):
+        with self.cameraLock:
+            for pin in self.pins:
+                self.gpio.output(pin, self.gpio.HIGH if channel is not None
+                                 and pin == channel.pin else self.gpio.LOW)
+            if channel is None:
+                return
+            values = {'framerate': channel.framerate,
+                      'shutter_speed': channel.shutter_speed,
+                      'iso': channel.iso,
+                      'exposure_mode': channel.exposure_mode,
+                      'awb_mode': 'auto'}
+            if channel.awb_gains is not None:
+                values.update(awb_mode='off', awb_gains=channel.awb_gains)
+            self.settings.update(**values)
+            self.settings.apply()
+
+    async def led(self, channel='off'):
+        self._checkIdle()
+        selected = None if channel == 'off' else channelByName(channel)
+        await self.call(self._light, selected)
+        self.channel = None if selected is None else selected.name
+        self.emit({'event': 'led', 'channel': channel})
+        return {'channel': channel}
+
+    async def cameraSettings(self, preset=None, **values):
+        if preset is not None:
+            if preset not in self.settings.presets:
+                raise CommandError("Unknown preset %r, expected one of %s" % (
+                    preset, ", ".join(self.settings.presets)))
+            self.settings.preset(preset)
+        if values.get('awb_gains') is not None:
+            values['awb_gains'] = tuple(values['awb_gains'])
+        try:
+            self.settings.update(**values)
+        except ValueError as e:
+            raise CommandError(str(e))
+        await self.call(self.settings.apply)
+        return self.settingsState()
+
+    def settingsState(self):
+        with self.settings.lock:
+            return {'desired': dict(self.settings.desired),
+                    'applied': dict(self.settings.applied),
+                    'presets': list(self.settings.presets)}
+
+    def _startAcquisition(self, protocol):
+        acquisition = RemoteAcquisition(protocol, self.camera, self.gpio,
+                                        self.exporter, self.cameraLock,
+                                        self.settings)
+        acquisition.start()
+        return acquisition
+
+    async def timelapseStart(self, **protocol):
+        self._checkIdle()
+        try:
+            protocol = parseProtocol(protocol, protocol.get('name', 'remote'))
+        except (ValueError, TypeError) as e:
+            raise CommandError("Invalid protocol: %s" % e)
+        # Files stay in the directory of the server.
+        protocol.directory = self.directory
+        self.acquisition = await self.call(self._startAcquisition, protocol)
+        self.channel = None
+        self.emit({'event': 'timelapse', 'running': True,
+                   'base': self.acquisition.base})
+        asyncio.ensure_future(self._watchAcquisition(self.acquisition))
+        return {'base': self.acquisition.base,
+                'protocol': protocol.describe()}
+
+    async def _watchAcquisition(self, acquisition):
+        error = await self.loop.run_in_executor(None, acquisition.wait)
+        acquisition.close()
+        # The sequencer left the settings of its last channel.
+        self.settings.restore()
+        if self.acquisition is acquisition:
+            self.acquisition = None
+        self.emit({'event': 'timelapse', 'running': False,
+                   'base': acquisition.base,
+                   'error': None if error is None else str(error),
+                   'summary': acquisition.scheduler.stats.summary()})
+
+    async def timelapseStop(self):
+        acquisition = self.acquisition
+        if acquisition is None:
+            raise CommandError("No time lapse is running", 409)
+        acquisition.stop()
+        await self.loop.run_in_executor(None, acquisition.scheduler.join)
+        return {'base': acquisition.base,
+                'summary': acquisition.scheduler.stats.summary()}
+
+    def status(self):
+        acquisition = self.acquisition
+        return {
+            'channel': self.channel,
+            'stills': self.stills,
+            'pending': self.pipeline.pending(),
+            'timelapse': None if acquisition is None else {
+                'base': acquisition.base,
+                'files': acquisition.files,
+                'summary': acquisition.scheduler.stats.summary()},
+            'storage': str(self.storage.status()),
+        }
+
+    async def close(self):
+        if self.acquisition is not None:
+            await self.timelapseStop()
+        await self.call(self._light, None)
+        self.owner.shutdown()
+        self.pipeline.close()
+        self.exporter.close()
+        self.index.close()
+        self.camera.close()
+
+
+# Latest JPEG of the video port, encoded once for every viewer.
+class MjpegBroadcast(object):
+    # size:    (width, height) of the stream.
+    # quality: JPEG quality (0-100).
+    # fps:     most frames encoded per second.
+    def __init__(self, microscope, size=STREAM_SIZE, quality=STREAM_QUALITY,
+                 fps=MAX_STREAM_FPS):
+        self.microscope = microscope
+        self.size = size
+        self.quality = quality
+        self.fps = fps
+        self.clients = 0
+        self.jpeg = None
+        self.sequence = 0
+        self.encoded = 0
+        self.sent = 0
+        self.error = None
+        self.condition = None
+        self._task = None
+
+    # Adds a viewer; returns the "seen" to pass to the first next(), so it
+    # gets the current frame if there is one.
+    def subscribe(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        self.clients += 1
+        if self._task is None:
+            self.error = None
+            self.jpeg = None
+            self._task = asyncio.ensure_future(self._run())
+        if self.jpeg is None:
+            return self.sequence
+        return self.sequence - 1
+
+    def unsubscribe(self):
+        self.clients -= 1
+
+    # (sequence, jpeg) of the first frame after "seen", None if the stream
+    # stopped.
+    async def next(self, seen):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.sequence != seen or self.error is not None)
+        if self.error is not None:
+            return None
+        self.sent += 1
+        return self.sequence, self.jpeg
+
+    def _encode(self, frame):
+        ok, data = cv2.imencode('.jpeg', frame,
+                                [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise IOError("JPEG encoding failed")
+        return data.tobytes()
+
+    async def _run(self):
+        microscope = self.microscope
+        loop = asyncio.get_running_loop()
+        preview = VideoPortPreview(microscope.camera, microscope.cameraLock,
+                                   self.size)
+        preview.start()
+        try:
+            while self.clients > 0:
+                start = loop.time()
+                if preview.error is not None:
+                    raise preview.error
+                frame = preview.poll()
+                if frame is not None:
+                    self.jpeg = await loop.run_in_executor(
+                        None, self._encode, frame)
+                    preview.displayed()
+                    self.encoded += 1
+                    self.sequence += 1
+                    async with self.condition:
+                        self.condition.notify_all()
+                await asyncio.sleep(max(0.005, 1 / self.fps -
+                                        (loop.time() - start)))
+        except Exception as e:
+            print("Stream stopped: %s" % e)
+            self.error = e
+        finally:
+            preview.stop()
+            # A viewer arriving from now on starts a new stream.
+            self._task = None
+            if self.error is None:
+                self.error = EOFError("no viewers")
+            async with self.condition:
+                self.condition.notify_all()
+
+    def status(self):
+        return {'clients': self.clients, 'encoded': self.encoded,
+                'sent': self.sent}
+
+
+class Request(object):
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    # Parameters of a command: the JSON body, or the query string (where
+    # "60" is a number and "auto" a string).
+    def params(self):
+        params = {}
+        for name, value in self.query:
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        if self.body.strip():
+            try:
+                body = json.loads(self.body.decode('utf-8'))
+            except ValueError as e:
+                raise CommandError("Invalid JSON: %s" % e)
+            if not isinstance(body, dict):
+                raise CommandError("The body must be a JSON object")
+            params.update(body)
+        return params
+
+
+# Next request of a connection, None when the client closed it.
+async def readRequest(reader):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise CommandError("Request header too large", 431)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise CommandError("Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise CommandError("Invalid Content-Length")
+    if length > MAX_BODY:
+        raise CommandError("Request body too large", 413)
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    return Request(method.upper(), path, parse_qsl(query), headers, body)
+
+
+def httpHead(status, contentType, length=None, extra=()):
+    lines = ['HTTP/1.1 %d %s' % (status, http.HTTPStatus(status).phrase),
+             'Content-Type: %s' % contentType, 'Cache-Control: no-store']
+    if length is not None:
+        lines.append('Content-Length: %d' % length)
+    lines.extend(extra)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def websocketAccept(key):
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+# A server frame (never masked, never fragmented).
+def websocketFrame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+# Next (opcode, payload) sent by the client, fragments joined.
+async def readWebsocketMessage(reader):
+    message = b''
+    first = None
+    while True:
+        head = await reader.readexactly(2)
+        final = head[0] & 0x80
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        if len(message) + length > MAX_BODY:
+            raise CommandError("WebSocket message too large", 413)
+        mask = await reader.readexactly(4) if head[1] & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        if opcode >= WS_CLOSE:
+            # Control frames may come between fragments.
+            return opcode, payload
+        if first is None:
+            first = opcode
+        message += payload
+        if final:
+            return first, message
+
+
+class RemoteServer(object):
+    def __init__(self, microscope, broadcast):
+        self.microscope = microscope
+        self.broadcast = broadcast
+        # Commands of the API: HTTP method and path, and the coroutine or
+        # function called with the parameters.
+        self.commands = {
+            'status': (('GET', '/status'), self.status),
+            'still': (('POST', '/still'), microscope.still),
+            'led': (('POST', '/led'), microscope.led),
+            'settings': (('POST', '/settings'), microscope.cameraSettings),
+            'timelapse_start': (('POST', '/timelapse/start'),
+                                microscope.timelapseStart),
+            'timelapse_stop': (('POST', '/timelapse/stop'),
+                               microscope.timelapseStop),
+        }
+        self.routes = dict(self.commands.values())
+        self.routes['GET', '/settings'] = microscope.settingsState
+
+    def status(self):
+        status = self.microscope.status()
+        status['stream'] = self.broadcast.status()
+        return status
+
+    async def run(self, function, params):
+        try:
+            result = function(**params)
+        except TypeError as e:
+            raise CommandError("Invalid parameters: %s" % e)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def handle(self, reader, writer):
+        try:
+            request = await readRequest(reader)
+            if request is None:
+                return
+            if request.path == '/ws':
+                await self.websocket(request, reader, writer)
+            elif request.path == '/stream' and request.method == 'GET':
+                await self.stream(writer)
+            elif request.path == '/' and request.method == 'GET':
+                page = INDEX_PAGE.encode('utf-8')
+                writer.write(httpHead(200, 'text/html; charset=utf-8',
+                                      len(page), ['Connection: close']) +
+                             page)
+            else:
+                function = self.routes.get((request.method, request.path))
+                if function is None:
+                    raise CommandError("No %s %s" % (request.method,
+                                                     request.path), 404)
+                self.reply(writer, 200, await self.run(function,
+                                                        request.params()))
+        except CommandError as e:
+            self.reply(writer, e.status, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print("Request failed: %r" % e)
+            self.reply(writer, 500, {'error': str(e)})
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def reply(self, writer, status, data):
+        body = json.dumps(data, indent=1, sort_keys=True).encode('utf-8')
+        writer.write(httpHead(status, 'application/json', len(body),
+                              ['Connection: close']) + body)
+
+    async def stream(self, writer):
+        writer.write(httpHead(
+            200, 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY))
+        seen = self.broadcast.subscribe()
+        try:
+            while True:
+                item = await self.broadcast.next(seen)
+                if item is None:
+                    return
+                seen, jpeg = item
+                writer.write(('--%s\r\nContent-Type: image/jpeg\r\n'
+                              'Content-Length: %d\r\n\r\n' % (
+                                  BOUNDARY, len(jpeg))).encode('latin-1') +
+                             jpeg + b'\r\n')
+                await writer.drain()
+        finally:
+            self.broadcast.unsubscribe()
+
+    async def websocket(self, request, reader, writer):
+        key = request.headers.get('sec-websocket-key')
+        if request.headers.get('upgrade', '').lower() != 'websocket' or \
+                not key:
+            raise CommandError("Expected a WebSocket upgrade")
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: %s\r\n\r\n' %
+                      websocketAccept(key)).encode('latin-1'))
+        # Replies and events go through one queue, sent by one task.
+        outbox = asyncio.Queue()
+        self.microscope.listeners.add(outbox)
+        sender = asyncio.ensure_future(self._sendLoop(outbox, writer))
+        try:
+            while True:
+                opcode, payload = await readWebsocketMessage(reader)
+                if opcode == WS_CLOSE:
+                    outbox.put_nowait((WS_CLOSE, payload[:2]))
+                    return
+                if opcode == WS_PING:
+                    outbox.put_nowait((WS_PONG, payload))
+                elif opcode == WS_TEXT:
+                    asyncio.ensure_future(self._command(outbox, payload))
+        finally:
+            self.microscope.listeners.discard(outbox)
+            outbox.put_nowait(None)
+            await sender
+
+    async def _sendLoop(self, outbox, writer):
+        while True:
+            item = await outbox.get()
+            if item is None:
+                return
+            if isinstance(item, dict):
+                item = (WS_TEXT, json.dumps(item).encode('utf-8'))
+            try:
+                writer.write(websocketFrame(*item))
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def _command(self, outbox, payload):
+        reply = {}
+        try:
+            try:
+                message = json.loads(payload.decode('utf-8'))
+            except ValueError as e:
+                raise CommandError("Invalid JSON: %s" % e)
+            if not isinstance(message, dict):
+                raise CommandError("Messages must be JSON objects")
+            reply['id'] = message.pop('id', None)
+            name = message.pop('command', None)
+            if name not in self.commands:
+                raise CommandError("Unknown command %r, expected one of %s" %
+                                   (name, ", ".join(sorted(self.commands))))
+            reply['result'] = await self.run(self.commands[name][1], message)
+        except CommandError as e:
+            reply['error'] = str(e)
+        except Exception as e:
+            print("Command failed: %r" % e)
+            reply['error'] = str(e)
+        outbox.put_nowait(reply)
+
+
+async def serve(args):
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    camera, gpio = openHardware(args.backend)
+    gpio.setmode(gpio.BCM)
+    gpio.setwarnings(False)
+    microscope = Microscope(camera, gpio, args.directory)
+    microscope.start()
+    broadcast = MjpegBroadcast(microscope, quality=args.quality,
+                               fps=args.fps)
+    remote = RemoteServer(microscope, broadcast)
+    server = await asyncio.start_server(remote.handle, args.host, args.port)
+    print("Serving on http://%s:%d/" % (args.host, args.port))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        print("Stopping")
+        server.close()
+        await server.wait_closed()
+        await microscope.close()
+        gpio.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serves the microscope controls and a live stream over "
+                    "HTTP and WebSocket")
+    parser.add_argument('--host', default=HOST,
+                        help="address to listen on (default: %s, use "
+                             "0.0.0.0 for every interface)" % HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--backend', default=None,
+                        choices=('sim', 'picamera', 'auto'),
+                        help="camera backend (default: $MICROSCOPE_BACKEND "
+                             "or auto)")
+    parser.add_argument('--directory', default='.',
+                        help="where the images are written")
+    parser.add_argument('--quality', type=int, default=STREAM_QUALITY,
+                        help="JPEG quality of the stream")
+    parser.add_argument('--fps', type=float, default=MAX_STREAM_FPS,
+                        help="most frames per second of the stream")
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+## ======== BURST STACKING ======== ##
+
+# "Stack N frames" capture for low-light fluorescence.
+# Instead of a single long exposure, a burst of frames is read from the video
+# port and averaged. Frames are accumulated as they arrive into float32
+# running statistics (Welford's mean and sum of squared deviations), so the
+# memory used is the same for 4 or 400 frames: a ring of three capture
+# buffers plus the accumulators.
+# With sigma clipping, once a few frames have been accumulated, pixels more
+# than "kappa" standard deviations away from their running mean (hot pixels,
+# cosmic rays, a passing cell) are left out of that pixel's mean.
+# The temporal standard deviation gives the noise of a single frame, from
+# which the SNR of one frame and of the stack are estimated, together with
+# how fast the SNR was gained per second of acquisition.
+
+from __future__ import division
+
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+from bufferpool import BufferPool
+
+STACK_RESOLUTION = (1640, 1232)
+SIGMA_KAPPA = 3.0
+SIGMA_WARMUP = 8
+
+
+class FrameStacker(object):
+    # shape:  shape of the frames, e.g. (height, width, 3).
+    # method: 'mean' for a running mean, 'sigma' for a sigma-clipped mean.
+    def __init__(self, shape, method='mean', kappa=SIGMA_KAPPA,
+                 warmup=SIGMA_WARMUP):
+        if method not in ('mean', 'sigma'):
+            raise ValueError("Unknown stacking method: %s" % method)
+        self.shape = tuple(shape)
+        self.method = method
+        self.kappa = kappa
+        self.warmup = max(2, warmup)
+        self.mean = np.zeros(self.shape, np.float32)
+        self.m2 = np.zeros(self.shape, np.float32)
+        self._delta = np.empty(self.shape, np.float32)
+        self._tmp = np.empty(self.shape, np.float32)
+        if method == 'sigma':
+            self.counts = np.zeros(self.shape, np.uint16)
+            self._keep = np.empty(self.shape, bool)
+        self.frames = 0
+        self.rejected = 0
+
+    def reset(self):
+        self.mean.fill(0)
+        self.m2.fill(0)
+        if self.method == 'sigma':
+            self.counts.fill(0)
+        self.frames = 0
+        self.rejected = 0
+
+    def add(self, frame):
+        self.frames += 1
+        delta, tmp = self._delta, self._tmp
+        np.subtract(frame, self.mean, out=delta, casting='unsafe')
+        if self.method == 'mean' or self.frames <= self.warmup:
+            n = self.frames
+            np.multiply(delta, 1.0 / n, out=tmp)
+            self.mean += tmp
+            if self.method == 'sigma':
+                self.counts += 1
+        else:
+            # Reject the pixels outside mean +/- kappa * sigma of this
+            # pixel's accepted values so far.
+            keep, counts = self._keep, self.counts
+            np.divide(self.m2, np.maximum(counts, 2) - 1, out=tmp)
+            np.sqrt(tmp, out=tmp)
+            tmp *= self.kappa
+            np.less_equal(np.abs(delta), tmp, out=keep)
+            self.rejected += keep.size - int(np.count_nonzero(keep))
+            counts += keep
+            np.divide(delta, np.maximum(counts, 1), out=tmp)
+            tmp *= keep
+            self.mean += tmp
+            delta *= keep
+        # m2 += delta * (frame - new mean)
+        np.subtract(frame, self.mean, out=tmp, casting='unsafe')
+        tmp *= delta
+        self.m2 += tmp
+
+    # Number of frames accumulated in each pixel.
+    def counted(self):
+        if self.method == 'sigma':
+            return self.counts
+        return self.frames
+
+    # Estimated SNR (median over pixels with signal) of a single frame and
+    # of the stack. The temporal standard deviation is used as the noise of
+    # one frame; averaging n frames divides it by sqrt(n).
+    def snr(self, step=4):
+        if self.frames < 2:
+            return 0.0, 0.0
+        mean = self.mean[::step, ::step]
+        n = self.counted()
+        if self.method == 'sigma':
+            n = n[::step, ::step].astype(np.float32)
+        std = np.sqrt(self.m2[::step, ::step] / np.maximum(n - 1, 1))
+        valid = (std > 0) & (mean >= 1.0)
+        if not valid.any():
+            return 0.0, 0.0
+        single = mean[valid] / std[valid]
+        if self.method == 'sigma':
+            stacked = single * np.sqrt(n[valid])
+        else:
+            stacked = single * np.sqrt(n)
+        return float(np.median(single)), float(np.median(stacked))
+
+    # Mean image scaled to 16 bits (x256 for 8-bit frames), which keeps the
+    # fractional part gained by averaging and stays linear.
+    def result16(self, out=None, scale=256.0):
+        if out is None:
+            out = np.empty(self.shape, np.uint16)
+        np.multiply(self.mean, scale, out=self._tmp)
+        np.clip(self._tmp, 0, 65535, out=self._tmp)
+        np.copyto(out, self._tmp, casting='unsafe')
+        return out
+
+
+# Report of a stack capture. snr2PerSecond (SNR squared per second of
+# acquisition) is the figure to compare between frame counts and exposures:
+# for shot-noise limited images it only improves when less time is wasted
+# between exposures.
+class StackReport(object):
+    def __init__(self, frames, seconds, singleSNR, stackedSNR, rejected=0):
+        self.frames = frames
+        self.seconds = seconds
+        self.singleSNR = singleSNR
+        self.stackedSNR = stackedSNR
+        self.rejected = rejected
+        self.snrGain = stackedSNR / singleSNR if singleSNR else 0.0
+        self.snrGainPerSecond = ((stackedSNR - singleSNR) / seconds
+                                 if seconds else 0.0)
+        self.snr2PerSecond = stackedSNR ** 2 / seconds if seconds else 0.0
+
+    def __str__(self):
+        return ("Stack of %d frames in %.2f s (%.1f fps): SNR %.1f -> %.1f "
+                "(x%.2f), +%.2f SNR/s, SNR^2/s %.0f, %d pixels rejected" % (
+                    self.frames, self.seconds,
+                    self.frames / self.seconds if self.seconds else 0,
+                    self.singleSNR, self.stackedSNR, self.snrGain,
+                    self.snrGainPerSecond, self.snr2PerSecond,
+                    self.rejected))
+
+
+class BurstStacker(object):
+    # camera:     PiCamera (or compatible) object.
+    # resolution: sensor resolution of the burst (video port).
+    # method:     'mean' or 'sigma', see FrameStacker.
+    def __init__(self, camera, resolution=STACK_RESOLUTION, method='mean',
+                 count=2):
+        self.camera = camera
+        self.resolution = tuple(resolution)
+        self.stacker = FrameStacker(
+            (resolution[1], resolution[0], 3), method)
+        # Ring of capture buffers: one being written by the camera, one
+        # being accumulated and one spare.
+        self._ring = BufferPool(self.resolution, 3)
+        self.pool = BufferPool(self.resolution, count, dtype=np.uint16)
+
+    # Captures "frames" frames and returns the StackReport; the mean is left
+    # in self.stacker. The caller must hold the camera lock. Through
+    # CapturePipeline, submit the job with resolution=self.resolution: the
+    # camera is then already at the burst resolution and is not
+    # reconfigured here.
+    def capture(self, frames):
+        self.stacker.reset()
+        if self.camera.resolution != self.resolution:
+            self.camera.resolution = self.resolution
+        ring = [self._ring.acquire() for _ in range(3)]
+        free = queue.Queue()
+        for buf in ring:
+            free.put(buf)
+        filled = queue.Queue()
+        errors = []
+
+        # Accumulates the frames while the camera fills the next buffer.
+        def accumulate():
+            while True:
+                buf = filled.get()
+                if buf is None:
+                    return
+                try:
+                    self.stacker.add(buf.array)
+                except Exception as e:
+                    errors.append(e)
+                free.put(buf)
+
+        # Hands one free buffer at a time to capture_sequence; when asked
+        # for the next one, the previous buffer holds a complete frame.
+        def outputs():
+            for _ in range(frames):
+                buf = free.get()
+                yield buf.raw
+                filled.put(buf)
+
+        worker = threading.Thread(target=accumulate)
+        worker.daemon = True
+        worker.start()
+        start = time.time()
+        try:
+            self.camera.capture_sequence(outputs(), format='bgr',
+                                         use_video_port=True)
+        finally:
+            filled.put(None)
+            worker.join()
+            for buf in ring:
+                buf.release()
+        seconds = time.time() - start
+        if errors:
+            raise errors[0]
+        single, stacked = self.stacker.snr()
+        return StackReport(self.stacker.frames, seconds, single, stacked,
+                           self.stacker.rejected)
+
+    # Capture function for CapturePipeline.submit(): stacks "frames" frames
+    # and returns the 16-bit mean in a pooled buffer.
+    def captureInto(self, job, frames):
+        job.stackReport = self.capture(frames)
+        job.buffer = self.pool.acquire()
+        self.stacker.result16(out=job.buffer.array)
+        job.bits = 16
+        job.times['stack'] = job.stackReport.seconds
+        return job.buffer.array
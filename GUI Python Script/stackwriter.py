@@ -0,0 +1,427 @@
+## ======== STACK WRITER ======== ##
+
+# Writes a time lapse (every timepoint and channel) into a single OME-TIFF
+# file as it is acquired, instead of one file per frame.
+# Each (t, c) plane is appended as one page of a BigTIFF file (no 4 GB
+# limit), tiled and compressed like the exports (see export.py). A page is
+# made visible only once it is complete: its tiles and directory are written
+# first, then the previous directory is linked to it. Next to the file an
+# index (<file>.idx) records, for every page, its (t, c) and where it starts
+# and ends, so any plane can be read with a seek instead of walking the
+# whole file.
+# If the acquisition is interrupted (power cut, full card) the last page may
+# be incomplete. The index and the directories only ever describe complete
+# pages, so readers ignore the partial one, and reopening the file with
+# StackWriter(..., resume=True) truncates it and continues from the last
+# complete page.
+# The OME-XML description, with the channel names and the final number of
+# timepoints, is rewritten when the writer is closed.
+
+from __future__ import division
+
+import os
+import re
+import struct
+import threading
+import zlib
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from export import (COMPRESSION_CODES, Exporter, buildIFD, imageTags,
+                    tileCompressor, zstandard, imagecodecs)
+
+INDEX_MAGIC = b'BIOSTK1\n'
+INDEX_RECORD = struct.Struct('<IIQQ')    # t, c, directory offset, page end
+HEADER_SIZE = 16
+TAG_DESCRIPTION = 270
+TAG_PAGE_NAME = 285
+OME_NAMESPACE = 'http://www.openmicroscopy.org/Schemas/OME/2016-06'
+
+
+# File name based on "base" that does not exist yet: base + extension, or
+# base-1 + extension, base-2 + extension...
+def uniqueFileName(base, extension):
+    fileName = base + extension
+    n = 1
+    while os.path.exists(fileName):
+        fileName = '%s-%d%s' % (base, n, extension)
+        n += 1
+    return fileName
+
+
+def indexFileName(fileName):
+    return fileName + '.idx'
+
+
+# OME-XML of a stack. pages is a list of (t, c) in file order.
+def omeXML(name, shape, dtype, channels, pages, interval=None):
+    height, width = shape[:2]
+    samples = shape[2] if len(shape) == 3 else 1
+    sizeT = max(t for t, c in pages) + 1 if pages else 0
+    increment = (' TimeIncrement="%g" TimeIncrementUnit="s"' % interval
+                 if interval else '')
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<OME xmlns="%s">' % OME_NAMESPACE,
+        '<Image ID="Image:0" Name="%s">' % escape(name),
+        '<Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="%s" '
+        'SizeX="%d" SizeY="%d" SizeZ="1" SizeC="%d" SizeT="%d"%s>' % (
+            np.dtype(dtype).name, width, height, samples * len(channels),
+            sizeT, increment),
+    ]
+    for i, channel in enumerate(channels):
+        lines.append('<Channel ID="Channel:0:%d" Name="%s" '
+                     'SamplesPerPixel="%d"/>' % (i, escape(channel), samples))
+    for ifd, (t, c) in enumerate(pages):
+        lines.append('<TiffData IFD="%d" FirstT="%d" FirstC="%d" '
+                     'FirstZ="0" PlaneCount="1"/>' % (ifd, t, c))
+    lines += ['</Pixels>', '</Image>', '</OME>']
+    return '\n'.join(lines)
+
+
+# Reads the complete pages listed in the index, ignoring a partial record
+# and the pages that end beyond the end of the file.
+def readIndex(fileName, fileSize):
+    records = []
+    try:
+        with open(indexFileName(fileName), 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            while True:
+                data = f.read(INDEX_RECORD.size)
+                if len(data) < INDEX_RECORD.size:
+                    break
+                record = INDEX_RECORD.unpack(data)
+                if record[3] > fileSize:
+                    break
+                records.append(record)
+    except (IOError, OSError):
+        return None
+    return records
+
+
+# Directory entries of a BigTIFF page: {tag: (type, count, value or offset,
+# position of the value field)}.
+def readDirectory(f, offset):
+    f.seek(offset)
+    count, = struct.unpack('<Q', f.read(8))
+    data = f.read(count * 20 + 8)
+    entries = {}
+    for i in range(count):
+        tag, kind, n = struct.unpack_from('<HHQ', data, i * 20)
+        entries[tag] = (kind, n, data[i * 20 + 12:i * 20 + 20],
+                        offset + 8 + i * 20 + 12)
+    nextIFD, = struct.unpack_from('<Q', data, count * 20)
+    return entries, nextIFD
+
+
+TYPE_FORMATS = {2: 's', 3: 'H', 4: 'I', 16: 'Q'}
+
+
+def tagValues(f, entry):
+    kind, count, raw, position = entry
+    fmt = TYPE_FORMATS[kind]
+    size = struct.calcsize('<' + fmt) * count
+    if size <= 8:
+        data = raw[:size]
+    else:
+        offset, = struct.unpack('<Q', raw)
+        f.seek(offset)
+        data = f.read(size)
+    if kind == 2:
+        return data.rstrip(b'\0').decode('ascii', 'replace')
+    return struct.unpack('<%d%s' % (count, fmt), data)
+
+
+# Decompression function for a TIFF compression code.
+def tileDecompressor(code):
+    if code == COMPRESSION_CODES['none']:
+        return lambda data: data
+    if code == COMPRESSION_CODES['zlib']:
+        return zlib.decompress
+    if code == COMPRESSION_CODES['zstd']:
+        if zstandard is not None:
+            return lambda data: zstandard.ZstdDecompressor().decompress(data)
+        if imagecodecs is not None:
+            return imagecodecs.zstd_decode
+    if code == COMPRESSION_CODES['lzw'] and imagecodecs is not None:
+        return imagecodecs.lzw_decode
+    raise ValueError("Unsupported TIFF compression: %d" % code)
+
+
+# End of a page: the end of its directory and of the values it points to
+# (its tiles are written before it). The description is left out: close()
+# moves the one of the first page to the end of the file, after the pages
+# appended since.
+def directoryEnd(offset, entries):
+    end = offset + 8 + len(entries) * 20 + 8
+    for tag, (kind, count, raw, position) in entries.items():
+        if tag == TAG_DESCRIPTION:
+            continue
+        size = struct.calcsize('<' + TYPE_FORMATS[kind]) * count
+        if size > 8:
+            end = max(end, struct.unpack('<Q', raw)[0] + size)
+    return end
+
+
+# Walks the chain of directories of a stack whose index is missing and
+# returns the index records of the complete pages.
+def scanPages(f, fileSize):
+    f.seek(8)
+    offset, = struct.unpack('<Q', f.read(8))
+    records = []
+    while offset and offset < fileSize:
+        try:
+            entries, nextIFD = readDirectory(f, offset)
+            name = tagValues(f, entries[TAG_PAGE_NAME])
+            t, c = (int(v) for v in re.findall(r'\d+', name)[:2])
+        except (struct.error, KeyError, ValueError):
+            break
+        end = directoryEnd(offset, entries)
+        if end > fileSize:
+            break
+        records.append((t, c, offset, end))
+        offset = nextIFD
+    return records
+
+
+class StackWriter(object):
+    # fileName:    OME-TIFF to write, e.g. "timelapse.ome.tiff".
+    # channels:    names of the channels, in their c order.
+    # compression: TIFF compression of the pages (see export.py) and level.
+    # interval:    time between timepoints in seconds, for the metadata.
+    # resume:      continue an existing stack after its last complete page
+    #              instead of starting a new file.
+    def __init__(self, fileName, channels, exporter=None, compression='zlib',
+                 level=1, interval=None, resume=False):
+        self.fileName = fileName
+        self.channels = list(channels)
+        self.exporter = exporter or Exporter()
+        self._ownExporter = exporter is None
+        self.compression = compression
+        self.level = level
+        self.compressor = tileCompressor(compression, level)
+        if self.compressor is None:
+            raise ValueError("%s compression is not available" % compression)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pages = []
+        self.shape = None
+        self.dtype = None
+        # Position of the next directory pointer of the last page, and of
+        # the description entry of the first one.
+        self._lastPointer = 8
+        self._descriptionEntry = None
+        if resume and os.path.exists(fileName):
+            self._resume()
+        else:
+            self.file = open(fileName, 'w+b')
+            self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+            self.end = HEADER_SIZE
+            self.index = open(indexFileName(fileName), 'wb')
+            self.index.write(INDEX_MAGIC)
+            self.index.flush()
+
+    # Drops a partial last page and reopens the file for appending.
+    def _resume(self):
+        self.file = open(self.fileName, 'r+b')
+        fileSize = os.path.getsize(self.fileName)
+        records = readIndex(self.fileName, fileSize)
+        if records is None:
+            records = scanPages(self.file, fileSize)
+        if not records and self._firstPage():
+            # A page was linked, so complete: never truncate it away.
+            self.file.close()
+            raise IOError("%s: no complete page found, not resuming it" %
+                          self.fileName)
+        self.end = records[-1][3] if records else HEADER_SIZE
+        if records:
+            entries, nextIFD = readDirectory(self.file, records[-1][2])
+            self._lastPointer = self._nextPointer(records[-1][2],
+                                                  len(entries))
+            first, _ = readDirectory(self.file, records[0][2])
+            self.shape, self.dtype = self._pageShape(first)
+            self._descriptionEntry = first[TAG_DESCRIPTION][3] - 12
+            # Keep the description written by close() if it is there.
+            kind, count, raw, position = first[TAG_DESCRIPTION]
+            descriptionEnd = struct.unpack('<Q', raw)[0] + count
+            if descriptionEnd <= fileSize:
+                self.end = max(self.end, descriptionEnd + descriptionEnd % 2)
+        self.file.truncate(self.end)
+        # A page written after the last complete one may have been linked
+        # already; unlink it.
+        self.file.seek(self._lastPointer)
+        self.file.write(struct.pack('<Q', 0))
+        self.pages = [(t, c) for t, c, offset, end in records]
+        self.index = open(indexFileName(self.fileName), 'wb')
+        self.index.write(INDEX_MAGIC)
+        for record in records:
+            self.index.write(INDEX_RECORD.pack(*record))
+        self.index.flush()
+
+    # Offset of the first directory in the header, 0 if no page was linked.
+    def _firstPage(self):
+        self.file.seek(8)
+        data = self.file.read(8)
+        return struct.unpack('<Q', data)[0] if len(data) == 8 else 0
+
+    def _pageShape(self, entries):
+        width = tagValues(self.file, entries[256])[0]
+        height = tagValues(self.file, entries[257])[0]
+        samples = tagValues(self.file, entries[277])[0]
+        bits = tagValues(self.file, entries[258])[0]
+        shape = (height, width, samples) if samples > 1 else (height, width)
+        return shape, np.uint8 if bits == 8 else np.uint16
+
+    @staticmethod
+    def _nextPointer(offset, count):
+        return offset + 8 + count * 20
+
+    # Compression of the pages appended from now on (e.g. a stronger one
+    # when the card is filling up); every page records its own.
+    def setCompression(self, compression, level=None):
+        compressor = tileCompressor(compression, level)
+        if compressor is None:
+            raise ValueError("%s compression is not available" % compression)
+        with self.lock:
+            self.compression = compression
+            self.level = level
+            self.compressor = compressor
+
+    def channelIndex(self, channel):
+        if isinstance(channel, int):
+            return channel
+        return self.channels.index(channel)
+
+    # Appends the plane of timepoint t and channel c (index or name).
+    # Planes must all have the same shape and type.
+    def append(self, t, c, image):
+        c = self.channelIndex(c)
+        with self.lock:
+            if self.shape is None:
+                self.shape, self.dtype = image.shape, image.dtype
+            elif image.shape != self.shape or image.dtype != self.dtype:
+                raise ValueError("Plane %s %s does not match the stack %s %s"
+                                 % (image.shape, image.dtype, self.shape,
+                                    np.dtype(self.dtype)))
+            f = self.file
+            f.seek(self.end)
+            offset = self.end
+            offsets = []
+            counts = []
+            predictor = self.compression != 'none'
+            for data in self.exporter.encodeTiles(image, self.compressor,
+                                                  predictor):
+                f.write(data)
+                offsets.append(offset)
+                counts.append(len(data))
+                offset += len(data)
+            if offset % 2:
+                f.write(b'\0')
+                offset += 1
+            tags = imageTags(image, COMPRESSION_CODES[self.compression],
+                             predictor, self.exporter.tile)
+            tags += [(324, 'LONG8', offsets), (325, 'LONG8', counts),
+                     (TAG_PAGE_NAME, 'ASCII', 'T%d C%d' % (t, c))]
+            first = not self.pages
+            if first:
+                tags.append((TAG_DESCRIPTION, 'ASCII', self._description(
+                    self.pages + [(t, c)])))
+            directory = buildIFD(tags, offset, big=True)
+            f.write(directory)
+            end = offset + len(directory)
+            f.flush()
+            # The page is complete, link it.
+            f.seek(self._lastPointer)
+            f.write(struct.pack('<Q', offset))
+            f.flush()
+            if first:
+                position = sorted(tag for tag, kind, values in tags).index(
+                    TAG_DESCRIPTION)
+                self._descriptionEntry = offset + 8 + position * 20
+            self._lastPointer = self._nextPointer(offset, len(tags))
+            self.end = end
+            self.pages.append((t, c))
+            self.index.write(INDEX_RECORD.pack(t, c, offset, end))
+            self.index.flush()
+
+    def _description(self, pages):
+        return omeXML(os.path.basename(self.fileName), self.shape,
+                      self.dtype, self.channels, pages, self.interval)
+
+    # Writes the final OME-XML (at the end of the file, pointed to by the
+    # description of the first page) and closes the files.
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self._descriptionEntry is not None:
+                text = self._description(self.pages).encode('ascii') + b'\0'
+                self.file.seek(self.end)
+                self.file.write(text)
+                self.file.seek(self._descriptionEntry + 4)
+                self.file.write(struct.pack('<QQ', len(text), self.end))
+            self.file.close()
+            self.index.close()
+            self.file = None
+        if self._ownExporter:
+            self.exporter.close()
+
+
+class StackReader(object):
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = open(fileName, 'rb')
+        fileSize = os.path.getsize(fileName)
+        records = readIndex(fileName, fileSize)
+        if records is None:
+            records = scanPages(self.file, fileSize)
+        self.pages = dict(((t, c), offset) for t, c, offset, end in records)
+        self.channels = []
+        if records:
+            entries, _ = readDirectory(self.file, records[0][2])
+            if TAG_DESCRIPTION in entries:
+                self.description = tagValues(self.file,
+                                             entries[TAG_DESCRIPTION])
+                self.channels = re.findall(r'<Channel [^>]*Name="([^"]*)"',
+                                           self.description)
+
+    def close(self):
+        self.file.close()
+
+    def timepoints(self):
+        return max(t for t, c in self.pages) + 1 if self.pages else 0
+
+    # Plane of timepoint t and channel c, as a BGR (or single channel)
+    # array.
+    def read(self, t, c):
+        if not isinstance(c, int):
+            c = self.channels.index(c)
+        f = self.file
+        entries, _ = readDirectory(f, self.pages[(t, c)])
+        value = lambda tag: tagValues(f, entries[tag])
+        width, height = value(256)[0], value(257)[0]
+        samples = value(277)[0]
+        dtype = np.uint8 if value(258)[0] == 8 else np.dtype('<u2')
+        tileWidth, tileHeight = value(322)[0], value(323)[0]
+        predictor = 317 in entries and value(317)[0] == 2
+        decompress = tileDecompressor(value(259)[0])
+        offsets, counts = value(324), value(325)
+        image = np.empty((height, width, samples), dtype)
+        across = (width + tileWidth - 1) // tileWidth
+        for i, (offset, count) in enumerate(zip(offsets, counts)):
+            f.seek(offset)
+            tile = np.frombuffer(decompress(f.read(count)), dtype).reshape(
+                tileHeight, tileWidth, samples)
+            if predictor:
+                tile = np.cumsum(tile, axis=1, dtype=dtype)
+            y = (i // across) * tileHeight
+            x = (i % across) * tileWidth
+            block = image[y:y + tileHeight, x:x + tileWidth]
+            block[...] = tile[:block.shape[0], :block.shape[1]]
+        if samples == 3:
+            image = image[:, :, ::-1]
+        elif samples == 1:
+            image = image[:, :, 0]
+        return np.ascontiguousarray(image)
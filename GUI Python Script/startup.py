@@ -0,0 +1,66 @@
+## ======== STARTUP TIMING ======== ##
+
+# Measures how long the GUI takes to start.
+# The window is built and painted first; the heavy modules (NumPy, OpenCV,
+# PIL, picamera), the camera and the capture pipeline are loaded afterwards
+# on a background thread (see loadHardware() in BioARTS_Microscope.py).
+# Each step is marked here as it finishes and the report printed once the
+# GUI is ready breaks the startup down into time-to-window and
+# time-to-first-capture.
+# Times are counted from the start of the process when the system tells it
+# (Linux), so the time the interpreter needs to start is included.
+
+from __future__ import division
+
+import os
+import threading
+
+from clock import monotonic
+
+
+# Seconds since the current process started, None when unknown.
+def processAge():
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # Field 22, starttime, in clock ticks after boot. The fields are
+        # counted after the command name, which may contain spaces.
+        ticks = int(stat.rsplit(')', 1)[1].split()[19])
+        return max(0.0, uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer(object):
+    def __init__(self):
+        age = processAge()
+        self.start = monotonic() - (age or 0.0)
+        self.lock = threading.Lock()
+        self.marks = []
+        if age is not None:
+            self.marks.append(('interpreter', age))
+
+    # Records that the step "name" has just finished. Only the first mark of
+    # each name counts.
+    def mark(self, name):
+        with self.lock:
+            if name not in dict(self.marks):
+                self.marks.append((name, monotonic() - self.start))
+
+    def elapsed(self, name):
+        with self.lock:
+            return dict(self.marks).get(name)
+
+    # One line per step: time since start and time spent in the step.
+    def report(self):
+        with self.lock:
+            marks = list(self.marks)
+        lines = ["Startup timing:"]
+        previous = 0.0
+        for name, t in marks:
+            lines.append("  %-16s %7.0f ms  (+%.0f ms)" % (
+                name, t * 1000, (t - previous) * 1000))
+            previous = t
+        return "\n".join(lines)
@@ -0,0 +1,245 @@
+## ======== STORAGE MONITOR ======== ##
+
+# Keeps an eye on the SD card during long acquisitions, so a run does not
+# fail silently when the card fills up or the writes fall behind.
+# Every file (or stack page) written is reported with its size and the time
+# the write took. Over the last WINDOW seconds (or WINDOW_INTERVALS
+# intervals of a slower time lapse) the monitor works out:
+#   - the fill rate: bytes written per second of acquisition;
+#   - the bandwidth: bytes per second while writing, what the card can do;
+#   - how busy the writer is: the fraction of the time spent writing;
+# and, from the free space of the file system (os.statvfs), the time left
+# before the card is full at the current fill rate. The depth of the write
+# queue is reported by the writer as well; a full queue means the captures
+# are waiting for the card.
+# The rates are measured on the wall clock since the start of the
+# acquisition (see reset()), until the window is full. Each timepoint counts
+# for the interval that follows it, so a time lapse is not seen filling the
+# card at the speed of the burst that writes its first timepoint.
+# A StoragePolicy turns that into an action, from the mildest:
+#   warn      print the status (and show it in orange in the GUI);
+#   compress  write with a stronger compression (COMPRESSED_FORMAT, or
+#             COMPRESSION for stacks, where each page has its own);
+#   reduce    halve the resolution of the images written (single files
+#             only, the pages of a stack must all have the same shape);
+#   pause     skip the timepoints until there is room again.
+# The time left decides between them (e.g. below an hour compress), the
+# free space below MIN_FREE pauses (a pause on the time left alone would end
+# as soon as the fill rate dropped to zero), and a writer that is behind
+# asks for at least "warn" (busy) or "reduce" (queue full). Until
+# MIN_SAMPLES writes have been recorded the rates are not trusted beyond
+# "warn"; only a card that is really full pauses. Writers only apply the
+# actions they support, the strongest one not above the level reached.
+
+from __future__ import division, print_function
+
+import collections
+import os
+import threading
+
+import cv2
+
+from clock import monotonic
+
+ACTIONS = ('warn', 'compress', 'reduce', 'pause')
+# Actions of a stack, which cannot change the size of its pages.
+STACK_ACTIONS = ('warn', 'compress', 'pause')
+LEVELS = ('ok',) + ACTIONS
+WINDOW = 120.0
+WINDOW_INTERVALS = 5
+MIN_SAMPLES = 2
+MIN_FREE = 200 << 20
+# Fraction of the time spent writing above which the writer is behind.
+MAX_BUSY = 0.9
+# Seconds between two reads of the free space.
+SPACE_INTERVAL = 1.0
+COMPRESSED_FORMAT = 'TIFF zlib 6'
+COMPRESSION = ('zlib', 6)
+
+
+# "3 h 20 min", "45 min", "30 s".
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d h %02d min" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%d min" % (seconds // 60)
+    return "%d s" % seconds
+
+
+class StorageStatus(object):
+    def __init__(self, free, total, fillRate, bandwidth, busy, queued,
+                 capacity, secondsLeft, samples=0):
+        self.free = free
+        self.total = total
+        self.fillRate = fillRate
+        self.bandwidth = bandwidth
+        self.busy = busy
+        self.queued = queued
+        self.capacity = capacity
+        # None while nothing has been written.
+        self.secondsLeft = secondsLeft
+        # Number of writes the rates were computed from.
+        self.samples = samples
+        self.level = 'ok'
+
+    @property
+    def queueFull(self):
+        return self.capacity > 0 and self.queued >= self.capacity
+
+    def __str__(self):
+        text = "%.1f GB free" % (self.free / 1e9)
+        if self.fillRate:
+            text += ", writing %.1f MB/s (card %.1f MB/s, %d%% busy)" % (
+                self.fillRate / 1e6, self.bandwidth / 1e6, self.busy * 100)
+        if self.capacity:
+            text += ", queue %d/%d" % (self.queued, self.capacity)
+        if self.secondsLeft is not None:
+            text += ", full in %s" % formatDuration(self.secondsLeft)
+        if self.level != 'ok':
+            text += " [%s]" % self.level
+        return text
+
+
+class StoragePolicy(object):
+    # warn, compress, reduce, pause: seconds left before the card is full
+    #          below which each action starts, None to not use the time.
+    # minFree: bytes of free space below which the acquisition pauses.
+    # maxBusy: fraction of the time spent writing that counts as behind.
+    # actions: the actions allowed, e.g. ('warn', 'pause') to never change
+    #          the images.
+    def __init__(self, warn=2 * 3600, compress=3600, reduce=1800, pause=None,
+                 minFree=MIN_FREE, maxBusy=MAX_BUSY, actions=ACTIONS):
+        self.thresholds = (('pause', pause), ('reduce', reduce),
+                           ('compress', compress), ('warn', warn))
+        self.minFree = minFree
+        self.maxBusy = maxBusy
+        unknown = set(actions) - set(ACTIONS)
+        if unknown:
+            raise ValueError("Unknown storage actions: %s" % ", ".join(
+                sorted(unknown)))
+        self.actions = tuple(actions)
+
+    # Level reached by a status, one of LEVELS.
+    def level(self, status):
+        level = 0
+        if status.secondsLeft is not None:
+            for name, seconds in self.thresholds:
+                if seconds is not None and status.secondsLeft < seconds:
+                    level = LEVELS.index(name)
+                    break
+        if status.queueFull:
+            level = max(level, LEVELS.index('reduce'))
+        elif status.busy > self.maxBusy:
+            level = max(level, LEVELS.index('warn'))
+        if status.samples < MIN_SAMPLES:
+            level = min(level, LEVELS.index('warn'))
+        if status.free < self.minFree:
+            level = LEVELS.index('pause')
+        return LEVELS[level]
+
+    # Strongest action allowed and "supported" by the writer not above the
+    # level of the status; 'ok' if none.
+    def action(self, status, supported=ACTIONS):
+        level = LEVELS.index(status.level)
+        for name in reversed(LEVELS[1:level + 1]):
+            if name in self.actions and name in supported:
+                return name
+        return 'ok'
+
+
+class StorageMonitor(object):
+    # directory: where the files are written (any path of the file system).
+    # policy:    StoragePolicy, the default one if not given.
+    # window:    seconds of writes the rates are computed over, at least.
+    def __init__(self, directory='.', policy=None, window=WINDOW):
+        self.directory = directory
+        self.policy = policy or StoragePolicy()
+        self.minWindow = window
+        self.writes = collections.deque()
+        self.lock = threading.Lock()
+        self.reset()
+        self.queued = 0
+        self.capacity = 0
+        self.level = 'ok'
+        self._space = None
+        self._spaceTime = None
+
+    # A file or page of "nbytes" was written in "seconds".
+    def recordWrite(self, nbytes, seconds):
+        now = monotonic()
+        with self.lock:
+            self.writes.append((now, nbytes, seconds))
+            while self.writes and self.writes[0][0] < now - self.window:
+                self.writes.popleft()
+
+    # Starts the measure of a new acquisition taking a timepoint every
+    # "interval" seconds (0 for captures made on demand), forgetting the
+    # writes recorded so far.
+    def reset(self, interval=0):
+        with self.lock:
+            self.writes.clear()
+            self.started = monotonic()
+            self.interval = max(0.0, interval or 0.0)
+            self.window = max(self.minWindow,
+                              WINDOW_INTERVALS * self.interval)
+
+    # Same as recordWrite() from an ExportResult (see export.py).
+    def recordExport(self, result):
+        self.recordWrite(result.fileBytes, result.seconds)
+
+    # Items waiting to be written and the most that can wait.
+    def setQueue(self, queued, capacity):
+        with self.lock:
+            self.queued = queued
+            self.capacity = capacity
+
+    # (free, total) bytes of the file system, read at most once per
+    # SPACE_INTERVAL.
+    def diskSpace(self):
+        now = monotonic()
+        if self._space is None or now - self._spaceTime >= SPACE_INTERVAL:
+            info = os.statvfs(self.directory)
+            self._space = (info.f_bavail * info.f_frsize,
+                           info.f_blocks * info.f_frsize)
+            self._spaceTime = now
+        return self._space
+
+    def status(self):
+        free, total = self.diskSpace()
+        now = monotonic()
+        with self.lock:
+            written = sum(nbytes for t, nbytes, seconds in self.writes)
+            writing = sum(seconds for t, nbytes, seconds in self.writes)
+            samples = len(self.writes)
+            elapsed = now - self.started
+            if elapsed < self.window:
+                span = elapsed + self.interval
+            else:
+                span = self.window
+            queued, capacity = self.queued, self.capacity
+        fillRate = written / span if span > 0 else 0.0
+        bandwidth = written / writing if writing > 0 else 0.0
+        busy = writing / span if span > 0 else 0.0
+        secondsLeft = max(0, free - self.policy.minFree) / fillRate \
+            if fillRate > 0 else None
+        status = StorageStatus(free, total, fillRate, bandwidth, busy,
+                               queued, capacity, secondsLeft, samples)
+        status.level = self.policy.level(status)
+        return status
+
+    # Status and the action the writer should apply (see
+    # StoragePolicy.action()). Changes of level are printed.
+    def check(self, supported=ACTIONS):
+        status = self.status()
+        if status.level != self.level:
+            self.level = status.level
+            print("Storage %s: %s" % (status.level, status))
+        return status, self.policy.action(status, supported)
+
+
+# Image written under the "reduce" action: half the width and height.
+def reduceImage(image):
+    height, width = image.shape[:2]
+    return cv2.resize(image, (width // 2, height // 2),
+                      interpolation=cv2.INTER_AREA)
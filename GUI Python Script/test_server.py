@@ -0,0 +1,115 @@
+## ======== REMOTE CONTROL SERVER TEST ======== ##
+
+# Starts server.py on localhost with the simulated camera and talks to it
+# over HTTP, as a client on the network would:
+#     python3 -m unittest test_server
+# Needs Python 3.7 and OpenCV, like the server.
+
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TIMEOUT = 30.0
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='microscope-server-')
+        cls.port = freePort()
+        env = dict(os.environ, MICROSCOPE_BACKEND='sim')
+        cls.server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'server.py'),
+             '--port', str(cls.port), '--directory', cls.directory],
+            cwd=cls.directory, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), 1).close()
+                break
+            except OSError:
+                if cls.server.poll() is not None or time.time() > deadline:
+                    output = cls.stop()
+                    raise RuntimeError("The server did not start:\n" +
+                                       output)
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stop()
+
+    @classmethod
+    def stop(cls):
+        if cls.server.poll() is None:
+            cls.server.send_signal(signal.SIGINT)
+        output = cls.server.communicate(timeout=STARTUP_TIMEOUT)[0]
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        return output.decode('utf-8', 'replace')
+
+    # (status, JSON reply) of a request.
+    def request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        request = Request('http://127.0.0.1:%d%s' % (self.port, path),
+                          data=body, method=method)
+        try:
+            with urlopen(request, timeout=STARTUP_TIMEOUT) as reply:
+                return reply.status, json.loads(reply.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+    def testStatus(self):
+        status, reply = self.request('GET', '/status')
+        self.assertEqual(status, 200)
+        self.assertIn('storage', reply)
+        self.assertIn('stream', reply)
+
+    def testPostSettings(self):
+        status, reply = self.request('POST', '/settings',
+                                     {'brightness': 60, 'contrast': 10})
+        self.assertEqual(status, 200)
+        self.assertEqual(reply['desired']['brightness'], 60)
+        self.assertEqual(reply['applied']['brightness'], 60)
+        self.assertEqual(reply['applied']['contrast'], 10)
+        status, reply = self.request('GET', '/settings')
+        self.assertEqual(status, 200)
+        self.assertEqual(reply['applied']['brightness'], 60)
+
+    def testPostUnknownSetting(self):
+        status, reply = self.request('POST', '/settings', {'zoom': 2})
+        self.assertEqual(status, 400)
+        self.assertIn('zoom', reply['error'])
+
+    def testGetSettingsChangesNothing(self):
+        self.request('POST', '/settings', {'sharpness': 5})
+        status, reply = self.request('GET', '/settings?sharpness=40')
+        self.assertEqual(status, 400)
+        status, reply = self.request('GET', '/settings')
+        self.assertEqual(reply['desired']['sharpness'], 5)
+        self.assertEqual(reply['applied']['sharpness'], 5)
+
+    def testTimelapseUnknownKey(self):
+        status, reply = self.request('POST', '/timelapse/start',
+                                     {'channels': ['BrFld'], 'frames': 2})
+        self.assertEqual(status, 400)
+        self.assertIn('frames', reply['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
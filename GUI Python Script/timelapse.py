@@ -0,0 +1,165 @@
+## ======== TIMELAPSE SCHEDULER ======== ##
+
+# Drift-free timelapse engine.
+# Frames are taken at absolute deadlines (start + n * interval) measured with
+# a monotonic clock, so the time spent turning the LED on, capturing and
+# encoding never accumulates into the interval.
+# Capturing and encoding are split: the scheduler thread only reads the
+# sensor at each deadline and hands the frame to an encoder thread, so frame
+# N is encoded while the scheduler waits for frame N+1.
+# The wait is done on a threading.Event, so stop() ends the sequence right
+# away instead of after the remaining delay.
+
+from __future__ import division
+
+import collections
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from clock import monotonic
+from tracing import tracer
+
+
+# Timing report of a timelapse run. Jitter is the delay between the deadline
+# of a frame and the moment its capture actually started, in seconds.
+class TimelapseStats(object):
+    def __init__(self, history=1000):
+        self.frames = 0
+        self.missed = 0
+        self.held = 0
+        self.maxJitter = 0.0
+        self.totalJitter = 0.0
+        self.jitter = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def record(self, jitter):
+        with self.lock:
+            self.frames += 1
+            self.totalJitter += jitter
+            self.maxJitter = max(self.maxJitter, jitter)
+            self.jitter.append(jitter)
+
+    def meanJitter(self):
+        with self.lock:
+            if self.frames == 0:
+                return 0.0
+            return self.totalJitter / self.frames
+
+    def summary(self):
+        return ("%d frames, %d missed deadlines, %d held, jitter mean %.1f "
+                "ms, max %.1f ms" % (self.frames, self.missed, self.held,
+                                     self.meanJitter() * 1000,
+                                     self.maxJitter * 1000))
+
+
+class TimelapseScheduler(threading.Thread):
+    # interval:  time between frames in seconds.
+    # capture:   capture(frame) reads the sensor and returns the frame data.
+    # write:     write(frame, data) encodes/stores the data, it runs on the
+    #            encoder thread.
+    # prepare:   optional, configures the camera once before the first frame.
+    # onFrame:   optional, onFrame(frame, jitter, stats) after every capture.
+    # tolerance: a deadline is counted as missed (and skipped) when the
+    #            previous frame finishes more than this many seconds after it.
+    # maxFrames: optional, number of frames after which the run finishes.
+    # onFinish:  optional, called once the sequence has ended and every
+    #            frame has been written (e.g. to close the output file).
+    # hold:      optional, hold() is asked at every deadline and the
+    #            deadline is skipped when it returns True (e.g. the card is
+    #            full, see storage.py).
+    def __init__(self, interval, capture, write, prepare=None, onFrame=None,
+                 tolerance=0.5, maxFrames=None, queueDepth=2, onFinish=None,
+                 hold=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = max(0.0, float(interval))
+        self.capture = capture
+        self.write = write
+        self.prepare = prepare
+        self.onFrame = onFrame
+        self.tolerance = tolerance
+        self.maxFrames = maxFrames
+        self.onFinish = onFinish
+        self.hold = hold
+        self.stats = TimelapseStats()
+        self.error = None
+        self.stopEvent = threading.Event()
+        self.encodeQueue = queue.Queue(maxsize=max(1, int(queueDepth)))
+        self.encoder = threading.Thread(target=self._encodeLoop,
+                                        name="timelapse-encoder")
+        self.encoder.daemon = True
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def stopped(self):
+        return self.stopEvent.is_set()
+
+    def run(self):
+        self.encoder.start()
+        try:
+            if self.prepare is not None:
+                self.prepare()
+            self._schedule()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.encodeQueue.put(None)
+            self.encoder.join()
+            if self.onFinish is not None:
+                self.onFinish()
+
+    def _schedule(self):
+        start = monotonic()
+        slot = 0
+        frame = 0
+        while self.maxFrames is None or frame < self.maxFrames:
+            deadline = start + slot * self.interval
+            wait = deadline - monotonic()
+            if wait > 0 and self.stopEvent.wait(wait):
+                return
+            if self.stopEvent.is_set():
+                return
+            if self.hold is not None and self.hold():
+                with self.stats.lock:
+                    self.stats.held += 1
+                slot += 1
+                if self.interval <= 0:
+                    # Nothing to wait for, check again in a while.
+                    self.stopEvent.wait(1.0)
+                continue
+            jitter = monotonic() - deadline
+            with tracer.span('timelapse capture'):
+                data = self.capture(frame)
+            self.stats.record(jitter)
+            # Blocks only if the encoder is more than queueDepth frames
+            # behind, which shows up as missed deadlines below.
+            self.encodeQueue.put((frame, data))
+            if self.onFrame is not None:
+                self.onFrame(frame, jitter, self.stats)
+            frame += 1
+            slot += 1
+            late = monotonic() - (start + slot * self.interval)
+            if self.interval > 0 and late > self.tolerance:
+                # Skip the deadlines that already passed instead of taking
+                # a burst of frames to catch up.
+                skipped = int(late // self.interval) + 1
+                with self.stats.lock:
+                    self.stats.missed += skipped
+                slot += skipped
+
+    def _encodeLoop(self):
+        while True:
+            item = self.encodeQueue.get()
+            if item is None:
+                return
+            frame, data = item
+            try:
+                with tracer.span('timelapse write'):
+                    self.write(frame, data)
+            except Exception as e:
+                self.error = e
@@ -0,0 +1,117 @@
+## ======== TONE MAPPING ======== ##
+
+# Gamma correction with cached lookup tables.
+# A lookup table maps every possible pixel value to its corrected value; it
+# is built once per gamma value with NumPy and kept in a small cache, so
+# moving the gamma slider back and forth does not rebuild it.
+# The ToneMapper keeps a preview-sized copy (proxy) of the captured image:
+# slider moves only correct the proxy, while the full resolution image is
+# corrected once, when it is exported.
+# Both 8-bit and 16-bit images are supported (e.g. 10-bit raw data stored in
+# 16-bit arrays).
+
+from __future__ import division
+
+import collections
+import threading
+
+import cv2
+import numpy as np
+
+PREVIEW_SIZE = (510, 384)
+LUT_CACHE_SIZE = 8
+
+
+# Builds the table mapping [0, 2^inBits - 1] to [0, 2^outBits - 1] with
+# out = (in / max) ** gamma * max, truncated like the original GUI code.
+def buildGammaLUT(gamma, inBits=8, outBits=None):
+    if outBits is None:
+        outBits = inBits
+    inMax = (1 << inBits) - 1
+    outMax = (1 << outBits) - 1
+    x = np.arange(inMax + 1, dtype=np.float64) / inMax
+    table = np.power(x, float(gamma)) * outMax
+    return table.astype(np.uint8 if outBits <= 8 else np.uint16)
+
+
+# Least recently used cache of lookup tables, keyed by (gamma, inBits,
+# outBits). Gamma values are rounded so that slider values such as
+# 0.30000000000000004 share the same entry.
+class GammaLUTCache(object):
+    def __init__(self, maxEntries=LUT_CACHE_SIZE):
+        self.maxEntries = maxEntries
+        self.tables = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lut(self, gamma, inBits=8, outBits=None):
+        key = (round(float(gamma), 4), inBits,
+               inBits if outBits is None else outBits)
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is None:
+                table = buildGammaLUT(key[0], inBits, key[2])
+            self.tables[key] = table
+            while len(self.tables) > self.maxEntries:
+                self.tables.popitem(last=False)
+        return table
+
+
+defaultCache = GammaLUTCache()
+
+
+def bitDepth(image):
+    return 8 if image.dtype == np.uint8 else 16
+
+
+# Applies a lookup table. 8-bit to 8-bit tables go through cv2.LUT, any
+# other combination uses NumPy indexing.
+def applyLUT(image, table, out=None):
+    if image.dtype == np.uint8 and table.dtype == np.uint8:
+        if out is None:
+            return cv2.LUT(image, table)
+        return cv2.LUT(image, table, dst=out)
+    if out is None:
+        return np.take(table, image)
+    return np.take(table, image, out=out)
+
+
+# Same behaviour as the former gamma_correction() of the GUI.
+def gammaCorrection(image, gamma, cache=defaultCache, bits=None):
+    return applyLUT(image, cache.lut(gamma, bits or bitDepth(image)))
+
+
+class ToneMapper(object):
+    # image:       full resolution capture (BGR, uint8 or uint16).
+    # previewSize: (width, height) of the proxy used for the live preview.
+    # bits:        significant bits of the image when fewer than its type
+    #              holds (e.g. 10 for raw sensor counts).
+    def __init__(self, image, previewSize=PREVIEW_SIZE, cache=defaultCache,
+                 bits=None):
+        self.source = image
+        self.cache = cache
+        self.bits = bits or bitDepth(image)
+        self.proxy = cv2.resize(image, previewSize,
+                                interpolation=cv2.INTER_AREA)
+        self._previewOut = np.empty(self.proxy.shape, np.uint8)
+        self._exported = None
+        self._exportedGamma = None
+
+    # Gamma corrected proxy as an 8-bit image, ready to be displayed. The
+    # returned array is reused by the next call.
+    def preview(self, gamma):
+        table = self.cache.lut(gamma, self.bits, 8)
+        return applyLUT(self.proxy, table, out=self._previewOut)
+
+    # Gamma corrected full resolution image, with the bit depth of the
+    # source. It is only computed when asked for. Without "out" the last
+    # result is kept in case the same gamma is exported again; with "out"
+    # (e.g. a pooled buffer) the result is written there and not kept.
+    def export(self, gamma, out=None):
+        table = self.cache.lut(gamma, self.bits)
+        if out is not None:
+            return applyLUT(self.source, table, out=out)
+        if self._exported is None or self._exportedGamma != gamma:
+            self._exported = None
+            self._exported = applyLUT(self.source, table)
+            self._exportedGamma = gamma
+        return self._exported
@@ -0,0 +1,183 @@
+## ======== TIMING SPANS ======== ##
+
+# Tells where the time of a slow capture goes: reading the sensor, resizing
+# the thumbnail, building the PhotoImage for Tk, compressing and writing the
+# file...
+# Code measures a stage with a span:
+#     with tracer.span('thumbnail'):
+#         ...
+# or a whole function with the @tracer.traced('led BrFld') decorator. Each
+# span records its name, an optional detail (e.g. the file format), the
+# thread and its start and duration in a ring buffer of the last CAPACITY
+# spans, so the memory used is fixed however long the program runs. From it:
+#   - summary(): count, median, 90th and 99th percentiles and maximum of
+#     every name, also shown by the GUI over the capture canvas;
+#   - writeCsv(): one row per span, for a spreadsheet;
+#   - writeChromeTrace(): the Trace Event format, which chrome://tracing and
+#     https://ui.perfetto.dev show as a timeline with one row per thread.
+# Tracing is off unless MICROSCOPE_TRACE=1 is set or enable() is called.
+# When off, span() returns the same do-nothing object without reading the
+# clock, so the spans can stay in the capture path (well under a
+# microsecond each).
+
+from __future__ import division
+
+import collections
+import csv
+import functools
+import json
+import os
+import threading
+
+from clock import monotonic
+
+CAPACITY = 4096
+TRACE_VARIABLE = 'MICROSCOPE_TRACE'
+PERCENTILES = (50, 90, 99)
+
+# name, detail, thread name, start and duration (seconds).
+Span = collections.namedtuple('Span', 'name detail thread start duration')
+
+
+# Percentile p (0-100) of sorted values, interpolated between the closest
+# two.
+def percentile(values, p):
+    if not values:
+        return None
+    position = (len(values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'detail', 'start')
+
+    def __init__(self, tracer, name, detail):
+        self.tracer = tracer
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, monotonic() - self.start,
+                           self.detail)
+        return False
+
+
+class Tracer(object):
+    # capacity: number of spans kept, the oldest are dropped first.
+    def __init__(self, capacity=CAPACITY, enabled=False):
+        # Appending to a bounded deque is atomic, spans need no lock.
+        self.spans = collections.deque(maxlen=capacity)
+        self.enabled = enabled
+        self.origin = monotonic()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        self.spans.clear()
+
+    # Context manager measuring the code it encloses.
+    def span(self, name, detail=None):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, detail)
+
+    # Decorator measuring every call of a function.
+    def traced(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, name, None):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Adds a span measured elsewhere; "start" is a monotonic() time.
+    def record(self, name, start, duration, detail=None):
+        if self.enabled:
+            self.spans.append(Span(name, detail,
+                                   threading.current_thread().name,
+                                   start, duration))
+
+    def snapshot(self):
+        return list(self.spans)
+
+    # {name: sorted durations} of the spans in the buffer.
+    def durations(self):
+        durations = collections.defaultdict(list)
+        for span in self.snapshot():
+            durations[span.name].append(span.duration)
+        for values in durations.values():
+            values.sort()
+        return durations
+
+    # One line per name: count, percentiles and maximum in milliseconds.
+    def summary(self, percentiles=PERCENTILES):
+        durations = self.durations()
+        if not durations:
+            return "No spans recorded" if self.enabled else "Tracing is off"
+        lines = ["%-18s %5s %s %8s" % (
+            "span", "n", " ".join("%8s" % ("p%d" % p) for p in percentiles),
+            "max ms")]
+        for name in sorted(durations):
+            values = durations[name]
+            lines.append("%-18s %5d %s %8.1f" % (
+                name[:18], len(values),
+                " ".join("%8.1f" % (percentile(values, p) * 1000)
+                         for p in percentiles),
+                values[-1] * 1000))
+        return "\n".join(lines)
+
+    def writeCsv(self, fileName):
+        with open(fileName, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(('name', 'detail', 'thread', 'start_ms',
+                             'duration_ms'))
+            for span in self.snapshot():
+                writer.writerow((span.name, span.detail or '', span.thread,
+                                 '%.3f' % ((span.start - self.origin) * 1000),
+                                 '%.3f' % (span.duration * 1000)))
+
+    # Trace Event format: complete ("X") events in microseconds, and the
+    # names of the threads.
+    def writeChromeTrace(self, fileName):
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for span in self.snapshot():
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            event = {'name': span.name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((span.start - self.origin) * 1e6, 1),
+                     'dur': round(span.duration * 1e6, 1)}
+            if span.detail is not None:
+                event['args'] = {'detail': span.detail}
+            events.append(event)
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': thread}})
+        with open(fileName, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Tracer shared by the whole program.
+tracer = Tracer(enabled=os.environ.get(TRACE_VARIABLE, '0') not in
+                ('', '0'))